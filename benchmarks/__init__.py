@@ -0,0 +1,13 @@
+"""Speed benchmarks for the emulator's hot paths: the cpu run loop and interpreter, the mmu
+and the cartridge.
+
+Run them with:
+
+  python -m benchmarks                         # print the results
+  python -m benchmarks --save baseline.json    # and save them as JSON
+  python -m benchmarks --compare baseline.json # fail if slower than a saved run
+
+See benchmarks.roms for the synthetic roms the cpu benchmarks run, and benchmarks.suite
+for the benchmarks themselves.
+
+"""
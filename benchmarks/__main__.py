@@ -0,0 +1,70 @@
+import argparse
+import json
+import sys
+
+from benchmarks.suite import compare, names, run_suite
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(
+    prog='python -m benchmarks', description="Measure the speed of the emulator.")
+  parser.add_argument('-k', '--filter', action='append', default=[],
+                      help="only run benchmarks whose names contain this (repeatable)")
+  parser.add_argument('-d', '--duration', type=float, default=1.0,
+                      help="seconds to measure each benchmark for (default: 1)")
+  parser.add_argument('-r', '--repeat', type=int, default=3,
+                      help="measurements per benchmark, of which the best is kept")
+  parser.add_argument('--json', action='store_true',
+                      help="write the results to stdout as JSON")
+  parser.add_argument('--save', metavar='PATH', help="save the results as JSON to PATH")
+  parser.add_argument('--compare', metavar='PATH',
+                      help="compare against the results saved in PATH, and exit with "
+                           "status 1 if anything got slower by more than the threshold")
+  parser.add_argument('--threshold', type=float, default=0.1,
+                      help="fraction a rate may drop by before it counts as a regression "
+                           "(default: 0.1)")
+  parser.add_argument('--list', action='store_true', help="list the benchmarks and exit")
+  args = parser.parse_args(argv)
+
+  selected = [name for name in names()
+              if not args.filter or any(f in name for f in args.filter)]
+  if args.list:
+    for name in selected:
+      print(name)
+    return 0
+
+  baseline = None
+  if args.compare:
+    with open(args.compare) as f:
+      baseline = json.load(f)
+
+  def progress(name):
+    sys.stderr.write("%s...\n" % name)
+  results = run_suite(selected, args.duration, args.repeat, progress)
+
+  if args.save:
+    with open(args.save, 'w') as f:
+      json.dump(results, f, indent=2, sort_keys=True)
+  if args.json:
+    json.dump(results, sys.stdout, indent=2, sort_keys=True)
+    sys.stdout.write('\n')
+  elif baseline is None:
+    for name, metrics in sorted(results['benchmarks'].items()):
+      for metric, value in sorted(metrics.items()):
+        print("%-28s %-24s %14.0f" % (name, metric, value))
+
+  if baseline is None:
+    return 0
+  rows = compare(baseline, results, args.threshold)
+  out = sys.stderr if args.json else sys.stdout
+  for name, metric, old, new, ratio, regressed in rows:
+    out.write("%-28s %-24s %14.0f %14.0f %7.2fx%s\n" % (
+      name, metric, old, new, ratio, '  REGRESSED' if regressed else ''))
+  regressions = sum(row[-1] for row in rows)
+  out.write("%d of %d rates regressed by more than %d%%\n" % (
+    regressions, len(rows), args.threshold * 100))
+  return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,171 @@
+"""Synthetic roms for the cpu benchmarks. Each one sets up and then loops forever over a
+kind of code that stresses one part of the emulator.
+
+"""
+
+from gb.cartridge import ROM_TYPE_BYTE
+from gb.mem import BANK_SIZE
+
+# Where code starts, as after the bios.
+ENTRY = 0x100
+
+# Cartridge type: MBC1 with ram.
+MBC1_RAM = 0x02
+
+
+def assemble(code, org=ENTRY):
+  """Resolve the labels in code, a list of bytes and of:
+
+    - 'name:' strings, which define a label at that point,
+    - ('rel', 'name') pairs, the one byte jr offset from after the pair to the label,
+    - ('abs', 'name') pairs, the two byte address of the label.
+
+  and return the bytes, to be placed at org.
+
+  """
+  labels = {}
+  pos = org
+  for item in code:
+    if isinstance(item, str):
+      labels[item.rstrip(':')] = pos
+    else:
+      pos += 1 if isinstance(item, int) or item[0] == 'rel' else 2
+
+  out = bytearray()
+  for item in code:
+    if isinstance(item, str):
+      continue
+    if isinstance(item, int):
+      out.append(item)
+      continue
+    kind, label = item
+    target = labels[label]
+    if kind == 'rel':
+      offset = target - (org + len(out) + 1)
+      if not -128 <= offset < 128:
+        raise ValueError("Jump to %s is out of range." % label)
+      out.append(offset & 0xFF)
+    else:
+      out.extend((target & 0xFF, target >> 8))
+  return bytes(out)
+
+
+def make_rom(code, banks=4):
+  """Return an MBC1 rom of banks banks, with code assembled at ENTRY, and each bank's
+  number in its first byte.
+
+  """
+  rom = bytearray(banks * BANK_SIZE)
+  rom[ROM_TYPE_BYTE] = MBC1_RAM
+  for bank in range(1, banks):
+    rom[bank * BANK_SIZE] = bank
+  program = assemble(code)
+  rom[ENTRY:ENTRY + len(program)] = program
+  return bytes(rom)
+
+
+def alu_rom():
+  """8 and 16 bit arithmetic and logic on registers."""
+  return make_rom([
+    0x06, 0x01,        # ld b,1
+    0x0E, 0x03,        # ld c,3
+    'loop:',
+    0x80,              # add a,b
+    0x89,              # adc a,c
+    0x98,              # sbc a,b
+    0xA9,              # xor c
+    0xB0,              # or b
+    0xA1,              # and c
+    0xB9,              # cp c
+    0x04,              # inc b
+    0x0D,              # dec c
+    0x07,              # rlca
+    0x09,              # add hl,bc
+    0x27,              # daa
+    0x18, ('rel', 'loop'),
+  ])
+
+
+def _copy(src, dst):
+  """Copy 256 bytes from src to dst with the copy subroutine."""
+  return [0x21, src & 0xFF, src >> 8,   # ld hl,src
+          0x11, dst & 0xFF, dst >> 8,   # ld de,dst
+          0x06, 0x00,                   # ld b,0
+          0xCD, ('abs', 'copy')]        # call copy
+
+
+def copy_rom():
+  """Byte at a time memory copies between rom, wram, vram and cartridge ram."""
+  return make_rom([
+    0x31, 0xFE, 0xFF,  # ld sp,0xFFFE
+    0x3E, 0x0A,        # ld a,0x0A
+    0xEA, 0x00, 0x00,  # ld (0x0000),a: enable cartridge ram
+    'loop:'] +
+    _copy(ENTRY, 0xC000) +
+    _copy(0xC000, 0x8000) +
+    _copy(0x8000, 0xA000) +
+    _copy(0xA000, 0xC100) + [
+    0x18, ('rel', 'loop'),
+    'copy:',
+    0x2A,              # ld a,(hl+)
+    0x12,              # ld (de),a
+    0x13,              # inc de
+    0x05,              # dec b
+    0x20, ('rel', 'copy'),
+    0xC9,              # ret
+  ])
+
+
+def banking_rom():
+  """Rom and ram bank switching, reading each bank as it is switched in."""
+  return make_rom([
+    0x3E, 0x0A,        # ld a,0x0A
+    0xEA, 0x00, 0x00,  # ld (0x0000),a: enable cartridge ram
+    0x3E, 0x01,        # ld a,1
+    0xEA, 0x00, 0x60,  # ld (0x6000),a: ram banking mode
+    0x06, 0x01,        # ld b,1
+    'loop:',
+    0x78,              # ld a,b
+    0xEA, 0x00, 0x20,  # ld (0x2000),a: select rom bank b
+    0xE6, 0x03,        # and 3
+    0xEA, 0x00, 0x40,  # ld (0x4000),a: select ram bank b & 3
+    0xFA, 0x00, 0x40,  # ld a,(0x4000)
+    0xEA, 0x00, 0xA0,  # ld (0xA000),a
+    0x81,              # add a,c
+    0x4F,              # ld c,a
+    0x04,              # inc b
+    0x78,              # ld a,b
+    0xE6, 0x03,        # and 3
+    0x20, ('rel', 'loop'),
+    0x06, 0x01,        # ld b,1
+    0x18, ('rel', 'loop'),
+  ])
+
+
+def cb_rom():
+  """0xCB prefixed rotates, shifts and bit operations, on registers and (hl)."""
+  return make_rom([
+    0x21, 0x00, 0xC0,  # ld hl,0xC000
+    'loop:',
+    0xCB, 0x00,        # rlc b
+    0xCB, 0x19,        # rr c
+    0xCB, 0x37,        # swap a
+    0xCB, 0x5A,        # bit 3,d
+    0xCB, 0xFB,        # set 7,e
+    0xCB, 0xBB,        # res 7,e
+    0xCB, 0x22,        # sla d
+    0xCB, 0x3B,        # srl e
+    0xCB, 0x16,        # rl (hl)
+    0xCB, 0x7E,        # bit 7,(hl)
+    0x04,              # inc b
+    0x18, ('rel', 'loop'),
+  ])
+
+
+# The roms by benchmark name.
+ROMS = {
+  'alu': alu_rom,
+  'copy': copy_rom,
+  'banking': banking_rom,
+  'cb': cb_rom,
+}
@@ -0,0 +1,292 @@
+"""The benchmarks, and running and comparing them.
+
+Each benchmark is a function taking the time to spend measuring, in seconds, and returning
+a dict of rates, named '<what>_per_second'. Higher is better for all of them. Every
+benchmark sets up its own machine or mmu, warms it up, then repeats a step until the time
+is up.
+
+"""
+
+import platform
+import timeit
+
+from benchmarks.roms import ROMS
+from gb.cartridge import Cartridge
+from gb.cpu import FRAME_CYCLES
+from gb.io import IoRegisters
+from gb.lcd import Lcd
+from gb.machine import Machine
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+# Version of the results format.
+RESULTS_VERSION = 1
+
+# Instructions run with execute_instr to find a rom's average cycles per instruction.
+CALIBRATION_INSTRUCTIONS = 20000
+
+# Addresses read by the mmu benchmarks: some in every region, rom to zram.
+READ_ADDRESSES = [base + offset
+                  for base in (0x0000, 0x4000, 0x8000, 0xA000, 0xC000, 0xE000)
+                  for offset in range(0, 0x100, 0x11)]
+READ_ADDRESSES += [0xFE00, 0xFE9F, 0xFF01, 0xFF44] + list(range(0xFF80, 0xFFFF, 0x11))
+# And written: everything writable through plain memory.
+WRITE_ADDRESSES = [addr for addr in READ_ADDRESSES if addr >= 0x8000]
+
+# Benchmark functions by name, in the order they were defined.
+BENCHMARKS = {}
+_ORDER = []
+
+
+def benchmark(name):
+  """Decorator registering a benchmark function as name."""
+  def register(func):
+    BENCHMARKS[name] = func
+    _ORDER.append(name)
+    return func
+  return register
+
+
+def names():
+  return list(_ORDER)
+
+
+def _timed(step, duration):
+  """Call step, which returns the amount of work it did, until duration seconds have
+  passed. Returns (total work, seconds taken).
+
+  """
+  timer = timeit.default_timer
+  work = 0
+  start = timer()
+  elapsed = 0
+  while elapsed < duration:
+    work += step()
+    elapsed = timer() - start
+  return work, elapsed
+
+
+def _machine(rom_name, io=None):
+  """Return a machine running the benchmark rom rom_name, warmed up."""
+  machine = Machine(Cartridge(ROMS[rom_name]()), io=io)
+  machine.run(FRAME_CYCLES)
+  return machine
+
+
+def _cycles_per_instruction(rom_name):
+  machine = _machine(rom_name)
+  cpu = machine.cpu
+  start = cpu.cycles
+  for _ in range(CALIBRATION_INSTRUCTIONS):
+    cpu.execute_instr()
+  return float(cpu.cycles - start) / CALIBRATION_INSTRUCTIONS
+
+
+def _run_benchmark(rom_name):
+  """Benchmark Cpu.run, which executes translated code, on a rom. Its instruction rate is
+  worked out from the average cycles per instruction, since run doesn't count them.
+
+  """
+  def run(duration):
+    machine = _machine(rom_name)
+    cycles, seconds = _timed(lambda: machine.run(FRAME_CYCLES)[0], duration)
+    cycles_per_second = cycles / seconds
+    return {
+      'cycles_per_second': cycles_per_second,
+      'instructions_per_second': cycles_per_second / _cycles_per_instruction(rom_name),
+    }
+  return run
+
+
+def _interpret_benchmark(rom_name):
+  """Benchmark the interpreter, Cpu.execute_instr, on a rom."""
+  def interpret(duration):
+    cpu = _machine(rom_name).cpu
+    execute_instr = cpu.execute_instr
+    start = cpu.cycles
+
+    def step():
+      for _ in range(1000):
+        execute_instr()
+      return 1000
+    instructions, seconds = _timed(step, duration)
+    return {
+      'cycles_per_second': (cpu.cycles - start) / seconds,
+      'instructions_per_second': instructions / seconds,
+    }
+  return interpret
+
+
+for _rom_name in sorted(ROMS):
+  benchmark('cpu.%s.run' % _rom_name)(_run_benchmark(_rom_name))
+  benchmark('cpu.%s.interpret' % _rom_name)(_interpret_benchmark(_rom_name))
+
+
+def _lcd_benchmark(render_every):
+  """Benchmark running the alu rom with lcd timing, drawing every render_every frames, or
+  headless if 0.
+
+  """
+  def run(duration):
+    machine = _machine('alu', IoRegisters(Lcd(render_every)))
+    frames, seconds = _timed(lambda: machine.run(FRAME_CYCLES)[0], duration)
+    return {'frames_per_second': float(frames) / FRAME_CYCLES / seconds}
+  return run
+
+
+benchmark('lcd.headless')(_lcd_benchmark(0))
+if numpy is not None:
+  benchmark('lcd.render')(_lcd_benchmark(1))
+
+
+def _fork_benchmark(io=None):
+  """Benchmark Machine.fork, which shares memory copy-on-write rather than copying it."""
+  def fork(duration):
+    machine = _machine('banking', io() if io is not None else None)
+
+    def step():
+      for _ in range(100):
+        machine.fork()
+      return 100
+    forks, seconds = _timed(step, duration)
+    return {'forks_per_second': forks / seconds}
+  return fork
+
+
+benchmark('machine.fork')(_fork_benchmark())
+benchmark('machine.fork.lcd')(_fork_benchmark(lambda: IoRegisters(Lcd())))
+
+
+def _mmu():
+  mmu = _machine('banking').mmu
+  # Enable cartridge ram, so that it is read too.
+  mmu[0x0000] = 0x0A
+  return mmu
+
+
+@benchmark('mmu.read')
+def mmu_read(duration):
+  mmu = _mmu()
+  addresses = READ_ADDRESSES
+
+  def step():
+    for addr in addresses:
+      mmu[addr]
+    return len(addresses)
+  reads, seconds = _timed(step, duration)
+  return {'reads_per_second': reads / seconds}
+
+
+@benchmark('mmu.write')
+def mmu_write(duration):
+  mmu = _mmu()
+  addresses = WRITE_ADDRESSES
+
+  def step():
+    for addr in addresses:
+      mmu[addr] = 0x55
+    return len(addresses)
+  writes, seconds = _timed(step, duration)
+  return {'writes_per_second': writes / seconds}
+
+
+@benchmark('mmu.addr_trans')
+def mmu_addr_trans(duration):
+  mmu = _mmu()
+  addresses = READ_ADDRESSES
+
+  def step():
+    for addr in addresses:
+      mmu.addr_trans(addr)
+    return len(addresses)
+  translations, seconds = _timed(step, duration)
+  return {'translations_per_second': translations / seconds}
+
+
+@benchmark('mmu.read_block')
+def mmu_read_block(duration):
+  mmu = _mmu()
+
+  def step():
+    # Across the rom banks, and from vram through cartridge ram into wram.
+    return len(mmu.read_block(0x3F00, 0x200)) + len(mmu.read_block(0x9F00, 0x2200))
+  size, seconds = _timed(step, duration)
+  return {'bytes_per_second': size / seconds}
+
+
+@benchmark('cartridge.read')
+def cartridge_read(duration):
+  cartridge = _mmu().cartridge
+  # Cartridge addresses of the rom banks and ram, see Mmu.addr_trans.
+  addresses = [addr for addr in READ_ADDRESSES if addr < 0x8000]
+  addresses += [addr - 0xA000 + 0x8000
+                for addr in READ_ADDRESSES if 0xA000 <= addr < 0xC000]
+
+  def step():
+    for addr in addresses:
+      cartridge[addr]
+    return len(addresses)
+  reads, seconds = _timed(step, duration)
+  return {'reads_per_second': reads / seconds}
+
+
+@benchmark('cartridge.bank_switch')
+def cartridge_bank_switch(duration):
+  mmu = _mmu()
+
+  def step():
+    # Through the mmu, so that remapping the banks is included.
+    for bank in range(1, 33):
+      mmu[0x2000] = bank
+      mmu[0x4000] = bank & 3
+    return 64
+  switches, seconds = _timed(step, duration)
+  return {'switches_per_second': switches / seconds}
+
+
+def run_suite(selected=None, duration=1.0, repeat=3, progress=None):
+  """Run the benchmarks named in selected (by default, all of them) repeat times each for
+  duration seconds, and return the results: the best of each rate, and a description of
+  the platform. progress is called with the name of each benchmark before it runs.
+
+  """
+  results = {}
+  for name in selected if selected is not None else names():
+    if progress is not None:
+      progress(name)
+    best = {}
+    for _ in range(repeat):
+      for metric, value in BENCHMARKS[name](duration).items():
+        best[metric] = max(best.get(metric, 0), value)
+    results[name] = best
+  return {
+    'version': RESULTS_VERSION,
+    'python': '%s %s' % (platform.python_implementation(), platform.python_version()),
+    'machine': platform.machine(),
+    'duration': duration,
+    'repeat': repeat,
+    'benchmarks': results,
+  }
+
+
+def compare(baseline, results, threshold=0.1):
+  """Compare results against baseline, both as returned by run_suite. Returns a list of
+  (benchmark, metric, baseline rate, rate, ratio, regressed) for the metrics in both, where
+  regressed is whether the rate dropped by more than the fraction threshold.
+
+  """
+  if baseline.get('version') != RESULTS_VERSION:
+    raise ValueError("Unsupported baseline version %r." % baseline.get('version'))
+  rows = []
+  for name, metrics in sorted(results['benchmarks'].items()):
+    old_metrics = baseline['benchmarks'].get(name, {})
+    for metric, value in sorted(metrics.items()):
+      old = old_metrics.get(metric)
+      if not old:
+        continue
+      ratio = value / old
+      rows.append((name, metric, old, value, ratio, ratio < 1 - threshold))
+  return rows
@@ -0,0 +1,110 @@
+"""Lookup tables for the 8 bit alu operations.
+
+Working out the half carry, carry and zero flags takes several python operations per
+instruction, and the alu runs on a large fraction of instructions, so the results of
+every operation are computed once, here, at import. Each table entry packs the result and
+the flags as result << 8 | flags, so one index gives both:
+
+  ALU_ADC    add and adc, indexed by carry << 16 | a << 8 | operand
+  ALU_SBC    sub, sbc and cp, indexed the same way
+  ALU_INC    inc, indexed by the operand. The flags don't include C, which is unchanged.
+  ALU_DEC    dec, likewise
+  ALU_DAA    daa, indexed by (f & 0x70) << 4 | a
+  ALU_SHIFT  the 0xCB rotates, shifts and swap, indexed by
+             kind << 9 | carry << 8 | operand, with kind as in gb.opcodes.EXT_KINDS
+
+where carry is the C flag as 0 or 1. The tables are plain lists shared by every cpu, and
+the packed values are interned, so the large tables only cost their list of pointers.
+
+"""
+
+FLAG_Z = 0x80
+FLAG_N = 0x40
+FLAG_H = 0x20
+FLAG_C = 0x10
+
+
+def _interned(entries):
+  """Build a list of the packed (result, flags) pairs in entries, sharing equal values."""
+  values = {}
+  return [values.setdefault(r << 8 | f, r << 8 | f) for r, f in entries]
+
+
+def _adc(a, v, c):
+  r = a + v + c
+  return r & 0xFF, ((0 if r & 0xFF else FLAG_Z) |
+                    (FLAG_H if (a & 0xF) + (v & 0xF) + c > 0xF else 0) |
+                    (FLAG_C if r > 0xFF else 0))
+
+
+def _sbc(a, v, c):
+  r = a - v - c
+  return r & 0xFF, (FLAG_N | (0 if r & 0xFF else FLAG_Z) |
+                    (FLAG_H if (a & 0xF) - (v & 0xF) - c < 0 else 0) |
+                    (FLAG_C if r < 0 else 0))
+
+
+def _inc(v):
+  r = (v + 1) & 0xFF
+  return r, (0 if r else FLAG_Z) | (0 if r & 0xF else FLAG_H)
+
+
+def _dec(v):
+  r = (v - 1) & 0xFF
+  return r, FLAG_N | (0 if r else FLAG_Z) | (FLAG_H if r & 0xF == 0xF else 0)
+
+
+def _daa(a, f):
+  if not f & FLAG_N:
+    if f & FLAG_C or a > 0x99:
+      a += 0x60
+      f |= FLAG_C
+    if f & FLAG_H or (a & 0xF) > 0x9:
+      a += 0x06
+  else:
+    if f & FLAG_C:
+      a -= 0x60
+    if f & FLAG_H:
+      a -= 0x06
+  a &= 0xFF
+  return a, (f & (FLAG_N | FLAG_C)) | (0 if a else FLAG_Z)
+
+
+# Result and carry out of each 0xCB rotate/shift, in gb.opcodes.EXT_KINDS order.
+_SHIFTS = [
+  lambda v, c: ((v << 1) | (v >> 7), v & 0x80),    # rlc
+  lambda v, c: ((v >> 1) | ((v & 0x1) << 7), v & 0x1),   # rrc
+  lambda v, c: ((v << 1) | c, v & 0x80),    # rl
+  lambda v, c: ((v >> 1) | (c << 7), v & 0x1),    # rr
+  lambda v, c: (v << 1, v & 0x80),    # sla
+  lambda v, c: ((v >> 1) | (v & 0x80), v & 0x1),    # sra
+  lambda v, c: ((v >> 4) | (v << 4), 0),    # swap
+  lambda v, c: (v >> 1, v & 0x1),    # srl
+]
+
+
+def _shift(kind, v, c):
+  r, carry = _SHIFTS[kind](v, c)
+  r &= 0xFF
+  return r, (0 if r else FLAG_Z) | (FLAG_C if carry else 0)
+
+
+ALU_ADC = _interned(
+  _adc((i >> 8) & 0xFF, i & 0xFF, i >> 16) for i in range(0x20000))
+ALU_SBC = _interned(
+  _sbc((i >> 8) & 0xFF, i & 0xFF, i >> 16) for i in range(0x20000))
+ALU_INC = _interned(_inc(v) for v in range(0x100))
+ALU_DEC = _interned(_dec(v) for v in range(0x100))
+ALU_DAA = _interned(_daa(i & 0xFF, (i >> 4) & 0x70) for i in range(0x800))
+ALU_SHIFT = _interned(
+  _shift(i >> 9, i & 0xFF, (i >> 8) & 0x1) for i in range(0x1000))
+
+# The tables, by name, for the namespaces of generated code.
+ALU_TABLES = {
+  'ALU_ADC': ALU_ADC,
+  'ALU_SBC': ALU_SBC,
+  'ALU_INC': ALU_INC,
+  'ALU_DEC': ALU_DEC,
+  'ALU_DAA': ALU_DAA,
+  'ALU_SHIFT': ALU_SHIFT,
+}
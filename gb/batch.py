@@ -0,0 +1,318 @@
+"""Headless batch runner, for running many roms, or one rom under many inputs, across a
+process pool.
+
+A job names a rom and optionally a save state to start from, a budget of cycles or frames,
+an input script, and what to capture at the end: the bytes sent over the serial port and
+any ranges of memory. Jobs are written as JSON objects, e.g.
+
+  {"name": "start", "rom": "game.gb", "frames": 600,
+   "inputs": [[60, ["start"]], [62, []]],
+   "serial": true, "memory": [["0xC000", 16]]}
+
+where each input is a frame number, counted from the start of the job, and the buttons
+held from then on (see gb.io.BUTTONS). A job can also stop early, at the first hit on any
+of its breakpoints or watchpoints (see gb.debug), e.g.
+
+  {"rom": "test.gb", "frames": 6000, "serial": true,
+   "breakpoints": ["0xC18B"], "watches": [["0xA000", 4, "w"]]}
+
+where each watch is an address, a length and "r", "w" or "rw". And a job can write an
+instruction trace of its run (see gb.trace), with "trace": "path/to/trace.bin".
+
+Machines run with lcd timing (see gb.lcd), but headless: no frames are drawn unless a job
+asks for screenshots, which are written as PNG files (and need NumPy), e.g.
+
+  {"rom": "game.gb", "frames": 600, "screenshot": "end.png",
+   "screenshots": ["shots/%04d.png", 60]}
+
+takes a screenshot at the end of the job, whether it ran to the end or stopped at a hit,
+and draws every 60th frame into a file numbered by the frame, counted from the start of
+the job.
+
+Results come back as they finish, one JSON object per job, with the index and name of the
+job, the cycles and lcd frames it ran for and how fast, why it stopped (see the gb.cpu
+REASON_* constants), any breakpoint or watchpoint hit, and what it captured, or the error it
+failed with.
+
+Each worker process builds a machine per rom and save state the first time it sees them,
+and runs every job on a fork of it (see Machine.fork), so jobs start almost instantly and
+share the translated code for the rom. Roms are mapped from their files (see
+RomImage.from_file), so the workers all share one copy of each in memory.
+
+Run it as:
+
+  python -m gb.batch jobs.jsonl > results.jsonl
+
+"""
+
+import argparse
+import json
+import multiprocessing
+import sys
+import timeit
+
+from gb.cpu import FRAME_CYCLES, REASON_CYCLES, REASON_STOP
+from gb.debug import Debugger
+from gb.io import IoRegisters, parse_buttons
+from gb.lcd import Lcd
+from gb.machine import Machine
+from gb.trace import Tracer
+
+
+class Job(object):
+  """One run of a rom. Exactly one of cycles and frames gives how long to run for.
+
+  Args:
+    rom: path of the rom file.
+    state: path of a save state file (see Machine.save_state) to start from, or None to
+      start from the post-bios state.
+    cycles, frames: how long to run for.
+    inputs: (frame, buttons) pairs, with buttons a mask or a list of button names, held
+      from that frame on.
+    serial: capture the bytes sent over the serial port.
+    memory: (address, length) ranges of memory to capture.
+    breakpoints: addresses to stop at.
+    watches: (address, length, access) ranges of memory to stop at accesses to, with
+      access 'r', 'w' or 'rw'.
+    trace: path of a file to write an instruction trace to, see gb.trace.
+    screenshot: path of a PNG file to write the screen to at the end.
+    screenshots: (path, every) to draw every every-th frame, counting from the one under
+      way when the job starts as 0 (which isn't drawn), into a PNG file at path % frame
+      number.
+    name: anything to identify the job by in its result.
+
+  """
+
+  FIELDS = ('name', 'rom', 'state', 'cycles', 'frames', 'inputs', 'serial', 'memory',
+            'breakpoints', 'watches', 'trace', 'screenshot', 'screenshots')
+
+  def __init__(self, rom, state=None, cycles=None, frames=None, inputs=(), serial=False,
+               memory=(), breakpoints=(), watches=(), trace=None, screenshot=None,
+               screenshots=None, name=None):
+    if (cycles is None) == (frames is None):
+      raise ValueError("A job needs exactly one of cycles and frames.")
+    length = cycles if cycles is not None else frames
+    if not isinstance(length, int) or length < 0:
+      raise ValueError("Cycles and frames must be whole numbers, not %r." % (length,))
+    self.rom = rom
+    self.state = state
+    self.cycles = cycles if cycles is not None else frames * FRAME_CYCLES
+    self.inputs = sorted((int(frame), parse_buttons(buttons)) for frame, buttons in inputs)
+    self.serial = bool(serial)
+    self.memory = [(_address(addr), int(length)) for addr, length in memory]
+    self.breakpoints = [_address(addr) for addr in breakpoints]
+    self.watches = []
+    for addr, length, access in watches:
+      if not access or set(access) - set('rw'):
+        raise ValueError("Watch access must be 'r', 'w' or 'rw', not %r." % access)
+      self.watches.append((_address(addr), int(length), access))
+    if trace is not None and (self.breakpoints or self.watches):
+      raise ValueError("A job can't both trace and stop at breakpoints or watchpoints.")
+    self.trace = trace
+    self.screenshot = screenshot
+    if screenshots is not None:
+      path, every = screenshots
+      if int(every) < 1:
+        raise ValueError("Screenshots need to be every 1 or more frames, not %r." % every)
+      screenshots = path, int(every)
+    self.screenshots = screenshots
+    self.name = name
+
+  @classmethod
+  def from_dict(cls, spec):
+    """Make a job from its JSON form, an object with the fields of FIELDS."""
+    if not isinstance(spec, dict):
+      raise ValueError("A job must be a JSON object, not %r." % (spec,))
+    unknown = set(spec) - set(cls.FIELDS)
+    if unknown:
+      raise ValueError("Unknown job fields: %s." % ', '.join(sorted(unknown)))
+    if 'rom' not in spec:
+      raise ValueError("A job needs a rom.")
+    return cls(**dict((str(key), value) for key, value in spec.items()))
+
+
+def _address(value):
+  """Parse an address given either as an int or as a string such as "0xC000"."""
+  if isinstance(value, int):
+    return value
+  return int(value, 0)
+
+
+# Machines jobs are forked from, by (rom, state), in each worker process.
+_bases = {}
+
+
+def _base(job):
+  key = (job.rom, job.state)
+  machine = _bases.get(key)
+  if machine is None:
+    machine = Machine.from_rom_file(job.rom, io=IoRegisters(Lcd()))
+    if job.state is not None:
+      with open(job.state, 'rb') as f:
+        machine.load_state(f.read())
+    _bases[key] = machine
+  return machine
+
+
+def run_job(job):
+  """Run job in this process, and return its result (without the index of the job)."""
+  result = {'name': job.name, 'rom': job.rom}
+  try:
+    machine = _base(job).fork()
+    cpu = machine.cpu
+    io = machine.io
+    lcd = io.lcd
+    # Count frames from the start of the job.
+    lcd.frames = 0
+    scheduler = cpu.scheduler
+    start = cpu.cycles
+    end = start + job.cycles
+
+    def set_buttons(buttons):
+      return lambda deadline: setattr(io, 'buttons', buttons)
+    for frame, buttons in job.inputs:
+      scheduler.schedule(start + frame * FRAME_CYCLES, set_buttons(buttons))
+
+    debugger = None
+    if job.breakpoints or job.watches:
+      debugger = Debugger(cpu)
+      for addr in job.breakpoints:
+        debugger.add_breakpoint(addr)
+      for addr, length, access in job.watches:
+        debugger.watch(addr, length, reads='r' in access, writes='w' in access)
+
+    if job.screenshots is not None:
+      path, every = job.screenshots
+      lcd.render_every = every
+      lcd.on_frame = lambda frame: _save_screen(path % (lcd.frames - 1), frame)
+
+    trace_file = tracer = None
+    if job.trace is not None:
+      trace_file = open(job.trace, 'wb')
+      tracer = Tracer(cpu, trace_file)
+      tracer.start()
+
+    started = timeit.default_timer()
+    reason = REASON_CYCLES
+    try:
+      while cpu.cycles < end:
+        _, reason = cpu.run(end - cpu.cycles)
+        if reason == REASON_STOP and scheduler.next_deadline < end:
+          # Stopped until a button is pressed, so skip ahead to the next input.
+          cpu.cycles = scheduler.next_deadline
+        elif reason != REASON_CYCLES:
+          break
+    finally:
+      # Keep the trace up to the end, even if the run failed.
+      if tracer is not None:
+        tracer.stop()
+        trace_file.close()
+    seconds = timeit.default_timer() - started
+
+    cycles = cpu.cycles - start
+    result.update(cycles=cycles, frames=lcd.frames, seconds=seconds, reason=reason,
+                  cycles_per_second=cycles / seconds if seconds else None)
+    if debugger is not None and debugger.hits:
+      result['hit'] = debugger.hits[0]._asdict()
+    if job.serial:
+      result['serial'] = io.serial_output.decode('latin-1')
+    if job.memory:
+      result['memory'] = dict(
+        ('0x%04X' % addr, bytes(machine.mmu.read_block(addr, length)).hex())
+        for addr, length in job.memory)
+    if job.screenshot is not None:
+      _save_screen(job.screenshot, lcd.screenshot())
+  except Exception as e:
+    result['error'] = '%s: %s' % (type(e).__name__, e)
+  return result
+
+
+def _save_screen(path, frame):
+  from gb.ppu import write_png
+  with open(path, 'wb') as f:
+    write_png(frame, f)
+
+
+def _run_indexed(indexed_job):
+  index, job = indexed_job
+  result = run_job(job)
+  result['job'] = index
+  return result
+
+
+def run_batch(jobs, processes=None):
+  """Run jobs across processes worker processes (by default, one per core), yielding
+  their results in the order they finish. Each result has the index of its job in jobs
+  under 'job'. With processes=1 the jobs run one after another in this process.
+
+  """
+  indexed = enumerate(jobs)
+  if processes == 1:
+    for indexed_job in indexed:
+      yield _run_indexed(indexed_job)
+    return
+
+  pool = multiprocessing.Pool(processes)
+  try:
+    # Jobs vary a lot in length, so hand them out one at a time to keep every core busy.
+    for result in pool.imap_unordered(_run_indexed, indexed, chunksize=1):
+      yield result
+    pool.close()
+  finally:
+    pool.terminate()
+    pool.join()
+
+
+def read_jobs(lines):
+  """Parse jobs from lines of JSON, skipping blank lines."""
+  jobs = []
+  for number, line in enumerate(lines, 1):
+    if not line.strip():
+      continue
+    try:
+      jobs.append(Job.from_dict(json.loads(line)))
+    except (TypeError, ValueError) as e:
+      # TypeError too, for fields of the wrong type, e.g. a number for a list.
+      raise ValueError("Job on line %d: %s" % (number, e))
+  return jobs
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(
+    prog='python -m gb.batch',
+    description="Run jobs across a process pool, writing their results as JSON lines.")
+  parser.add_argument('jobs', nargs='?', default='-',
+                      help="file of jobs as JSON lines, or - for stdin (the default)")
+  parser.add_argument('-j', '--processes', type=int, default=None,
+                      help="number of worker processes (default: one per core)")
+  parser.add_argument('-o', '--output', default='-',
+                      help="file to write results to, or - for stdout (the default)")
+  args = parser.parse_args(argv)
+
+  if args.jobs == '-':
+    jobs = read_jobs(sys.stdin)
+  else:
+    with open(args.jobs) as f:
+      jobs = read_jobs(f)
+
+  output = sys.stdout if args.output == '-' else open(args.output, 'w')
+  failed = 0
+  cycles = 0
+  started = timeit.default_timer()
+  try:
+    for result in run_batch(jobs, args.processes):
+      failed += 'error' in result
+      cycles += result.get('cycles', 0)
+      output.write(json.dumps(result, sort_keys=True) + '\n')
+      output.flush()
+  finally:
+    if output is not sys.stdout:
+      output.close()
+  seconds = timeit.default_timer() - started
+  sys.stderr.write("%d jobs, %d failed, %.0f emulated cycles per second in total\n" %
+                   (len(jobs), failed, cycles / seconds if seconds else 0))
+  return 1 if failed else 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
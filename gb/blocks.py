@@ -0,0 +1,506 @@
+"""Translation of guest code into python functions, one per basic block.
+
+Interpreting pays for a fetch through the page tables, a dispatch and a call on every
+instruction. A BlockCache instead translates the straight-line code starting at a pc, up to
+and including the first instruction that changes the pc, into a single python function. It
+is built from the same source as the opcode handlers (see gb.opcodes), with the immediate
+operands and the pc folded in as constants.
+
+A block is called with the cpu and returns the clock cycles it took, just like an opcode
+handler, and leaves cpu.pc at the next instruction to run. If an instruction raises, the
+block leaves cpu.pc and cpu.cycles where the interpreter would (see block_fault). Blocks
+keep the guarantees the run loop makes about _yield_at, so events, interrupts and cycle
+budgets land on the same instructions as when interpreting:
+
+  - a block only runs the instructions which would start before _yield_at: if some of
+    them wouldn't, it checks _yield_at before each one (except the first, which always
+    runs).
+  - after every instruction that writes memory, a block stops early if the write brought
+    _yield_at forward (e.g. a device scheduled an event, or IF was written).
+
+Idle loops, such as polling a register until it changes, are skipped through. A block
+which branches back to its own start without writing memory, and whose registers come out
+of an iteration the same as they went in, would keep doing exactly the same thing until
+something it reads changes. That can only happen at a scheduled event (or an interrupt,
+which needs one), so the block counts all the iterations that fit before _yield_at in one
+go (see skip_idle), unless any reads are watched. This relies on devices only changing
+what the cpu reads from events.
+
+Blocks are kept per page of the memory they were read from (a page of a rom bank, of wram,
+...) rather than per address, so a bank switch brings the blocks of the newly mapped bank
+into view instead of throwing anything away. Blocks translated from writable memory are
+dropped by a write trap on their page (see Mmu.trap_writes) the first time it is written,
+and the trap also makes the running block stop after the write. Pages which aren't backed
+by a buffer, or are locked (see Mmu.lock), are always interpreted. Blocks translated from
+read-only memory are shared by every cache mapping that memory, so the forks of a machine
+(see Machine.fork) start out with the blocks of their rom already translated.
+
+Breakpoints (see BlockCache.add_breakpoint) swap the blocks of just their page for a
+_BreakpointBlocks, which runs a breakpoint block at each breakpoint and translates blocks
+of its own that end before them. Nothing else pays for breakpoints.
+
+"""
+
+import re
+import sys
+import weakref
+
+from gb.mmu import NUM_PAGES, PAGE_MASK, PAGE_SHIFT, PAGE_SIZE
+from gb.opcodes import *
+
+# Longest block translated, in instructions.
+MAX_BLOCK_INSTRUCTIONS = 64
+# Memory whose blocks have been dropped this many times is left to the interpreter: it
+# probably mixes code with data that is written all the time.
+MAX_INVALIDATIONS = 16
+# Translated functions are shared by every cache, keyed by their source. The table is
+# cleared when it reaches this size.
+MAX_SHARED_BLOCKS = 1 << 16
+
+_SIGNED_IMMEDIATE = "(n - 0x100 if n & 0x80 else n)"
+_IMMEDIATE_8 = re.compile(r'\bn\b')
+_IMMEDIATE_16 = re.compile(r'\bnn\b')
+# Reads of cpu.pc, as opposed to assignments to it.
+_READ_PC = re.compile(r'cpu\.pc(?! =)')
+_SETS_PC = re.compile(r'cpu\.pc =')
+_WRITES_MEMORY = re.compile(r'^\s*mmu\[.*\] =')
+_RETURN = re.compile(r'\breturn (\d+)')
+# Comment marking the lines of each instruction with the address of the next one and the
+# cycles taken before it, see block_fault.
+_LOCATION = re.compile(r'  # next 0x([0-9A-F]{4}) after (\d+)$')
+# Jumps to a constant address: jr n, jr cc,n, jp nn and jp cc,nn.
+_RELATIVE_JUMPS = frozenset([0x18, 0x20, 0x28, 0x30, 0x38])
+_ABSOLUTE_JUMPS = frozenset([0xC3, 0xC2, 0xCA, 0xD2, 0xDA])
+
+_compiled = {}
+# Regions of read-only memory, shared by every cache, keyed like BlockCache._regions. The
+# caches using a region keep it alive.
+_shared_regions = weakref.WeakValueDictionary()
+
+
+def interpret(cpu):
+  """Execute the instruction at cpu.pc through the dispatch table, returning its cycles.
+  Stands in for a block wherever code isn't translated.
+
+  """
+  pc = cpu.pc
+  cpu.pc = (pc + 1) & 0xFFFF
+  return cpu.ops[cpu.mmu[pc]](cpu)
+
+
+def skip_idle(cpu, start, cycles):
+  """Called by an idle loop block started at cycle start, whose iterations take cycles
+  and have no effect. Returns the cycles taken by every iteration that can run before
+  _yield_at, at least the one that already ran. Nothing is skipped while reads are
+  watched (see Mmu.watch), so that watches see every poll.
+
+  """
+  if cpu.mmu.reads_watched:
+    return cycles
+  return max(1, (cpu._yield_at - start) // cycles) * cycles
+
+
+def block_fault(cpu, locations):
+  """Called by a block when an instruction in it raises, with locations mapping the line
+  numbers of each instruction's lines to (address of the next instruction, cycles taken
+  before it). Leaves cpu.pc and cpu.cycles as the interpreter would when the instruction
+  raises, past the instruction but without its cycles, so errors are reported at the
+  same place whichever way the code runs.
+
+  """
+  location = locations.get(sys.exc_info()[2].tb_lineno)
+  if location is not None:
+    cpu.pc, cycles = location
+    cpu.cycles += cycles
+
+
+def branch_target(code, pc):
+  """Return the address the instruction at pc jumps to, if it is a jump to a constant
+  address, else None. code holds the bytes of pc's page.
+
+  """
+  offset = pc & PAGE_MASK
+  op = code[offset]
+  if op in _RELATIVE_JUMPS:
+    n = code[offset + 1]
+    return (pc + 2 + (n - 0x100 if n & 0x80 else n)) & 0xFFFF
+  if op in _ABSOLUTE_JUMPS:
+    return code[offset + 1] | code[offset + 2] << 8
+  return None
+
+
+def instruction_source(code, pc):
+  """Decode the instruction at pc, where code holds the bytes of pc's page. Returns
+  (length, cycles, lines), with the operands and the address of the next instruction
+  folded into lines, or None if the instruction can't be translated: it is illegal, or
+  runs off the end of the page. For conditional branches, cycles is the time taken when
+  the branch isn't taken.
+
+  """
+  offset = pc & PAGE_MASK
+  op = code[offset]
+  if op in ILLEGAL:
+    return None
+  length, _, lines = decode(op)
+  if offset + length > PAGE_SIZE:
+    return None
+
+  cycles = CYCLES[op]
+  if op == 0xCB:
+    ext = code[offset + 1]
+    _, lines = decode_ext(ext)
+    cycles = EXT_CYCLES[ext]
+  elif length == 2:
+    n = code[offset + 1]
+    signed = "(%d)" % (n - 0x100 if n & 0x80 else n)
+    lines = [
+      _IMMEDIATE_8.sub("0x%02X" % n, line.replace(_SIGNED_IMMEDIATE, signed))
+      for line in lines]
+  elif length == 3:
+    nn = code[offset + 1] | code[offset + 2] << 8
+    lines = [_IMMEDIATE_16.sub("0x%04X" % nn, line) for line in lines]
+
+  next_pc = "0x%04X" % ((pc + length) & 0xFFFF)
+  return length, cycles, [_READ_PC.sub(next_pc, line) for line in lines]
+
+
+def block_source(name, code, pc, stops=()):
+  """Source for a function name(cpu) running the block at pc, where code holds the bytes
+  of pc's page. The block ends before any address in stops other than pc. Returns None if
+  the first instruction can't be translated.
+
+  """
+  body = []
+  # The body again, checking _yield_at before every instruction after the first, for
+  # when the whole block doesn't fit before it.
+  checked = []
+  cycles = 0
+  # Cycles taken before the last instruction in the block starts.
+  before_last = 0
+  # (pc, cycles) after the last instruction, if it wrote memory.
+  wrote = None
+  checks_yield = False
+  # Whether the block could be an idle loop: it doesn't write memory or touch sp.
+  idle = True
+  addr = pc
+
+  for _ in range(MAX_BLOCK_INSTRUCTIONS):
+    if addr >> PAGE_SHIFT != pc >> PAGE_SHIFT or (addr != pc and addr in stops):
+      break
+    decoded = instruction_source(code, addr)
+    if decoded is None:
+      break
+    length, instr_cycles, lines = decoded
+
+    if wrote is not None:
+      body += [
+        "if cpu._yield_at <= now + %d:" % wrote[1],
+        "  cpu.pc = 0x%04X" % wrote[0],
+        "  return %d" % wrote[1]]
+      wrote = None
+      checks_yield = True
+    if cycles:
+      checked += [
+        "if cpu._yield_at <= now + %d:" % cycles,
+        "  cpu.pc = 0x%04X" % addr,
+        "  return %d" % cycles]
+
+    # Conditional branches return their taken cycles, which have to include the rest of
+    # the block.
+    last = len(body)
+    last_checked = len(checked)
+    lines = [_RETURN.sub(lambda m: "return %d" % (cycles + int(m.group(1))), line) +
+             "  # next 0x%04X after %d" % ((addr + length) & 0xFFFF, cycles)
+             for line in lines]
+    body += lines
+    checked += lines
+    before_last = cycles
+    cycles += instr_cycles
+    instr_pc = addr
+    addr = (addr + length) & 0xFFFF
+    writes = any(_WRITES_MEMORY.match(line) for line in lines)
+    if writes or any("cpu.sp =" in line for line in lines):
+      idle = False
+
+    if any(_SETS_PC.search(line) or '_yield_at' in line for line in lines):
+      # End of the block. Conditional branches fall through to the next instruction.
+      conditional = not any(line.startswith("cpu.pc =") for line in lines)
+      end = (["cpu.pc = 0x%04X" % addr] if conditional else []) + ["return %d" % cycles]
+      body += end
+      checked += end
+      if idle and branch_target(code, instr_pc) == pc:
+        # Looping back to the start: skip the rest of the iterations if this one left the
+        # registers as they were.
+        checks_yield = True
+        body = _skip_idle_source(body, last, conditional)
+        checked = _skip_idle_source(checked, last_checked, conditional)
+      break
+    if writes:
+      wrote = addr, cycles
+
+  if not body:
+    return None
+  if not body[-1].startswith("return"):
+    end = ["cpu.pc = 0x%04X" % addr, "return %d" % cycles]
+    body += end
+    checked += end
+
+  prologue = []
+  if before_last or checks_yield:
+    prologue.append("now = cpu.cycles")
+  if before_last:
+    # Not every instruction starts before _yield_at, so run the ones that do.
+    prologue += ["if now + %d >= cpu._yield_at:" % before_last]
+    prologue += ["  " + line for line in checked]
+  # Put right where an instruction raising leaves the cpu, see block_fault.
+  lines = (["try:"] + ["  " + line for line in prologue + body] +
+           ["except Exception:", "  block_fault(cpu, LOCATIONS)", "  raise"])
+  source = function_source(name, lines)
+  locations = {}
+  for number, line in enumerate(source.splitlines(), 1):
+    match = _LOCATION.search(line)
+    if match is not None:
+      locations[number] = int(match.group(1), 16), int(match.group(2))
+  return source.replace("LOCATIONS", repr(locations))
+
+
+def _skip_idle_source(body, last, conditional):
+  """Make the lines body of an idle loop block skip the rest of its iterations when an
+  iteration leaves the registers as they were. The last instruction, the branch back to
+  the start, starts at body[last]. If it is conditional, the last two lines return when it
+  isn't taken.
+
+  """
+  taken_end = len(body) - 2 if conditional else len(body)
+  return ["before = regs[:]"] + body[:last] + [
+    _RETURN.sub(r"return skip_idle(cpu, now, \1) if regs == before else \1", line)
+    for line in body[last:taken_end]] + body[taken_end:]
+
+
+def compile_block(name, source):
+  """Compile the source of a block function called name, sharing the result with any
+  other cache that translates the same code.
+
+  """
+  block = _compiled.get(source)
+  if block is None:
+    if len(_compiled) >= MAX_SHARED_BLOCKS:
+      _compiled.clear()
+    namespace = dict(ALU_TABLES, interpret=interpret, skip_idle=skip_idle,
+                     block_fault=block_fault)
+    exec(compile(source, "<gb.blocks>", "exec"), namespace)
+    block = _compiled[source] = namespace[name]
+  return block
+
+
+class _Blocks(dict):
+  """The blocks translated from one page, keyed by address. Looking up an address that
+  hasn't been translated yet translates it, so the run loop can just index this. Pages
+  which aren't backed by a buffer have no region, and are interpreted.
+
+  """
+  __slots__ = ('region',)
+
+  def __init__(self, region):
+    super(_Blocks, self).__init__()
+    self.region = region
+
+  def __missing__(self, pc):
+    block = self[pc] = interpret if self.region is None else self.region.translate(pc)
+    return block
+
+
+class _Unresolved(dict):
+  """Stands in for the blocks of every page that hasn't been run from since it was
+  mapped. The first lookup finds the page's blocks and puts them in its place, so mapping
+  pages (e.g. on a bank switch, or when creating a cache) doesn't cost anything per page.
+
+  """
+  __slots__ = ('cache',)
+
+  def __init__(self, cache):
+    super(_Unresolved, self).__init__()
+    self.cache = cache
+
+  def __missing__(self, pc):
+    return self.cache.page_blocks(pc >> PAGE_SHIFT)[pc]
+
+
+class _Region(object):
+  """A page's worth of memory that code has been translated from, along with the blocks
+  for each page it is mapped at.
+
+  Regions of read-only memory, such as rom banks, belong to no cache in particular: they
+  are shared by every cache that maps the same memory (e.g. the forks of a machine), so
+  code is only translated once. Regions of writable memory belong to one cache, whose mmu
+  traps writes to them.
+
+  """
+  __slots__ = ('cache', 'buffer', 'code', 'pages', 'trapped', 'invalidations',
+               '__weakref__')
+
+  def __init__(self, cache, buffer, offset):
+    self.cache = cache
+    # Holding on to the buffer keeps its id, which is part of our key, from being reused.
+    self.buffer = buffer
+    self.code = memoryview(buffer)[offset:offset + PAGE_SIZE]
+    self.pages = {}
+    self.trapped = False
+    self.invalidations = 0
+
+  def translate(self, pc, stops=()):
+    """Return the block function for the code at pc, ending before any address in
+    stops.
+
+    """
+    if self.invalidations >= MAX_INVALIDATIONS:
+      return interpret
+    name = "block_%04x" % pc
+    source = block_source(name, self.code, pc, stops)
+    if source is None:
+      return interpret
+    if self.cache is not None and not self.trapped:
+      self.cache.mmu.trap_writes(pc >> PAGE_SHIFT, self.written)
+      self.trapped = True
+    return compile_block(name, source)
+
+  def written(self, page):
+    """Write trap callback: the code may have changed, so drop its blocks."""
+    if not self.trapped:
+      return
+    self.trapped = False
+    self.invalidations += 1
+    for blocks in self.pages.values():
+      blocks.clear()
+    cache = self.cache
+    if cache._breakpoints:
+      # Drop the blocks translated around breakpoints too.
+      for page in self.pages:
+        if isinstance(cache.pages[page], _BreakpointBlocks):
+          cache.pages[page] = cache._unresolved
+    # Stop the running block after this write, in case it is one of them.
+    cache.cpu._yield_at = 0
+
+
+class _BreakpointBlocks(dict):
+  """Stands in for the blocks of a page with breakpoints on it, for one cache. Breakpoint
+  addresses get a breakpoint block, and other addresses blocks which end before the next
+  breakpoint, translated from the page's region but kept here, since the region's own
+  blocks may be shared with other caches.
+
+  """
+  __slots__ = ('cache', 'region', 'stops')
+
+  def __init__(self, cache, region, stops):
+    super(_BreakpointBlocks, self).__init__()
+    self.cache = cache
+    self.region = region
+    self.stops = stops
+
+  def __missing__(self, pc):
+    if pc in self.stops:
+      block = _breakpoint_block(self.cache._breakpoints[pc])
+    elif self.region is None:
+      block = interpret
+    else:
+      block = self.region.translate(pc, self.stops)
+    self[pc] = block
+    return block
+
+
+def _breakpoint_block(callback):
+  """Return a block for a breakpoint, which calls callback(cpu) and, unless it returns
+  true to stop there, runs the instruction through the interpreter.
+
+  """
+  def breakpoint(cpu):
+    if callback(cpu):
+      cpu.request_break()
+      return 0
+    return interpret(cpu)
+  return breakpoint
+
+
+class BlockCache(object):
+  """Translated blocks for a cpu. pages holds the blocks for each page of the address
+  space as it is currently mapped, so the block at pc is pages[pc >> 8][pc]. pages is
+  updated in place as the mmu is remapped.
+
+  """
+
+  def __init__(self, cpu):
+    self.cpu = cpu
+    self.mmu = cpu.mmu
+    self._unresolved = _Unresolved(self)
+    self.pages = [self._unresolved] * NUM_PAGES
+    # _Region for each (id(buffer), offset) code has been translated from.
+    self._regions = {}
+    # Breakpoint callbacks, by address, see add_breakpoint.
+    self._breakpoints = {}
+    self.mmu.add_remap_listener(self._remapped)
+
+  def _remapped(self, first, last):
+    """Mmu remap listener: the pages will find the blocks of whatever is now mapped when
+    they are next run from.
+
+    """
+    self.pages[first:last + 1] = [self._unresolved] * (last + 1 - first)
+    # The running block may have come from memory that is no longer mapped.
+    self.cpu._yield_at = 0
+
+  def add_breakpoint(self, pc, callback):
+    """Call callback(cpu) whenever Cpu.run is about to execute the instruction at pc, in
+    whatever is mapped there. If it returns true, the cpu stops before the instruction, and
+    run returns REASON_BREAK (see Cpu.request_break). Otherwise the instruction runs. The
+    interpreter (execute_instr, run_until) doesn't see breakpoints.
+
+    """
+    self._breakpoints[pc] = callback
+    self.pages[pc >> PAGE_SHIFT] = self._unresolved
+    # The running block may run past pc.
+    self.cpu._yield_at = 0
+
+  def remove_breakpoint(self, pc):
+    if self._breakpoints.pop(pc, None) is not None:
+      self.pages[pc >> PAGE_SHIFT] = self._unresolved
+      self.cpu._yield_at = 0
+
+  def page_blocks(self, page):
+    """Return the blocks for page as it is currently mapped."""
+    blocks = self.pages[page]
+    if blocks is not self._unresolved:
+      return blocks
+    region = None
+    source = self.mmu.page_source(page)
+    if source is None:
+      blocks = _Blocks(None)
+    else:
+      buffer, offset = source
+      key = id(buffer), offset
+      region = self._regions.get(key)
+      if region is None:
+        if isinstance(buffer, memoryview) and buffer.readonly:
+          region = _shared_regions.get(key)
+          if region is None:
+            region = _shared_regions[key] = _Region(None, buffer, offset)
+        else:
+          region = _Region(self, buffer, offset)
+        self._regions[key] = region
+      blocks = region.pages.get(page)
+      if blocks is None:
+        blocks = region.pages[page] = _Blocks(region)
+    if self._breakpoints:
+      first = page << PAGE_SHIFT
+      stops = frozenset(pc for pc in self._breakpoints if first <= pc < first + PAGE_SIZE)
+      if stops:
+        blocks = _BreakpointBlocks(self, region, stops)
+    self.pages[page] = blocks
+    return blocks
+
+  def flush(self):
+    """Drop every translated block, including those shared with other caches."""
+    for region in self._regions.values():
+      for blocks in region.pages.values():
+        blocks.clear()
+    self._regions = {}
+    self._remapped(0, NUM_PAGES - 1)
@@ -1,7 +1,7 @@
-import six
-from six.moves import xrange
+import copy
 
 from gb.mem import *
+from gb.state import StateError, StateReader, StateWriter
 
 ROM_TYPE_BYTE = 0x147
 
@@ -37,8 +37,7 @@ class CartridgeMeta(type):
     super(CartridgeMeta, cls).__init__(name, bases, dct)
 
 
-@six.add_metaclass(CartridgeMeta)
-class Cartridge(object):
+class Cartridge(object, metaclass=CartridgeMeta):
   """Base class for Cartridges. Calling the Cartridge constructor with a romstring
   automatically constructs the appropriate child class, if a child class exists which has
   the cartridge type id in its "ids" variable.
@@ -69,13 +68,12 @@ class Cartridge(object):
     """
     assert cls is Cartridge, "Only __new__ should call this!"
 
-    if not romstring:
+    if not len(romstring):
       cls = DummyCartridge
     else:
-      # 2/3: convert to bytearry to ensure uniform indexing. Could also use
-      # six.indexbytes, but that doesn't work on existing bytearrays, so we would still
-      # need a conversion, and we might as well use python builtins if we can.
-      romstring = bytearray(romstring)
+      # Wrap the romstring in a RomImage for uniform indexing. This doesn't copy it.
+      if not isinstance(romstring, RomImage):
+        romstring = RomImage(romstring)
       if len(romstring) < ROM_TYPE_BYTE:
         raise ValueError(
           "Unable to read cartridge type: cartridge type located at byte %d, but "
@@ -89,10 +87,81 @@ class Cartridge(object):
 
     return super(Cartridge, cls).__new__(cls)
 
+  _mapping_listeners = ()
+
+  def mapped_banks(self):
+    """Return the buffers currently visible in the fixed rom, switchable rom and ram
+    regions, as a (rom0, romx, ram) tuple. Any of them may be None, meaning that region
+    can only be accessed through __getitem__ and __setitem__.
+
+    """
+    return None, None, None
+
+  def add_mapping_listener(self, listener):
+    """Register listener to be called with no arguments whenever the result of
+    mapped_banks changes.
+
+    """
+    self._mapping_listeners = list(self._mapping_listeners) + [listener]
+
+  def remove_mapping_listener(self, listener):
+    self._mapping_listeners = [l for l in self._mapping_listeners if l != listener]
+
+  def _mapping_changed(self):
+    for listener in self._mapping_listeners:
+      listener()
+
+  def fork(self):
+    """Return a cartridge in the same state as this one, for a forked machine (see
+    Machine.fork), without this one's mapping listeners. This is a shallow copy, which is
+    enough for cartridges without any state; cartridges with state override it.
+
+    """
+    cartridge = copy.copy(self)
+    cartridge._mapping_listeners = ()
+    return cartridge
+
+  def save_state(self, memory=True):
+    """Return the cartridge's state (banking registers, ram) as a save state blob (see
+    gb.state). The rom is not included, nor the ram if memory is false. Cartridges
+    without any state return b''.
+
+    """
+    return b''
+
+  def memory_regions(self):
+    """Return the cartridge's ram, as a list of (name, buffer) pairs, one per bank. The
+    buffers are the cartridge's own, not shared with any fork, so they can be written to.
+
+    """
+    return []
+
+  def load_state(self, data):
+    """Restore a blob from save_state of the same kind of cartridge."""
+    if len(data):
+      raise StateError("%s has no state to load." % type(self).__name__)
+
+
+def _banking_register(name):
+  """Make a property for the banking register name. Setting it refreshes the cached bank
+  mapping.
+
+  """
+  attr = '_' + name
+
+  def fget(self):
+    return getattr(self, attr)
+
+  def fset(self, value):
+    setattr(self, attr, value)
+    self._update_mapping()
+
+  return property(fget, fset)
+
 
 class DummyCartridge(Cartridge):
 
-  def __init__(self):
+  def __init__(self, romstring=b""):
     pass
 
   def __getitem__(self, addr):
@@ -102,15 +171,31 @@ class DummyCartridge(Cartridge):
     pass
 
 
+# Shared by every cartridge for banks that aren't in the rom.
+_EMPTY_ROM = Rom()
+
+
 class Mbc1Cartridge(Cartridge):
 
   ids = [0x1, 0x2, 0x3]
 
+  # The banking registers. The currently mapped banks are cached in _romx and _ram, so
+  # these are properties that refresh the cache when set.
+  ram_enable = _banking_register('ram_enable')
+  rom_select = _banking_register('rom_select')
+  bankset_select = _banking_register('bankset_select')
+  mode_select = _banking_register('mode_select')
+  rambanks = _banking_register('rambanks')
+
   def __init__(self, romstring):
-    self.ram_enable = 0
-    self.rom_select = 1
-    self.bankset_select = 0
-    self.mode_select = 0
+    self._ram_enable = 0
+    self._rom_select = 1
+    self._bankset_select = 0
+    self._mode_select = 0
+    self._romx = None
+    self._ram = None
+    # Indices of the ram banks shared with a fork of the cartridge, see fork.
+    self._shared_ram = set()
 
     # Note(zstewar1): This is how I think this works: there are 128 rom banks. All four of
     # the banks that would be accessible with rom_select = 0, regardless of
@@ -124,15 +209,20 @@ class Mbc1Cartridge(Cartridge):
     #
     # This assumes that the romstring *does not* already contain data in the sections for
     # the repeated bank 0.
-    self.rombanks = [
-      Rom(romstring[x:x+0x4000]) for x in xrange(0, len(romstring), 0x4000)]
+    #
+    # The banks are views of the rom image, and all of the missing banks share one empty
+    # bank, so none of the rom data is copied.
+    if not isinstance(romstring, RomImage):
+      romstring = RomImage(romstring)
+    self.rombanks = [Rom(romstring.bank(i)) for i in range(romstring.num_banks)]
     if len(self.rombanks) < 125:
-      self.rombanks = self.rombanks + [Rom()] * (125 - len(self.rombanks))
+      self.rombanks = self.rombanks + [_EMPTY_ROM] * (125 - len(self.rombanks))
     # Insert the fixed bank into appropriate indices in the rombank. Note: Not sure if the
     # cartridge file already contains these repeated chunks or not.
     self.rombanks.insert(32, self.fixedbank)
     self.rombanks.insert(64, self.fixedbank)
     self.rombanks.insert(96, self.fixedbank)
+    self._rom0 = self.fixedbank.data
     self.rambanks = [bytearray(8192) for _ in range(4)]
 
   @property
@@ -162,15 +252,86 @@ class Mbc1Cartridge(Cartridge):
       return self.bankset_select
     return 0
 
+  def _update_mapping(self):
+    """Recompute the mapped rom and ram banks after a banking register changed, and notify
+    listeners if either one is different.
+
+    """
+    romx = self.rombanks[self.rom_bank].data
+    ram = self._rambanks[self.ram_bank] if self._ram_enable == 0xA else None
+    if romx is not self._romx or ram is not self._ram:
+      self._romx = romx
+      self._ram = ram
+      self._mapping_changed()
+
+  def mapped_banks(self):
+    ram = self._ram
+    if ram is not None and self.ram_bank in self._shared_ram:
+      # Writes have to come through __setitem__, to copy the bank first.
+      ram = None
+    return self._rom0, self._romx, ram
+
+  def fork(self):
+    """The rom banks are shared outright. The ram banks are shared by both cartridges until
+    either one writes to a bank, which copies it first. Shared banks aren't returned by
+    mapped_banks, so the mmu sends accesses to them through __getitem__ and __setitem__.
+
+    """
+    cartridge = super(Mbc1Cartridge, self).fork()
+    cartridge._rambanks = list(self._rambanks)
+    newly_shared = self.ram_bank not in self._shared_ram
+    self._shared_ram = set(range(len(self._rambanks)))
+    cartridge._shared_ram = set(self._shared_ram)
+    if self._ram is not None and newly_shared:
+      # The mapped bank can't be mapped any more.
+      self._mapping_changed()
+    return cartridge
+
+  def _unshare_ram(self):
+    """Copy the mapped ram bank if it is shared with a fork, before writing to it."""
+    bank = self.ram_bank
+    if bank in self._shared_ram:
+      self._shared_ram.discard(bank)
+      self._rambanks[bank] = bytearray(self._rambanks[bank])
+      self._update_mapping()
+
+  def memory_regions(self):
+    if self._shared_ram:
+      self._shared_ram = set()
+      self._rambanks = [bytearray(bank) for bank in self._rambanks]
+      self._update_mapping()
+    return [('ram%d' % i, bank) for i, bank in enumerate(self._rambanks)]
+
+  def save_state(self, memory=True):
+    state = StateWriter(b'GBM1', 1)
+    state.pack('BBBB', self._ram_enable, self._rom_select, self._bankset_select,
+               self._mode_select)
+    for bank in self._rambanks:
+      state.section(bank if memory else b'')
+    return state.value()
+
+  def load_state(self, data):
+    state = StateReader(data, b'GBM1', 1)
+    (self._ram_enable, self._rom_select, self._bankset_select,
+     self._mode_select) = state.unpack('BBBB')
+    # The banks are restored in place, since the mmu maps them directly, except for those
+    # shared with a fork, which are copied first.
+    for i, bank in enumerate(self._rambanks):
+      if i in self._shared_ram:
+        bank = self._rambanks[i] = bytearray(bank)
+      state.buffer(bank)
+    self._shared_ram = set()
+    self._update_mapping()
+
   def __getitem__(self, addr):
     if addr < 0x0 or addr > 0x9FFF:
       raise KeyError("Invalid cartridge memory address.")
     if addr < 0x4000:
-      return self.fixedbank[addr]
+      return self._rom0[addr]
     elif addr < 0x8000:
-      return self.rombanks[self.rom_bank][addr-0x4000]
-    elif self.ram_enable == 0xA:
-      return self.rambanks[self.ram_bank][addr-0x8000]
+      return self._romx[addr-0x4000]
+    elif self._ram is not None:
+      return self._ram[addr-0x8000]
     else:
       return 0
 
@@ -187,11 +348,10 @@ class Mbc1Cartridge(Cartridge):
       self.bankset_select = 0x3 & value
     elif addr < 0x8000:
       self.mode_select = 0x1 & value
-    elif self.ram_enable == 0xA:
-      self.rambanks[self.ram_bank][addr-0x8000] = value
+    elif self._ram is not None:
+      if self._shared_ram:
+        self._unshare_ram()
+      self._ram[addr-0x8000] = value
 
 def load_rom_from_file(path):
-  with open(path, "rb") as f:
-    romstring = f.read()
-
-  return Cartridge(romstring)
+  return Cartridge(RomImage.from_file(path))
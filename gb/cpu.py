@@ -1,231 +1,318 @@
-REG_A = 0b111
-REG_B = 0b000
-REG_C = 0b001
-REG_D = 0b010
-REG_E = 0b011
-REG_H = 0b100
-REG_L = 0b101
+from gb.blocks import BlockCache
+from gb.opcodes import *
+from gb.mmu import INT_JOYPAD, INT_MASK
+from gb.scheduler import NEVER
+from gb.state import StateReader, StateWriter
+
+
+# Reasons returned by Cpu.run and Cpu.run_until for stopping.
+REASON_CYCLES = 'cycles'
+REASON_HALT = 'halt'
+REASON_STOP = 'stop'
+REASON_PC = 'pc'
+REASON_PREDICATE = 'predicate'
+REASON_BREAK = 'break'
+
+# The cpu clock rate, in clock cycles per second.
+CLOCK_HZ = 4194304
+# Clock cycles per video frame, about 59.7 frames per second.
+FRAME_CYCLES = 70224
+
+# Save state header.
+STATE_MAGIC = b'GBCP'
+STATE_VERSION = 1
+
+# Clock cycles taken to dispatch an interrupt to its handler.
+INTERRUPT_CYCLES = 20
+# The handler for the interrupt in bit n of IF is at INTERRUPT_VECTOR + 8 * n.
+INTERRUPT_VECTOR = 0x40
+
+
+class CpuError(Exception):
+  """Base exception for this module."""
+  pass
+
+
+class IllegalInstructionError(CpuError):
+  """Error raised when the cpu executes one of the unused opcodes."""
+  pass
+
+
+def _reg_property(index):
+  """Make a property for the 8 bit register at index in the register file."""
+
+  def fget(self):
+    return self.regs[index]
+
+  def fset(self, value):
+    self.regs[index] = value
+
+  return property(fget, fset)
+
+
+def _pair_property(hi, lo):
+  """Make a property for the 16 bit register pair made of registers hi and lo."""
+
+  def fget(self):
+    regs = self.regs
+    return regs[hi] << 8 | regs[lo]
+
+  def fset(self, value):
+    regs = self.regs
+    regs[hi] = value >> 8
+    regs[lo] = value & 0xFF
+
+  return property(fget, fset)
+
 
 class Cpu(object):
+  __slots__ = ('mmu', 'regs', 'pc', 'sp', 'stopped', 'halted', 'interrupts_enabled',
+               'cycles', '_yield_at', '_break', 'scheduler', 'blocks', 'profiler',
+               'debugger', 'tracer')
+
+  # Dispatch tables for the base and 0xCB-prefixed opcodes, shared by every instance. Each
+  # entry is a function of the cpu, specialised for its opcode (see gb.opcodes), called
+  # with pc already past the opcode byte.
+  ops, ext_ops, mnemonics, ext_mnemonics, lengths = build_tables(
+    {'IllegalInstructionError': IllegalInstructionError})
+
+  a = _reg_property(REG_A)
+  f = _reg_property(REG_F)
+  b = _reg_property(REG_B)
+  c = _reg_property(REG_C)
+  d = _reg_property(REG_D)
+  e = _reg_property(REG_E)
+  h = _reg_property(REG_H)
+  l = _reg_property(REG_L)
+
+  af = _pair_property(*PAIR_AF)
+  bc = _pair_property(*PAIR_BC)
+  de = _pair_property(*PAIR_DE)
+  hl = _pair_property(*PAIR_HL)
+
   def __init__(self, mmu):
     self.mmu = mmu
 
     self.pc = 0
     self.sp = 0
 
-    self.gp_regs = {0b111:0, 0b000:0, 0b001:0, 0b010:0, 0b011:0, 0b100:0, 0b101:0}
-    self.f = 0
+    # The register file, indexed by the 3 bit register encodings used in opcodes, with the
+    # flags at REG_F.
+    self.regs = bytearray(8)
 
     self.stopped = False
     self.halted = False
     self.interrupts_enabled = False
 
-    ops = { 0x00: self.nop,
-            0x10: self.stop,
-            0x76: self.halt,
-            0xCB: self.ext,
-            #set up A for BCD, whatever that entails
-            0x27: self.daa,
-            #set the carry flag (why?)
-            0x37: self.scf,
-            #complement the carry flag (again, I ask, why?)
-            0x3F: self.ccf,
-            0x2F: self.cpl,
-            #enable/disable interrupts
-            0xF3: self.int_switch, 0xFB: self.int_switch,
-            #shift ops
-            0x07: self.rlca,
-            0x17: self.rla,
-            0x0F: self.rrca,
-            0x1f: self.rra,
-            #8-bit immediate loads
-            0x06: self.load8_imm, 0x16: self.load8_imm, 0x26: self.load8_imm, 
-              0x36: self.load_imm, 0x0E: self.load8_imm, 0x1E: self.load8_imm,
-              0x2E: self.load8_imm, 0x3E: self.load8_imm, 
-            #16-bit immediate loads
-            0x01: self.load16_imm, 0x11: self.load16_imm, 0x21: self.load16_imm,
-              0x31: self.load16_imm,
-            #8-bit register loads
-            0x40: self.load8_reg, 0x41: self.load8_reg, 0x42: self.load8_reg, 
-              0x43: self.load8_reg, 0x44: self.load8_reg, 0x45: self.load8_reg, 
-              0x46: self.load8_reg, 0x47: self.load8_reg, 0x48: self.load8_reg, 
-              0x49: self.load8_reg, 0x4A: self.load8_reg, 0x4B: self.load8_reg, 
-              0x4C: self.load8_reg, 0x4D: self.load8_reg, 0x4E: self.load8_reg, 
-              0x4F: self.load8_reg, 0x50: self.load8_reg, 0x51: self.load8_reg, 
-              0x52: self.load8_reg, 0x53: self.load8_reg, 0x54: self.load8_reg, 
-              0x55: self.load8_reg, 0x56: self.load8_reg, 0x57: self.load8_reg, 
-              0x58: self.load8_reg, 0x59: self.load8_reg, 0x5A: self.load8_reg, 
-              0x5B: self.load8_reg, 0x5C: self.load8_reg, 0x5D: self.load8_reg, 
-              0x5E: self.load8_reg, 0x5F: self.load8_reg, 0x60: self.load8_reg, 
-              0x61: self.load8_reg, 0x62: self.load8_reg, 0x63: self.load8_reg, 
-              0x64: self.load8_reg, 0x65: self.load8_reg, 0x66: self.load8_reg, 
-              0x67: self.load8_reg, 0x68: self.load8_reg, 0x69: self.load8_reg, 
-              0x6A: self.load8_reg, 0x6B: self.load8_reg, 0x6C: self.load8_reg, 
-              0x6D: self.load8_reg, 0x6E: self.load8_reg, 0x6F: self.load8_reg, 
-              0x70: self.load8_reg, 0x71: self.load8_reg, 0x72: self.load8_reg, 
-              0x73: self.load8_reg, 0x74: self.load8_reg, 0x75: self.load8_reg, 
-              0x77: self.load8_reg, 0x78: self.load8_reg, 0x79: self.load8_reg, 
-              0x7A: self.load8_reg, 0x7B: self.load8_reg, 0x7C: self.load8_reg, 
-              0x7D: self.load8_reg, 0x7E: self.load8_reg, 0x7F: self.load8_reg,
-            #Memory loads from/to non HL addresses
-            0x02: self.load_to_mem, 0x12: self.load_to_mem,
-            0x0A: self.load_fr_mem, 0x1A: self.load_fr_mem,
-            #HL loads with inc/dec
-            0x22: self.ldi_to, 0x32: self.ldd_to,
-            0x2A: self.ldi_fr, 0x3A: self.ldd_fr,
-            #Loads to/from the upper half of memory
-            0xE0: self.ldh_imm_to, 0xF0: self.ldh_imm_fr, 0xE2: self.ldh_c,
-            #Loads to/from immediate memory addresses
-            0xEA: self.load_imm_to, 0xFA: self.load_imm_fr,
-            #Dump HL to SP
-            0xF9: self.load_to_sp,
-            #Save offset from SP
-            0xF8: self.load_sp_with_offset,
-            #Save SP to memory
-            0x08: self.load_sp_to_mem,
-            #ARITHMETIC OPS
-            #16-bit increments
-            0x03: self.inc16, 0x13: self.inc16, 0x23: self.inc16, 0x33: self.inc16,
-            #16-bit decrements
-            0x0B: self.dec16, 0x1B: self.dec16, 0x2B: self.dec16, 0x3B: self.dec16,
-            #8-bit increments
-            0x04: self.inc8, 0x14: self.inc8, 0x24: self.inc8, 0x34: self.inc8,
-              0x0C: self.inc8, 0x1C: self.inc8, 0x2C: self.inc8, 0x3C: self.inc8,
-            #8-bit decrements
-            0x50: self.dec8, 0x51: self.dec8, 0x52: self.dec8, 0x53: self.dec8,
-              0x0D: self.dec8, 0x1D: self.dec8, 0x2D: self.dec8, 0x3D: self.dec8,
-            #8-bit add
-            0x80: self.add8, 0x81: self.add8, 0x82: self.add8, 0x83: self.add8,
-              0x84: self.add8, 0x85: self.add8, 0x86: self.add8, 0x87: self.add8,
-            #8-bit add w/ carry
-            0x88: self.adc8, 0x89: self.adc8, 0x8A: self.adc8, 0x8B: self.adc8,
-              0x8C: self.adc8, 0x8D: self.adc8, 0x8E: self.adc8, 0x8F: self.adc8, 
-            #8-bit subtract
-            0x90: self.sub8, 0x91: self.sub8, 0x92: self.sub8, 0x93: self.sub8,
-              0x94: self.sub8, 0x95: self.sub8, 0x96: self.sub8, 0x97: self.sub8,
-            #8-bit subtract w/ carry
-            0x98: self.sbc8, 0x99: self.sbc8, 0x9A: self.sbc8, 0x9B: self.sbc8,
-              0x9C: self.sbc8, 0x9D: self.sbc8, 0x9E: self.sbc8, 0x9F: self.sbc8, 
-            #8-bit and
-            0xA0: self.and8, 0xA1: self.and8, 0xA2: self.and8, 0xA3: self.and8,
-              0xA4: self.and8, 0xA5: self.and8, 0xA6: self.and8, 0xA7: self.and8,
-            #8-bit xor
-            0xA8: self.xor8, 0xA9: self.xor8, 0xAA: self.xor8, 0xAB: self.xor8,
-              0xAC: self.xor8, 0xAD: self.xor8, 0xAE: self.xor8, 0xAF: self.xor8, 
-            #8-bit or
-            0xB0: self.or8, 0xB1: self.or8, 0xB2: self.or8, 0xB3: self.or8,
-              0xB4: self.or8, 0xB5: self.or8, 0xB6: self.or8, 0xB7: self.or8,
-            #8-bit compare
-            0xB8: self.cp8, 0xB9: self.cp8, 0xBA: self.cp8, 0xBB: self.cp8,
-              0xBC: self.cp8, 0xBD: self.cp8, 0xBE: self.cp8, 0xBF: self.cp8, 
-            #8-bit immediate arithmetic
-            0xC6: self.add8_imm, 0xD6: self.sub8_imm, 0xE6: self.and8_imm,
-              0xF6: self.or8_imm, 0xCE: self.adc8_imm, 0xDE: self.sbc_imm,
-              0xEE: self.xor8_imm, 0xFE: self.cp8_imm,
-            #STACK OPS AND BRANCHES
-            #Push
-            0xC5: self.push, 0xD5: self.push, 0xE5: self.push, 0xF5: self.push,
-            #Pop
-            0xC1: self.pop, 0xD1: self.pop, 0xE1: self.pop, 0xF1: self.pop,
-            #Fixed location calls
-            0xC7: self.rst, 0xCF: self.rst, 0xD7: self.rst, 0xDF: self.rst,
-              0xE7: self.rst, 0xEF: self.rst, 0xF7: self.rst, 0xFF: self.rst,
-            #Variable location calls
-            0xC4: self.callnz, 0xD4: self.callnc, 0xCC: self.callz, 0xDC: callc,
-              0xCD: self.call,
-            #Returns
-            0xC0: self.retnz, 0xD0: self.retnc, 0xC8: self.retz, 0xD8: self.retc,
-              0xC9: self.ret, 0xD9: self.reti,
-            #Relative jumps
-            0x20: self.jrnz, 0x30: self.jrnc, 0x18: self.jr, 0x28: self.jrz,
-              0x38: self.jrc,
-            #Garbage instructions
-            0xF2:self.ill, 0xD3: self.ill, 0xE3: self.ill, 0xE4: self.ill,
-              0xF4: self.ill, 0xDB: self.ill, 0xEB: self.ill, 0xEC: self.ill,
-              0xFC: self.ill, 0xDD: self.ill, 0xED: self.ill, 0xFD: self.ill 
-          }
-    self.ext_ops = { 0x00: self.rlc, 0x01: self.rlc, 0x02: self.rlc, 0x03: self.rlc, 
-              0x04: self.rlc, 0x05: self.rlc, 0x06: self.rlc, 0x07: self.rlc, 
-              #rotate right w/ carry
-              0x08: self.rrc, 0x09: self.rrc, 0x0A: self.rrc, 0x0B: self.rrc, 
-              0x0C: self.rrc, 0x0D: self.rrc, 0x0E: self.rrc, 0x0F: self.rrc, 
-              #rotate left
-              0x10: self.rlc, 0x11: self.rlc, 0x12: self.rlc, 0x13: self.rlc, 
-              0x14: self.rlc, 0x15: self.rlc, 0x16: self.rlc, 0x17: self.rlc, 
-              #rotate right
-              0x18: self.rrc, 0x19: self.rrc, 0x1A: self.rrc, 0x1B: self.rrc, 
-              0x1C: self.rrc, 0x1D: self.rrc, 0x1E: self.rrc, 0x1F: self.rrc, 
-              #shift left
-              0x20: self.sla, 0x21: self.sla, 0x22: self.sla, 0x23: self.sla, 
-              0x24: self.sla, 0x25: self.sla, 0x26: self.sla, 0x27: self.sla, 
-              #shift right
-              0x28: self.sra, 0x29: self.sra, 0x2A: self.sra, 0x2B: self.sra, 
-              0x2C: self.sra, 0x2D: self.sra, 0x2E: self.sra, 0x2F: self.sra, 
-              #swap nybbles
-              0x30: self.swap, 0x31: self.swap, 0x32: self.swap, 0x33: self.swap, 
-              0x34: self.swap, 0x35: self.swap, 0x36: self.swap, 0x37: self.swap, 
-              #shift right without preserving sign
-              0x38: self.srl, 0x39: self.srl, 0x3A: self.srl, 0x3B: self.srl, 
-              0x3C: self.srl, 0x3D: self.srl, 0x3E: self.srl, 0x3F: self.srl, 
-              #test nth bit
-              0x40: self.bit, 0x41: self.bit, 0x42: self.bit, 0x43: self.bit, 
-              0x44: self.bit, 0x45: self.bit, 0x46: self.bit, 0x47: self.bit, 
-              0x48: self.bit, 0x49: self.bit, 0x4A: self.bit, 0x4B: self.bit, 
-              0x4C: self.bit, 0x4D: self.bit, 0x4E: self.bit, 0x4F: self.bit, 
-              0x50: self.bit, 0x51: self.bit, 0x52: self.bit, 0x53: self.bit, 
-              0x54: self.bit, 0x55: self.bit, 0x56: self.bit, 0x57: self.bit, 
-              0x58: self.bit, 0x59: self.bit, 0x5A: self.bit, 0x5B: self.bit, 
-              0x5C: self.bit, 0x5D: self.bit, 0x5E: self.bit, 0x5F: self.bit, 
-              0x60: self.bit, 0x61: self.bit, 0x62: self.bit, 0x63: self.bit, 
-              0x64: self.bit, 0x65: self.bit, 0x66: self.bit, 0x67: self.bit, 
-              0x68: self.bit, 0x69: self.bit, 0x6A: self.bit, 0x6B: self.bit, 
-              0x6C: self.bit, 0x6D: self.bit, 0x6E: self.bit, 0x6F: self.bit, 
-              0x70: self.bit, 0x71: self.bit, 0x72: self.bit, 0x73: self.bit, 
-              0x74: self.bit, 0x75: self.bit, 0x76: self.bit, 0x77: self.bit, 
-              0x78: self.bit, 0x79: self.bit, 0x7A: self.bit, 0x7B: self.bit, 
-              0x7C: self.bit, 0x7D: self.bit, 0x7E: self.bit, 0x7F: self.bit, 
-              #clear nth bit
-              0x80: self.res, 0x81: self.res, 0x82: self.res, 0x83: self.res, 
-              0x84: self.res, 0x85: self.res, 0x86: self.res, 0x87: self.res, 
-              0x88: self.res, 0x89: self.res, 0x8A: self.res, 0x8B: self.res, 
-              0x8C: self.res, 0x8D: self.res, 0x8E: self.res, 0x8F: self.res, 
-              0x90: self.res, 0x91: self.res, 0x92: self.res, 0x93: self.res, 
-              0x94: self.res, 0x95: self.res, 0x96: self.res, 0x97: self.res, 
-              0x98: self.res, 0x99: self.res, 0x9A: self.res, 0x9B: self.res, 
-              0x9C: self.res, 0x9D: self.res, 0x9E: self.res, 0x9F: self.res, 
-              0xA0: self.res, 0xA1: self.res, 0xA2: self.res, 0xA3: self.res, 
-              0xA4: self.res, 0xA5: self.res, 0xA6: self.res, 0xA7: self.res, 
-              0xA8: self.res, 0xA9: self.res, 0xAA: self.res, 0xAB: self.res, 
-              0xAC: self.res, 0xAD: self.res, 0xAE: self.res, 0xAF: self.res, 
-              0xB0: self.res, 0xB1: self.res, 0xB2: self.res, 0xB3: self.res, 
-              0xB4: self.res, 0xB5: self.res, 0xB6: self.res, 0xB7: self.res, 
-              0xB8: self.res, 0xB9: self.res, 0xBA: self.res, 0xBB: self.res, 
-              0xBC: self.res, 0xBD: self.res, 0xBE: self.res, 0xBF: self.res, 
-              #set nth bit
-              0xC0: self.set, 0xC1: self.set, 0xC2: self.set, 0xC3: self.set, 
-              0xC4: self.set, 0xC5: self.set, 0xC6: self.set, 0xC7: self.set, 
-              0xC8: self.set, 0xC9: self.set, 0xCA: self.set, 0xCB: self.set, 
-              0xCC: self.set, 0xCD: self.set, 0xCE: self.set, 0xCF: self.set, 
-              0xD0: self.set, 0xD1: self.set, 0xD2: self.set, 0xD3: self.set, 
-              0xD4: self.set, 0xD5: self.set, 0xD6: self.set, 0xD7: self.set, 
-              0xD8: self.set, 0xD9: self.set, 0xDA: self.set, 0xDB: self.set, 
-              0xDC: self.set, 0xDD: self.set, 0xDE: self.set, 0xDF: self.set, 
-              0xE0: self.set, 0xE1: self.set, 0xE2: self.set, 0xE3: self.set, 
-              0xE4: self.set, 0xE5: self.set, 0xE6: self.set, 0xE7: self.set, 
-              0xE8: self.set, 0xE9: self.set, 0xEA: self.set, 0xEB: self.set, 
-              0xEC: self.set, 0xED: self.set, 0xEE: self.set, 0xEF: self.set, 
-              0xF0: self.set, 0xF1: self.set, 0xF2: self.set, 0xF3: self.set, 
-              0xF4: self.set, 0xF5: self.set, 0xF6: self.set, 0xF7: self.set, 
-              0xF8: self.set, 0xF9: self.set, 0xFA: self.set, 0xFB: self.set, 
-              0xFC: self.set, 0xFD: self.set, 0xFE: self.set, 0xFF: self.set}
+    # Total clock cycles executed, at CLOCK_HZ.
+    self.cycles = 0
+    # The run loop executes instructions while cycles is below this. Handlers which need the
+    # loop to stop and look at the cpu state (e.g. HALT) set it to 0.
+    self._yield_at = 0
 
+    # Peripherals schedule their work on the mmu's scheduler, against our cycle count.
+    self.scheduler = mmu.scheduler
+    self.scheduler.clock = self
+    self.scheduler.on_earlier_deadline = self._earlier_deadline
+    mmu.on_interrupts_changed = self._interrupts_changed
+
+    # Translated code for run, see gb.blocks.
+    self.blocks = BlockCache(self)
+    # Whether request_break was called since the run loop last stopped for it.
+    self._break = False
+    # The gb.profiler.Profiler profiling us, gb.debug.Debugger debugging us and
+    # gb.trace.Tracer tracing us, if any.
+    self.profiler = None
+    self.debugger = None
+    self.tracer = None
 
   def execute_instr(self):
-    if (self.halted and self.interrupts_enabled) or self.stopped:
+    """Execute a single instruction, returning the clock cycles it took, including
+    dispatching a pending interrupt first.
+
+    A halted cpu doesn't execute anything: it skips ahead to the next scheduled event and
+    returns the cycles skipped, which is 0 if nothing is scheduled. A stopped cpu returns 0.
+
+    """
+    start = self.cycles
+    scheduler = self.scheduler
+    self._check_interrupts()
+    if self.stopped:
+      return 0
+    if self.halted:
+      if scheduler.next_deadline != NEVER:
+        self.cycles = max(self.cycles, scheduler.next_deadline)
+        scheduler.run_due(self.cycles)
+      return self.cycles - start
+
+    pc = self.pc
+    self.pc = (pc + 1) & 0xFFFF
+    self.cycles += self.ops[self.mmu[pc]](self)
+    if scheduler.next_deadline <= self.cycles:
+      scheduler.run_due(self.cycles)
+    return self.cycles - start
+
+  def _earlier_deadline(self, deadline):
+    """Scheduler hook: make a running loop stop in time for a newly scheduled event."""
+    if deadline < self._yield_at:
+      self._yield_at = deadline
+
+  def request_break(self):
+    """Make the running loop return REASON_BREAK as soon as it can: before the next
+    instruction when called from a breakpoint or an interpreted instruction, or at the end
+    of the current translated block at the latest.
+
+    """
+    self._break = True
+    self._yield_at = 0
+
+  def _interrupts_changed(self):
+    """Mmu hook: IF or IE changed, so make a running loop stop and check for interrupts."""
+    self._yield_at = 0
+
+  def _check_interrupts(self):
+    """Wake the cpu if an enabled interrupt is pending, and dispatch the highest priority
+    one to its handler if interrupts are enabled.
+
+    """
+    mmu = self.mmu
+    pending = mmu.interrupt_flag & mmu.interrupt_enable & INT_MASK
+    if not pending:
       return
+    if self.stopped:
+      # Only the joypad brings the cpu out of STOP.
+      if not pending & INT_JOYPAD:
+        return
+      self.stopped = False
+    self.halted = False
+    if not self.interrupts_enabled:
+      return
+
+    bit = pending & -pending
+    mmu.interrupt_flag &= ~bit
+    self.interrupts_enabled = False
+    sp = (self.sp - 2) & 0xFFFF
+    self.sp = sp
+    mmu[(sp + 1) & 0xFFFF] = self.pc >> 8
+    mmu[sp] = self.pc & 0xFF
+    self.pc = INTERRUPT_VECTOR + 8 * (bit.bit_length() - 1)
+    self.cycles += INTERRUPT_CYCLES
+
+  def _service(self, end):
+    """Called by the run loops between batches of instructions. Runs any scheduled events
+    that are due and dispatches interrupts, then returns the reason to stop running, or
+    None after setting up the next batch, which runs until end or the next scheduled event.
+
+    While the cpu is halted nothing can happen until an event raises an interrupt, so rather
+    than spinning, the cycle count jumps straight to each event in turn.
+
+    """
+    scheduler = self.scheduler
+    while True:
+      if self._break:
+        self._break = False
+        return REASON_BREAK
+      if scheduler.next_deadline <= self.cycles:
+        scheduler.run_due(self.cycles)
+      self._check_interrupts()
+      if self.stopped:
+        return REASON_STOP
+      if self.cycles >= end:
+        return REASON_CYCLES
+      if not self.halted:
+        self._yield_at = min(end, scheduler.next_deadline)
+        return None
+      if scheduler.next_deadline == NEVER or not self.mmu.interrupt_enable & INT_MASK:
+        # Nothing will ever wake us up: no events, or no interrupts they could raise.
+        return REASON_HALT
+      self.cycles = min(end, scheduler.next_deadline)
+
+  def run(self, max_cycles):
+    """Execute instructions until at least max_cycles clock cycles have passed, or the cpu
+    stops, or halts with nothing left to wake it (no scheduled events, or no interrupts
+    enabled), or request_break is called. Returns (cycles executed, reason for
+    returning), where the reason is one of the REASON_* constants.
+
+    The inner loop only executes code, a translated block at a time (see gb.blocks). It
+    breaks out to run scheduled events when the next one is due, and when a handler asks
+    it to (see _yield_at).
+
+    """
+    start = self.cycles
+    end = start + max_cycles
+    blocks = self.blocks.pages
+
+    reason = self._service(end)
+    while reason is None:
+      while self.cycles < self._yield_at:
+        pc = self.pc
+        self.cycles += blocks[pc >> 8][pc](self)
+      reason = self._service(end)
+    return self.cycles - start, reason
+
+  def run_until(self, pc=None, cycles=None, predicate=None):
+    """Execute instructions until the pc reaches pc, at least cycles clock cycles have
+    passed, predicate(cpu) returns true after an instruction, or the cpu halts or stops.
+    Returns (cycles executed, reason for returning), like run.
+
+    Checking pc and predicate costs time on every instruction, so without them this just
+    calls run.
+
+    """
+    if pc is None and predicate is None:
+      if cycles is None:
+        raise ValueError("run_until needs at least one condition to stop on.")
+      return self.run(cycles)
+
+    start = self.cycles
+    end = start + cycles if cycles is not None else NEVER
+    ops = self.ops
+    pages = self.mmu.read_pages
+    break_pc = pc
+
+    reason = self._service(end)
+    while reason is None:
+      while self.cycles < self._yield_at:
+        pc = self.pc
+        self.pc = (pc + 1) & 0xFFFF
+        self.cycles += ops[pages[pc >> 8][pc & 0xFF]](self)
+        if self.pc == break_pc:
+          return self.cycles - start, REASON_PC
+        if predicate is not None and predicate(self):
+          return self.cycles - start, REASON_PREDICATE
+      reason = self._service(end)
+    return self.cycles - start, reason
+
+  def save_state(self):
+    """Return the registers, flags and cycle count as a save state blob (see gb.state).
+    The mmu saves its own state.
+
+    """
+    state = StateWriter(STATE_MAGIC, STATE_VERSION)
+    flags = self.halted | self.stopped << 1 | self.interrupts_enabled << 2
+    state.pack('HH8sBQ', self.pc, self.sp, bytes(self.regs), flags, self.cycles)
+    return state.value()
+
+  def load_state(self, data):
+    """Restore a blob from save_state. Note that events already on the scheduler are
+    left alone, and will run against the restored cycle count.
+
+    """
+    state = StateReader(data, STATE_MAGIC, STATE_VERSION)
+    self.pc, self.sp, regs, flags, self.cycles = state.unpack('HH8sBQ')
+    self.regs[:] = regs
+    self.halted = bool(flags & 0x1)
+    self.stopped = bool(flags & 0x2)
+    self.interrupts_enabled = bool(flags & 0x4)
+    self._yield_at = 0
 
-    opcode = self.mmu[self.pc]
-    if not self.halted:
-      self.pc = (self.pc + 1) % 0x10000
+  def get_pair(self, pair):
+    hi, lo = pair
+    regs = self.regs
+    return regs[hi] << 8 | regs[lo]
 
-    self.ops[opcode](opcode)
+  def set_pair(self, pair, value):
+    hi, lo = pair
+    regs = self.regs
+    regs[hi] = (value >> 8) & 0xFF
+    regs[lo] = value & 0xFF
@@ -0,0 +1,166 @@
+"""Breakpoints and watchpoints.
+
+A Debugger collects hits on execution breakpoints and on reads and writes of watched
+addresses, and by default stops Cpu.run at each one (with REASON_BREAK). Neither costs
+anything where it isn't set:
+
+  - breakpoints swap in different translated blocks for just the pages they are on (see
+    BlockCache.add_breakpoint), ending the blocks around them before the breakpoint.
+  - watchpoints swap in watching handlers for just the pages they are on (see Mmu.watch).
+
+Translated blocks don't keep the pc and cycle count up to date while they run, so while
+any watchpoint is set the debugger swaps the cpu's class for one whose run loop executes
+an instruction at a time, as the profiler does. Hits then report the exact instruction and
+cycle of every access, and stop the cpu right after the instruction making it.
+
+"""
+
+import collections
+
+from gb.cpu import Cpu
+
+# Kinds of hits.
+HIT_BREAK = 'break'
+HIT_READ = 'read'
+HIT_WRITE = 'write'
+
+# A breakpoint or watchpoint hit: the kind of hit, the address executed, read or written,
+# the value read or written (None for breakpoints), and the pc and cycle count at the start
+# of the instruction.
+Hit = collections.namedtuple('Hit', ['kind', 'address', 'value', 'pc', 'cycles'])
+
+
+class Debugger(object):
+  """Breakpoints and watchpoints for cpu. Hits are appended to hits and passed to on_hit,
+  if set. If stop is true, each hit stops Cpu.run. Running again carries on from there:
+  a breakpoint doesn't hit again until the cpu comes back to it.
+
+  """
+
+  def __init__(self, cpu, stop=True, on_hit=None):
+    self.cpu = cpu
+    self.stop = stop
+    self.on_hit = on_hit
+    self.hits = []
+    self._breakpoints = set()
+    # (reads, writes) by watched address.
+    self._watches = {}
+    # Breakpoints by address, for the instruction at a time run loop.
+    self._break_map = bytearray(0x10000)
+    # The (pc, cycles) the last breakpoint hit at, so that running on from it doesn't hit
+    # it again straight away.
+    self._resume = None
+    # The pc at the start of the instruction being run, while watching.
+    self.pc = None
+
+  @property
+  def breakpoints(self):
+    return sorted(self._breakpoints)
+
+  @property
+  def watches(self):
+    return sorted(self._watches.items())
+
+  def add_breakpoint(self, addr):
+    self._breakpoints.add(addr)
+    self._break_map[addr] = 1
+    self.cpu.blocks.add_breakpoint(addr, self._breakpoint)
+
+  def remove_breakpoint(self, addr):
+    self._breakpoints.discard(addr)
+    self._break_map[addr] = 0
+    self.cpu.blocks.remove_breakpoint(addr)
+
+  def watch(self, addr, length=1, reads=False, writes=True):
+    """Watch reads of, and/or writes to, the length addresses from addr."""
+    mmu = self.cpu.mmu
+    for a in range(addr, addr + length):
+      if a in self._watches:
+        mmu.unwatch(a, self._watched)
+      self._watches[a] = reads, writes
+      mmu.watch(a, self._watched, reads, writes)
+    self._instrument()
+
+  def unwatch(self, addr, length=1):
+    mmu = self.cpu.mmu
+    for a in range(addr, addr + length):
+      if self._watches.pop(a, None) is not None:
+        mmu.unwatch(a, self._watched)
+    self._instrument()
+
+  def clear(self):
+    """Remove every breakpoint and watchpoint."""
+    for addr in list(self._breakpoints):
+      self.remove_breakpoint(addr)
+    for addr in list(self._watches):
+      self.unwatch(addr)
+
+  def _instrument(self):
+    """Run an instruction at a time while anything is watched."""
+    cpu = self.cpu
+    if self._watches and type(cpu) is not _WatchingCpu:
+      if type(cpu) is not Cpu:
+        raise ValueError("Can't watch memory while the cpu is being profiled.")
+      cpu.debugger = self
+      cpu.__class__ = _WatchingCpu
+    elif not self._watches and type(cpu) is _WatchingCpu:
+      cpu.__class__ = Cpu
+      cpu.debugger = None
+
+  def _hit(self, hit):
+    self.hits.append(hit)
+    if self.on_hit is not None:
+      self.on_hit(hit)
+    if self.stop:
+      self.cpu.request_break()
+
+  def _breakpoint(self, cpu):
+    """Breakpoint callback, see BlockCache.add_breakpoint."""
+    position = cpu.pc, cpu.cycles
+    if position == self._resume:
+      return False
+    self._resume = position
+    self._hit(Hit(HIT_BREAK, cpu.pc, None, cpu.pc, cpu.cycles))
+    return self.stop
+
+  def _watched(self, addr, value, is_write):
+    """Watch callback, see Mmu.watch."""
+    cpu = self.cpu
+    self._hit(Hit(HIT_WRITE if is_write else HIT_READ, addr, value,
+                  self.pc if self.pc is not None else cpu.pc, cpu.cycles))
+
+
+class _WatchingCpu(Cpu):
+  """What a Cpu becomes while its debugger is watching memory, see Debugger. Only the run
+  loop differs.
+
+  """
+  __slots__ = ()
+
+  def run(self, max_cycles):
+    """Cpu.run, an instruction at a time, keeping the debugger's pc up to date and
+    checking for breakpoints.
+
+    """
+    debugger = self.debugger
+    break_map = debugger._break_map
+    start = self.cycles
+    end = start + max_cycles
+    ops = self.ops
+    pages = self.mmu.read_pages
+
+    debugger.pc = self.pc
+    reason = self._service(end)
+    while reason is None:
+      while self.cycles < self._yield_at:
+        pc = debugger.pc = self.pc
+        if break_map[pc] and debugger._breakpoint(self):
+          self.request_break()
+          break
+        self.pc = (pc + 1) & 0xFFFF
+        self.cycles += ops[pages[pc >> 8][pc & 0xFF]](self)
+      # Interrupts are dispatched between instructions, at the pc they interrupt.
+      debugger.pc = self.pc
+      reason = self._service(end)
+    debugger.pc = None
+    return self.cycles - start, reason
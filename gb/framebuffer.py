@@ -0,0 +1,224 @@
+"""Exporting frames to other processes through shared memory, without copying them or
+waiting for the processes reading them.
+
+A FrameBuffer is a fixed layout in any writable buffer: a header, and two slots of a frame
+each, as one byte per pixel, the shade (see gb.ppu). The emulator publishes each frame into
+the slot not holding the latest one, so it never waits for readers, and readers look at the
+latest frame in place, through a memoryview (which NumPy takes as is, with
+numpy.asarray). The header counts the frames published, and each slot is stamped with the
+number of the frame in it, cleared while it is being written, so a reader can tell whether
+the frame it looked at was overwritten under it (see valid), and look again.
+
+The buffer is usually shared memory (multiprocessing.shared_memory, on Python 3.8 on),
+made with FrameBuffer.create and mapped by readers with FrameBuffer.attach and its name:
+
+  frames = export(machine, FrameBuffer.create())
+  ...
+  frames = FrameBuffer.attach(name)
+  sequence, frame = frames.latest()
+  ... use frame ...
+  if not frames.valid(sequence):
+    ... it was overwritten, look again ...
+
+where export has the machine's lcd draw every frame into frames. Readers that would rather
+not check can copy a frame out with read, which retries until it gets a whole one.
+
+"""
+
+import multiprocessing
+import os
+import struct
+
+try:
+  from multiprocessing import resource_tracker, shared_memory
+except ImportError:
+  shared_memory = None
+
+from gb.lcd import VISIBLE_LINES
+
+# The size of a frame, as gb.ppu.SCREEN_WIDTH and SCREEN_HEIGHT (which need NumPy).
+WIDTH = 160
+HEIGHT = VISIBLE_LINES
+FRAME_SIZE = WIDTH * HEIGHT
+SLOTS = 2
+
+# Header: magic, version, slots, width and height, then the number of frames published and
+# of the frame in each slot (0 for none), then the slots.
+MAGIC = b'GBFB'
+VERSION = 1
+HEADER = struct.Struct('<4sBBHH')
+_COUNT = struct.Struct('<Q')
+SEQUENCE_OFFSET = 16
+SLOT_SEQUENCE_OFFSET = SEQUENCE_OFFSET + _COUNT.size
+FRAMES_OFFSET = 64
+BUFFER_SIZE = FRAMES_OFFSET + SLOTS * FRAME_SIZE
+
+# Names of the shared memory made by this process, see attach.
+_created = set()
+
+
+class FrameBufferError(Exception):
+  """Error raised for buffers which don't hold a frame buffer."""
+  pass
+
+
+class FrameBuffer(object):
+  """Double buffered frames in buffer, a writable bytes-like object of at least
+  BUFFER_SIZE bytes, e.g. a bytearray or an mmap. If init, the buffer is set up empty,
+  else it has to hold a frame buffer already.
+
+  """
+
+  def __init__(self, buffer, init=True):
+    view = memoryview(buffer).cast('B')
+    if len(view) < BUFFER_SIZE:
+      raise ValueError("A frame buffer needs %d bytes, not %d." % (BUFFER_SIZE, len(view)))
+    self._view = view
+    self._memory = None
+    if init:
+      view[:BUFFER_SIZE] = bytes(BUFFER_SIZE)
+      HEADER.pack_into(view, 0, MAGIC, VERSION, SLOTS, WIDTH, HEIGHT)
+    elif HEADER.unpack_from(view) != (MAGIC, VERSION, SLOTS, WIDTH, HEIGHT):
+      raise FrameBufferError("Not a frame buffer, or an unsupported version.")
+    self._slots = [view[FRAMES_OFFSET + slot * FRAME_SIZE:
+                        FRAMES_OFFSET + (slot + 1) * FRAME_SIZE]
+                   for slot in range(SLOTS)]
+
+  @classmethod
+  def create(cls, name=None):
+    """Return a new frame buffer in shared memory, called name, or a unique name if None.
+    Call unlink once it is no longer needed.
+
+    """
+    if shared_memory is None:
+      raise FrameBufferError("Shared memory needs Python 3.8 or later.")
+    memory = shared_memory.SharedMemory(name, create=True, size=BUFFER_SIZE)
+    _created.add(memory.name)
+    frames = cls(memory.buf)
+    frames._memory = memory
+    return frames
+
+  @classmethod
+  def attach(cls, name):
+    """Return the frame buffer in the shared memory called name, made by create."""
+    if shared_memory is None:
+      raise FrameBufferError("Shared memory needs Python 3.8 or later.")
+    try:
+      memory = shared_memory.SharedMemory(name, track=False)
+    except TypeError:
+      memory = shared_memory.SharedMemory(name)
+      # Before Python 3.13, attaching registers the memory to be unlinked when the process
+      # exits, as if it had made it. Undo that unless the process shares the resource
+      # tracker of the one that did.
+      if (os.name == 'posix' and name not in _created and
+          multiprocessing.parent_process() is None):
+        resource_tracker.unregister(memory._name, 'shared_memory')
+    try:
+      frames = cls(memory.buf, init=False)
+    except Exception:
+      memory.close()
+      raise
+    frames._memory = memory
+    return frames
+
+  @property
+  def name(self):
+    """The name of the shared memory, for attach, or None if not in shared memory."""
+    return self._memory.name if self._memory is not None else None
+
+  @property
+  def sequence(self):
+    """The number of frames published, which is also the number of the latest one."""
+    return _COUNT.unpack_from(self._view, SEQUENCE_OFFSET)[0]
+
+  def _slot_sequence(self, slot):
+    return _COUNT.unpack_from(self._view, SLOT_SEQUENCE_OFFSET + slot * _COUNT.size)[0]
+
+  def _set_slot_sequence(self, slot, sequence):
+    _COUNT.pack_into(self._view, SLOT_SEQUENCE_OFFSET + slot * _COUNT.size, sequence)
+
+  def publish(self, frame):
+    """Make frame, a bytes-like object of HEIGHT rows of WIDTH shades (e.g. a
+    gb.ppu.Renderer frame), the latest frame. Never waits for readers.
+
+    """
+    sequence = self.sequence + 1
+    slot = sequence % SLOTS
+    self._set_slot_sequence(slot, 0)
+    self._slots[slot][:] = memoryview(frame).cast('B')
+    self._set_slot_sequence(slot, sequence)
+    _COUNT.pack_into(self._view, SEQUENCE_OFFSET, sequence)
+
+  def frame(self, sequence):
+    """Return a memoryview of the slot frame number sequence is published into, indexed by
+    [y, x]. Check the frame is still there with valid once done with it.
+
+    """
+    return self._slots[sequence % SLOTS].cast('B', (HEIGHT, WIDTH))
+
+  def latest(self):
+    """Return (sequence, frame): the number of the latest frame and a view of it (see
+    frame), or (0, None) if none has been published.
+
+    """
+    sequence = self.sequence
+    if not sequence:
+      return 0, None
+    return sequence, self.frame(sequence)
+
+  def valid(self, sequence):
+    """Whether frame number sequence is still whole in its slot: once it isn't, what was
+    read from it since it was published can't be trusted.
+
+    """
+    return self._slot_sequence(sequence % SLOTS) == sequence
+
+  def read(self, out=None):
+    """Copy the latest frame into out, a writable bytes-like object of FRAME_SIZE bytes,
+    or a new bytearray if None. Returns (sequence, out), or (0, None) if no frame has been
+    published.
+
+    """
+    if out is None:
+      out = bytearray(FRAME_SIZE)
+    target = memoryview(out).cast('B')
+    while True:
+      sequence = self.sequence
+      if not sequence:
+        return 0, None
+      target[:] = self._slots[sequence % SLOTS]
+      if self.valid(sequence):
+        return sequence, out
+
+  def close(self):
+    """Stop using the buffer. Views returned by frame and latest have to be released
+    first.
+
+    """
+    for view in self._slots:
+      view.release()
+    self._view.release()
+    if self._memory is not None:
+      self._memory.close()
+
+  def unlink(self):
+    """Free the shared memory, once every process has closed it."""
+    if self._memory is not None:
+      _created.discard(self._memory.name)
+      self._memory.unlink()
+
+
+def export(machine, frames, every=1):
+  """Have the lcd of machine (a gb.machine.Machine with gb.io.IoRegisters and a gb.lcd.Lcd)
+  draw every every-th frame and publish it into the FrameBuffer frames, in place of its
+  on_frame. Returns frames.
+
+  """
+  lcd = getattr(machine.io, 'lcd', None)
+  if lcd is None:
+    raise ValueError("The machine has no lcd to export frames from.")
+  if every < 1:
+    raise ValueError("Frames can only be exported every 1 or more frames, not %d." % every)
+  lcd.render_every = every
+  lcd.on_frame = frames.publish
+  return frames
@@ -0,0 +1,239 @@
+"""The io registers at 0xFF00-0xFF7F, for the parts of them that do more than hold a value:
+the joypad and the serial port, and the lcd registers if given a gb.lcd.Lcd. Everything
+else reads back whatever was last written.
+
+Machine uses a plain bytearray for the io registers unless it is given an IoRegisters, so
+that code which doesn't need input or serial output doesn't pay for it.
+
+"""
+
+from gb.mmu import INT_JOYPAD, INT_SERIAL
+from gb.state import StateReader, StateWriter
+
+IO_SIZE = 0x80
+
+# Register offsets from 0xFF00.
+P1_REG = 0x00
+SB_REG = 0x01
+SC_REG = 0x02
+LCDC_REG = 0x40
+STAT_REG = 0x41
+SCY_REG = 0x42
+SCX_REG = 0x43
+LY_REG = 0x44
+LYC_REG = 0x45
+BGP_REG = 0x47
+OBP0_REG = 0x48
+OBP1_REG = 0x49
+WY_REG = 0x4A
+WX_REG = 0x4B
+
+# Buttons, as bits of IoRegisters.buttons. The low nibble is read through P1 when the
+# direction keys are selected, the high nibble when the action buttons are.
+BUTTON_RIGHT = 0x01
+BUTTON_LEFT = 0x02
+BUTTON_UP = 0x04
+BUTTON_DOWN = 0x08
+BUTTON_A = 0x10
+BUTTON_B = 0x20
+BUTTON_SELECT = 0x40
+BUTTON_START = 0x80
+
+BUTTONS = {
+  'right': BUTTON_RIGHT,
+  'left': BUTTON_LEFT,
+  'up': BUTTON_UP,
+  'down': BUTTON_DOWN,
+  'a': BUTTON_A,
+  'b': BUTTON_B,
+  'select': BUTTON_SELECT,
+  'start': BUTTON_START,
+}
+
+# P1 bits selecting the direction keys and the action buttons, active low.
+P1_DIRECTIONS = 0x10
+P1_ACTIONS = 0x20
+
+# SC bits: a transfer is in progress, and this side drives the clock.
+SC_TRANSFER = 0x80
+SC_INTERNAL_CLOCK = 0x01
+
+# LCDC bits.
+LCDC_BG_ENABLE = 0x01
+LCDC_OBJ_ENABLE = 0x02
+LCDC_OBJ_SIZE = 0x04
+LCDC_BG_MAP = 0x08
+LCDC_TILE_DATA = 0x10
+LCDC_WINDOW_ENABLE = 0x20
+LCDC_WINDOW_MAP = 0x40
+LCDC_ENABLE = 0x80
+
+# Clock cycles to shift out a byte on the internal 8192Hz serial clock.
+SERIAL_TRANSFER_CYCLES = 4096
+
+# Save state header.
+STATE_MAGIC = b'GBIO'
+STATE_VERSION = 2
+
+
+def parse_buttons(buttons):
+  """Return the button bits for buttons, which is either already a mask or an iterable of
+  names from BUTTONS.
+
+  """
+  if isinstance(buttons, int):
+    return buttons & 0xFF
+  mask = 0
+  for name in buttons:
+    try:
+      mask |= BUTTONS[name.lower()]
+    except KeyError:
+      raise ValueError("Unknown button %r." % name)
+  return mask
+
+
+class IoRegisters(object):
+  """Io register device with a joypad and a serial port with nothing plugged in.
+
+  Set buttons (or call press and release) to change which buttons are held. Bytes sent
+  over the serial port with the internal clock are appended to serial_output once the
+  transfer finishes, SERIAL_TRANSFER_CYCLES later, and read back as 0xFF, as with no cable
+  attached. Transfers are timed by an event on the mmu's scheduler, so the device needs to
+  be attached to an mmu.
+
+  The lcd registers (LCDC_REG through WX_REG) are handed to lcd, a gb.lcd.Lcd, if given,
+  which keeps LY and STAT up to date and raises the lcd interrupts. Without one they hold
+  whatever was written, and the lcd never moves on.
+
+  """
+
+  def __init__(self, lcd=None):
+    self.regs = bytearray(IO_SIZE)
+    self.lcd = lcd
+    self.regs[P1_REG] = 0xCF
+    self.serial_output = bytearray()
+    self._buttons = 0
+    self._mmu = None
+    self._transfer = None
+    # Deadline of the transfer in progress, kept while detached (see fork).
+    self._transfer_deadline = None
+
+  def attach(self, mmu):
+    self._mmu = mmu
+    self._transfer = None
+    if self._transfer_deadline is not None:
+      self._transfer = mmu.scheduler.schedule(self._transfer_deadline, self._transfer_done)
+    if self.lcd is not None:
+      self.lcd.attach(mmu, self.regs)
+
+  @property
+  def buttons(self):
+    return self._buttons
+
+  @buttons.setter
+  def buttons(self, value):
+    pressed = value & ~self._buttons
+    self._buttons = value & 0xFF
+    # Pressing a button that is selected pulls its P1 line low, which raises the joypad
+    # interrupt.
+    if pressed & self._selected() and self._mmu is not None:
+      self._mmu.request_interrupt(INT_JOYPAD)
+
+  def press(self, buttons):
+    self.buttons = self._buttons | parse_buttons(buttons)
+
+  def release(self, buttons):
+    self.buttons = self._buttons & ~parse_buttons(buttons)
+
+  def _selected(self):
+    """Return the button bits currently readable through P1."""
+    select = self.regs[P1_REG]
+    mask = 0
+    if not select & P1_DIRECTIONS:
+      mask |= 0x0F
+    if not select & P1_ACTIONS:
+      mask |= 0xF0
+    return mask
+
+  def __getitem__(self, offset):
+    if offset == P1_REG:
+      held = self._buttons & self._selected()
+      return 0xC0 | (self.regs[P1_REG] & 0x30) | (~(held | held >> 4) & 0x0F)
+    return self.regs[offset]
+
+  def __setitem__(self, offset, value):
+    if offset == P1_REG:
+      self.regs[P1_REG] = 0xC0 | (value & 0x30) | 0x0F
+    elif offset == SC_REG:
+      self.regs[SC_REG] = value | 0x7E
+      if value & (SC_TRANSFER | SC_INTERNAL_CLOCK) == SC_TRANSFER | SC_INTERNAL_CLOCK:
+        self._start_transfer()
+    elif LCDC_REG <= offset <= WX_REG and self.lcd is not None:
+      self.lcd.write(offset, value)
+    else:
+      self.regs[offset] = value
+
+  def _start_transfer(self):
+    if self._transfer is not None and self._transfer.pending:
+      return
+    scheduler = self._mmu.scheduler
+    self._transfer_deadline = scheduler.now + SERIAL_TRANSFER_CYCLES
+    self._transfer = scheduler.schedule(self._transfer_deadline, self._transfer_done)
+
+  def _transfer_done(self, deadline):
+    self.serial_output.append(self.regs[SB_REG])
+    self.regs[SB_REG] = 0xFF
+    self.regs[SC_REG] &= ~SC_TRANSFER
+    self._transfer_deadline = None
+    self._mmu.request_interrupt(INT_SERIAL)
+
+  def fork(self):
+    """Return a copy of the registers for a forked machine, including any transfer in
+    progress and the lcd (see Lcd.fork), which carry on once the copy is attached to the
+    new mmu.
+
+    """
+    io = IoRegisters(self.lcd.fork() if self.lcd is not None else None)
+    io.regs[:] = self.regs
+    io.serial_output = bytearray(self.serial_output)
+    io._buttons = self._buttons
+    io._transfer_deadline = self._transfer_deadline
+    return io
+
+  def save_state(self):
+    """Return the registers, held buttons, any transfer in progress and the state of the
+    lcd as a save state blob (see gb.state). serial_output is not included.
+
+    """
+    state = StateWriter(STATE_MAGIC, STATE_VERSION)
+    deadline = self._transfer_deadline
+    state.pack('BQ', self._buttons, deadline + 1 if deadline is not None else 0)
+    state.section(self.regs)
+    state.section(self.lcd.save_state() if self.lcd is not None else b'')
+    return state.value()
+
+  def load_state(self, data):
+    """Restore a blob from save_state, or the registers saved by a machine whose io
+    registers are a plain bytearray.
+
+    """
+    if len(data) == IO_SIZE:
+      self.regs[:] = data
+      if self.lcd is not None and self._mmu is not None:
+        self.lcd.reset()
+      return
+    state = StateReader(data, STATE_MAGIC, STATE_VERSION)
+    self._buttons, deadline = state.unpack('BQ')
+    state.buffer(self.regs)
+    lcd = state.section()
+    if self.lcd is not None:
+      if len(lcd):
+        self.lcd.load_state(lcd)
+      elif self._mmu is not None:
+        self.lcd.reset()
+    if self._transfer is not None:
+      self._mmu.scheduler.cancel(self._transfer)
+      self._transfer = None
+    self._transfer_deadline = deadline - 1 if deadline else None
+    if self._mmu is not None:
+      self.attach(self._mmu)
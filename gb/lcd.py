@@ -0,0 +1,334 @@
+"""Lcd timing: the modes the lcd goes through on every line of every frame, and what the
+cpu sees of them: the LY and STAT registers, the VBlank and STAT interrupts, and being
+locked out of vram and oam while the lcd is reading them.
+
+An Lcd is plugged into the io registers (see gb.io.IoRegisters), and runs off events on the
+mmu's scheduler, one per mode change, so the registers change and the interrupts are raised
+on exactly the instruction they would be, and code polling LY or STAT sees every value.
+
+Composing the pixels of a frame is the expensive part of drawing it, and the timing doesn't
+depend on it, so the lcd only draws the frames asked for: every render_every frames, the
+next frame after request_frame, and the screen as it is at any moment with screenshot. The
+rest of the time the lcd is headless, and costs no more than its events. Frames are drawn
+by a gb.ppu.Renderer, which needs NumPy, so that is only imported once a frame is wanted.
+
+A frame being drawn is rendered in batches of lines (see Renderer.render_lines): the lines
+up to the current one are drawn whenever a register that changes what they look like is
+written, and the rest at the end of the frame. So scrolling and palette effects come out
+right, but changes to vram and oam only show from the next such write.
+
+"""
+
+from gb.cpu import FRAME_CYCLES
+from gb.io import (BGP_REG, LCDC_ENABLE, LCDC_REG, LY_REG, LYC_REG, OBP0_REG, OBP1_REG,
+                   SCX_REG, SCY_REG, STAT_REG, WX_REG, WY_REG)
+from gb.mmu import BUFFER_PAGES, INT_STAT, INT_VBLANK, PageLock
+from gb.state import StateReader, StateWriter
+
+# Lines per frame, of which the first 144 are drawn, and the clock cycles each line takes.
+LINE_CYCLES = 456
+LINES = FRAME_CYCLES // LINE_CYCLES
+VISIBLE_LINES = 144
+
+# Modes, as read from the low bits of STAT.
+MODE_HBLANK = 0
+MODE_VBLANK = 1
+MODE_OAM = 2
+MODE_TRANSFER = 3
+
+# Clock cycles spent in each mode of a visible line: searching oam, transferring pixels to
+# the screen, then horizontal blank for the rest of the line.
+OAM_CYCLES = 80
+TRANSFER_CYCLES = 172
+HBLANK_CYCLES = LINE_CYCLES - OAM_CYCLES - TRANSFER_CYCLES
+
+# STAT bits: the mode, whether LY equals LYC, and the conditions raising the STAT
+# interrupt, which are the only bits that can be written.
+STAT_MODE = 0x03
+STAT_COINCIDENCE = 0x04
+STAT_HBLANK = 0x08
+STAT_VBLANK = 0x10
+STAT_OAM = 0x20
+STAT_LYC = 0x40
+STAT_WRITABLE = 0x78
+
+# The STAT interrupt condition of each mode.
+_MODE_SOURCES = (STAT_HBLANK, STAT_VBLANK, STAT_OAM, 0)
+
+# Registers which change how the lines drawn after them look.
+_RENDER_REGS = frozenset([LCDC_REG, SCY_REG, SCX_REG, BGP_REG, OBP0_REG, OBP1_REG, WY_REG,
+                          WX_REG])
+
+# Save state header.
+STATE_MAGIC = b'GBLC'
+STATE_VERSION = 1
+
+
+class Lcd(object):
+  """Lcd timing for the io registers regs of an mmu, see attach.
+
+  Args:
+    render_every: draw every render_every-th frame (counting frames from 0), or no frames
+      but those asked for if 0.
+    restrict_access: lock the cpu out of oam while the lcd searches it and transfers
+      pixels, and out of vram while it transfers pixels, reading 0xFF and dropping writes,
+      as the hardware does. Locked memory is accessed a little slower all the time (see
+      Mmu.lock), so this can be turned off for code that is known not to need it.
+
+  on_frame, if set, is called with each frame drawn (Renderer.frame, an array of shades
+  which is drawn over in place, so copy it to keep it) at the start of the vertical blank
+  that ends it. frames counts the frames finished, and frames_rendered the frames drawn.
+
+  """
+
+  def __init__(self, render_every=0, restrict_access=True):
+    self.render_every = render_every
+    self.restrict_access = restrict_access
+    self.on_frame = None
+    self.renderer = None
+    self.frames = 0
+    self.frames_rendered = 0
+    # The line being drawn (LY) and the mode the lcd is in.
+    self.line = 0
+    self.mode = MODE_HBLANK
+    self.regs = None
+    self._mmu = None
+    self._event = None
+    # Deadline of the next mode change, or None while the lcd is off. Kept while detached
+    # (see fork).
+    self._deadline = None
+    # Whether any STAT interrupt condition holds: the interrupt is raised when one starts
+    # to.
+    self._stat_line = False
+    # Whether to draw the next frame, whether the current one is being drawn, and the lines
+    # of it drawn so far.
+    self._requested = False
+    self._rendering = False
+    self._drawn = 0
+    self._oam_lock = PageLock()
+    self._vram_lock = PageLock()
+
+  @property
+  def enabled(self):
+    return self._deadline is not None
+
+  @property
+  def frame(self):
+    """The last frame drawn, or None if none has been (see on_frame)."""
+    return self.renderer.frame if self.renderer is not None else None
+
+  def attach(self, mmu, regs):
+    """Run on the scheduler of mmu, keeping the lcd registers in the bytearray regs (the
+    io registers) up to date.
+
+    """
+    self._mmu = mmu
+    self.regs = regs
+    self.renderer = None
+    self._rendering = False
+    self._event = None
+    if self.restrict_access:
+      pages = dict(BUFFER_PAGES)
+      for name, lock in (('oam', self._oam_lock), ('vram', self._vram_lock)):
+        for first, last in pages[name]:
+          mmu.lock(first, last, lock)
+    self._update_locks()
+    if self._deadline is not None:
+      self._event = mmu.scheduler.schedule(self._deadline, self._next_mode)
+
+  def request_frame(self):
+    """Draw the next frame the lcd starts."""
+    self._requested = True
+
+  def screenshot(self):
+    """Draw the whole screen as vram, oam and the registers are now, whatever the lcd is
+    doing, and return it (see on_frame). A frame being drawn is given up.
+
+    """
+    self._rendering = False
+    return self._renderer().render_frame()
+
+  def _renderer(self):
+    if self.renderer is None:
+      from gb.ppu import Renderer
+      self.renderer = Renderer(self._mmu)
+    return self.renderer
+
+  def write(self, offset, value):
+    """Write the io register at offset, one of LCDC_REG through WX_REG."""
+    regs = self.regs
+    if self._rendering and offset in _RENDER_REGS and regs[offset] != value:
+      self._draw_lines(self._lines_done())
+    if offset == LCDC_REG:
+      on = regs[LCDC_REG] & LCDC_ENABLE
+      regs[LCDC_REG] = value
+      if value & LCDC_ENABLE and not on:
+        self._switch_on()
+      elif on and not value & LCDC_ENABLE:
+        self._switch_off()
+    elif offset == STAT_REG:
+      regs[STAT_REG] = regs[STAT_REG] & ~STAT_WRITABLE | value & STAT_WRITABLE
+      self._update_stat()
+    elif offset == LYC_REG:
+      regs[LYC_REG] = value
+      self._update_stat()
+    elif offset != LY_REG:
+      regs[offset] = value
+
+  def reset(self):
+    """Start over from the registers, e.g. after they have been replaced: from the first
+    line if LCDC has the lcd on, else off.
+
+    """
+    self._switch_off()
+    if self.regs[LCDC_REG] & LCDC_ENABLE:
+      self._switch_on()
+
+  def _switch_on(self):
+    now = self._mmu.scheduler.now
+    # On from now, for the STAT interrupt conditions of the first line.
+    self._deadline = now
+    self._deadline = now + self._start_line(0)
+    self._schedule()
+
+  def _switch_off(self):
+    if self._event is not None:
+      self._mmu.scheduler.cancel(self._event)
+    self._deadline = None
+    self._rendering = False
+    self.line = 0
+    self.regs[LY_REG] = 0
+    self._set_mode(MODE_HBLANK)
+
+  def _schedule(self):
+    if self._event is None:
+      self._event = self._mmu.scheduler.schedule(self._deadline, self._next_mode)
+    else:
+      self._mmu.scheduler.reschedule(self._event, self._deadline)
+
+  def _next_mode(self, deadline):
+    """Event callback: move on to the next mode."""
+    mode = self.mode
+    if mode == MODE_OAM:
+      self._set_mode(MODE_TRANSFER)
+      delay = TRANSFER_CYCLES
+    elif mode == MODE_TRANSFER:
+      self._set_mode(MODE_HBLANK)
+      delay = HBLANK_CYCLES
+    else:
+      line = self.line + 1
+      delay = self._start_line(line if line < LINES else 0)
+    self._deadline = deadline + delay
+    self._schedule()
+
+  def _start_line(self, line):
+    """Start drawing line, returning the clock cycles until the next mode change."""
+    self.line = line
+    self.regs[LY_REG] = line
+    if line >= VISIBLE_LINES:
+      if line == VISIBLE_LINES:
+        self._end_frame()
+        self._mmu.request_interrupt(INT_VBLANK)
+      self._set_mode(MODE_VBLANK)
+      return LINE_CYCLES
+    if not line:
+      self._start_frame()
+    self._set_mode(MODE_OAM)
+    return OAM_CYCLES
+
+  def _set_mode(self, mode):
+    self.mode = mode
+    self._update_locks()
+    self._update_stat()
+
+  def _update_locks(self):
+    self._oam_lock.locked = self.mode >= MODE_OAM
+    self._vram_lock.locked = self.mode == MODE_TRANSFER
+
+  def _update_stat(self):
+    """Bring STAT up to date with the mode and LY, and raise the STAT interrupt if one of
+    its conditions has started to hold.
+
+    """
+    regs = self.regs
+    stat = regs[STAT_REG] & STAT_WRITABLE
+    if self.line == regs[LYC_REG]:
+      stat |= STAT_COINCIDENCE
+    regs[STAT_REG] = 0x80 | stat | self.mode
+    line = (self._deadline is not None and
+            bool(stat & (_MODE_SOURCES[self.mode] |
+                         (STAT_LYC if stat & STAT_COINCIDENCE else 0))))
+    if line and not self._stat_line:
+      self._mmu.request_interrupt(INT_STAT)
+    self._stat_line = line
+
+  def _start_frame(self):
+    self._rendering = self._requested or bool(
+      self.render_every and not self.frames % self.render_every)
+    self._requested = False
+    self._drawn = 0
+    if self._rendering:
+      self._renderer()
+
+  def _end_frame(self):
+    self.frames += 1
+    if not self._rendering:
+      return
+    self._draw_lines(VISIBLE_LINES)
+    self._rendering = False
+    self.frames_rendered += 1
+    if self.on_frame is not None:
+      self.on_frame(self.renderer.frame)
+
+  def _lines_done(self):
+    """The lines of the current frame the lcd has finished transferring."""
+    if self.mode == MODE_VBLANK:
+      return VISIBLE_LINES
+    return self.line + (self.mode != MODE_OAM)
+
+  def _draw_lines(self, end):
+    """Draw the lines of the frame not drawn yet before end."""
+    if end > self._drawn:
+      self.renderer.render_lines(self._drawn, end)
+      self._drawn = end
+
+  def fork(self):
+    """Return a copy of the lcd for a forked machine, which carries on from the same point
+    of the same frame once attached to the new mmu. The copy only draws from the next
+    frame, and doesn't have on_frame set.
+
+    """
+    lcd = Lcd(self.render_every, self.restrict_access)
+    lcd.frames = self.frames
+    lcd.frames_rendered = self.frames_rendered
+    lcd.line = self.line
+    lcd.mode = self.mode
+    lcd._deadline = self._deadline
+    lcd._stat_line = self._stat_line
+    lcd._requested = self._requested
+    return lcd
+
+  def save_state(self):
+    """Return the line, mode and timing of the lcd as a save state blob (see gb.state).
+    The registers are saved with the rest of the io registers.
+
+    """
+    state = StateWriter(STATE_MAGIC, STATE_VERSION)
+    deadline = self._deadline
+    state.pack('BBBQQ', self.line, self.mode, self._stat_line,
+               deadline + 1 if deadline is not None else 0, self.frames)
+    return state.value()
+
+  def load_state(self, data):
+    """Restore a blob from save_state, once the registers have been restored."""
+    state = StateReader(data, STATE_MAGIC, STATE_VERSION)
+    self.line, self.mode, stat_line, deadline, self.frames = state.unpack('BBBQQ')
+    self._stat_line = bool(stat_line)
+    if self._event is not None:
+      self._mmu.scheduler.cancel(self._event)
+    self._deadline = deadline - 1 if deadline else None
+    self._rendering = False
+    if self._mmu is not None:
+      self._update_locks()
+      if self._deadline is not None:
+        self._schedule()
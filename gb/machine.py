@@ -0,0 +1,99 @@
+from gb.cartridge import *
+from gb.cpu import Cpu
+from gb.io import BGP_REG, IO_SIZE, LCDC_REG
+from gb.mem import DummyMem
+from gb.mmu import Mmu
+from gb.state import StateReader, StateWriter
+
+# Save state header.
+STATE_MAGIC = b'GBMA'
+STATE_VERSION = 1
+
+# Sizes of the memory devices a Machine creates. Oam is 0xA0 bytes, but the rest of its
+# page (0xFEA0-0xFEFF, which is unusable) is backed too, so that code touching it, e.g.
+# clearing oam with a loop that runs on to 0xFEFF, doesn't fail.
+VRAM_SIZE = 0x2000
+OAM_SIZE = 0x100
+
+# Register values the bios leaves behind, for starting without one.
+POST_BIOS_REGISTERS = {'af': 0x01B0, 'bc': 0x0013, 'de': 0x00D8, 'hl': 0x014D}
+# And io register values, by offset: the lcd on, showing the background.
+POST_BIOS_IO = {LCDC_REG: 0x91, BGP_REG: 0xFC}
+
+
+class Machine(object):
+  """A whole machine: a Cpu and its Mmu, with plain memory for vram, oam and the io
+  registers, and a cartridge.
+
+  Pass an io device (e.g. a gb.io.IoRegisters, for input and serial output) to use it in
+  place of the plain io registers.
+
+  Without a bios, the machine starts in the state the bios would leave it in, at 0x100.
+
+  """
+
+  def __init__(self, cartridge=None, bios=None, io=None):
+    self.mmu = Mmu(bios if bios is not None else DummyMem(), bytearray(VRAM_SIZE),
+                   bytearray(OAM_SIZE), io if io is not None else bytearray(IO_SIZE))
+    if cartridge is not None:
+      self.mmu.load_cartridge(cartridge)
+    self.cpu = Cpu(self.mmu)
+    if bios is None:
+      self.skip_bios()
+
+  @classmethod
+  def from_rom_file(cls, path, bios=None, io=None):
+    return cls(load_rom_from_file(path), bios, io)
+
+  @property
+  def cartridge(self):
+    return self.mmu.cartridge
+
+  @property
+  def io(self):
+    return self.mmu.io
+
+  def skip_bios(self):
+    """Unmap the bios and set up the registers as it would have left them."""
+    self.mmu.in_bios = False
+    for pair, value in POST_BIOS_REGISTERS.items():
+      setattr(self.cpu, pair, value)
+    self.cpu.sp = 0xFFFE
+    self.cpu.pc = 0x0100
+    for offset, value in POST_BIOS_IO.items():
+      self.mmu[0xFF00 + offset] = value
+
+  def run(self, max_cycles):
+    """Run for at least max_cycles clock cycles, see Cpu.run."""
+    return self.cpu.run(max_cycles)
+
+  def fork(self):
+    """Return a new machine in the same state as this one, which then runs independently of
+    it. The rom is shared and the rest of memory is shared copy-on-write (see Mmu.fork), so
+    forking costs little, and each machine only pays for the pages it writes afterwards.
+    Translated code for the rom is shared too.
+
+    """
+    machine = type(self).__new__(type(self))
+    machine.mmu = self.mmu.fork()
+    machine.cpu = Cpu(machine.mmu)
+    machine.cpu.load_state(self.cpu.save_state())
+    return machine
+
+  def save_state(self, memory=True):
+    """Return the state of the whole machine as a save state blob (see gb.state). The
+    cartridge rom and the bios aren't included, so the state has to be loaded into a
+    machine with the same ones. If memory is false, the buffers returned by
+    Mmu.memory_regions are left out too.
+
+    """
+    state = StateWriter(STATE_MAGIC, STATE_VERSION)
+    state.section(self.cpu.save_state())
+    state.section(self.mmu.save_state(memory))
+    return state.value()
+
+  def load_state(self, data):
+    state = StateReader(data, STATE_MAGIC, STATE_VERSION)
+    cpu = state.section()
+    self.mmu.load_state(state.section())
+    self.cpu.load_state(cpu)
@@ -1,16 +1,81 @@
+import mmap
+import os
+import weakref
+
+BANK_SIZE = 0x4000
+
+# One bank of zeros, shared by every rom bank that isn't present in the rom image.
+ZERO_BANK = memoryview(bytes(BANK_SIZE))
+
+
 class DummyMem(object):
   def __getitem__(self,addr):
     return 0
-  def __setitem(self,addr,value):
+  def __setitem__(self,addr,value):
     pass
 
 
-class Rom(DummyMem):
+class RomImage(object):
+  """Read-only rom image. The image is held as a single memoryview, over the bytes it was
+  constructed with or over a read-only mmap of the rom file, and banks are handed out as
+  slices of it, so nothing is copied. Mapping the file also means that every emulator
+  opening the same rom shares the same physical pages.
+
+  """
+
+  # Images opened from files, so that opening the same rom again reuses the mapping.
+  _open_files = weakref.WeakValueDictionary()
+
   def __init__(self, data=b''):
-    self.data = bytearray(data)
-    if len(self.data) < 0x4000:
-      self.data += bytearray([0x0]) * (0x4000 - len(self.data))
-    assert len(self.data) == 0x4000
+    # Keep a reference to the underlying object so an mmap stays open.
+    self.source = data
+    self.data = memoryview(data).cast('B')
+
+  @classmethod
+  def from_file(cls, path):
+    """Open the rom at path, mapping it into memory rather than reading it."""
+    st = os.stat(path)
+    key = (os.path.realpath(path), st.st_size, st.st_mtime)
+    image = cls._open_files.get(key)
+    if image is None:
+      if not st.st_size:
+        # mmap refuses to map empty files.
+        image = cls()
+      else:
+        with open(path, "rb") as f:
+          image = cls(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+      cls._open_files[key] = image
+    return image
+
+  def __len__(self):
+    return len(self.data)
+
+  def __getitem__(self, addr):
+    return self.data[addr]
+
+  @property
+  def num_banks(self):
+    return (len(self.data) + BANK_SIZE - 1) // BANK_SIZE
+
+  def bank(self, i):
+    """Return bank i as a BANK_SIZE long view. Banks past the end of the image are
+    ZERO_BANK, and only a partial last bank is padded by copying.
+
+    """
+    data = self.data[i * BANK_SIZE:(i + 1) * BANK_SIZE]
+    if len(data) == BANK_SIZE:
+      return data
+    if not len(data):
+      return ZERO_BANK
+    return memoryview(bytes(data) + bytes(BANK_SIZE - len(data)))
+
+
+class Rom(DummyMem):
+  def __init__(self, data=ZERO_BANK):
+    self.data = memoryview(data)
+    if len(self.data) < BANK_SIZE:
+      self.data = memoryview(bytes(self.data) + bytes(BANK_SIZE - len(self.data)))
+    assert len(self.data) == BANK_SIZE
 
   def __getitem__(self, addr):
     return self.data[addr]
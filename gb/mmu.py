@@ -1,9 +1,307 @@
 from gb.mem import *
 from gb.cartridge import *
+from gb.scheduler import Scheduler
+from gb.state import StateError, StateReader, StateWriter
+
+# The address space is translated in 256 byte pages, indexed by the high byte of the
+# address.
+PAGE_SHIFT = 8
+PAGE_SIZE = 1 << PAGE_SHIFT
+PAGE_MASK = PAGE_SIZE - 1
+NUM_PAGES = 0x10000 >> PAGE_SHIFT
+
+# Offset of the oam dma register in the io registers, and the size of a dma transfer.
+DMA_REG = 0x46
+DMA_LENGTH = 0xA0
+
+# Save state header.
+STATE_MAGIC = b'GBMU'
+STATE_VERSION = 1
+
+# Offsets in page 0xFF of the interrupt flag (IF) and interrupt enable (IE) registers.
+IF_REG = 0x0F
+IE_REG = 0xFF
+
+# Interrupt bits, in IF and IE. Lower bits have priority.
+INT_VBLANK = 0x01
+INT_STAT = 0x02
+INT_TIMER = 0x04
+INT_SERIAL = 0x08
+INT_JOYPAD = 0x10
+INT_MASK = 0x1F
+
+# The pages each of the mmu's own buffers is mapped at, as (first, last) ranges.
+BUFFER_PAGES = (
+  ('vram', ((0x80, 0x9F),)),
+  # The second range is the echo of wram.
+  ('wram', ((0xC0, 0xDF), (0xE0, 0xFD))),
+  ('oam', ((0xFE, 0xFE),)),
+)
+_BUFFER_RANGES = dict(BUFFER_PAGES)
+
+
+def _save_device(state, device):
+  """Add a section for device to state: the device itself if it is a bytearray, or its own
+  save state blob if it has a save_state method, or else nothing.
+
+  """
+  if isinstance(device, bytearray):
+    state.section(device)
+  elif hasattr(device, 'save_state'):
+    state.section(device.save_state())
+  else:
+    state.section(b'')
+
+
+def _load_device(state, device):
+  """Restore device from the next section of state, written by _save_device."""
+  if isinstance(device, bytearray):
+    state.buffer(device)
+  elif hasattr(device, 'load_state'):
+    device.load_state(state.section())
+  elif len(state.section()):
+    raise StateError("Save state has data for a device that can't load it.")
+
+
+def _fork_device(device):
+  """Return the device a fork of the mmu uses in place of device: a fork of it, if it
+  has a fork method, or else the device itself.
+
+  """
+  if hasattr(device, 'fork'):
+    return device.fork()
+  return device
+
+
+class _DevicePage(object):
+  """Page handler which forwards accesses to a device, offset by a fixed base address.
+  Used for devices that don't expose a buffer which can be indexed directly.
+
+  """
+  __slots__ = ('device', 'base')
+
+  def __init__(self, device, base):
+    self.device = device
+    self.base = base
+
+  def __getitem__(self, offset):
+    return self.device[self.base + offset]
+
+  def __setitem__(self, offset, value):
+    self.device[self.base + offset] = value
+
+
+class _BiosExitPage(_DevicePage):
+  """Handler for page 0x01 while the bios is mapped. Touching 0x0100 unmaps the bios, all
+  other accesses go straight to the cartridge.
+
+  """
+  __slots__ = ('mmu',)
+
+  def __init__(self, mmu, device, base):
+    super(_BiosExitPage, self).__init__(device, base)
+    self.mmu = mmu
+
+  def __getitem__(self, offset):
+    if not offset:
+      self.mmu.in_bios = False
+    return self.device[self.base + offset]
+
+  def __setitem__(self, offset, value):
+    if not offset:
+      self.mmu.in_bios = False
+    self.device[self.base + offset] = value
+
+
+class _HighPage(object):
+  """Handler for page 0xFF, which is split between the io registers (0xFF00-0xFF7F) and
+  zram (0xFF80-0xFFFF). Writing the DMA register starts an oam dma transfer. The
+  interrupt flag register is kept by the mmu rather than the io device, and writes to it
+  or to the interrupt enable register let the cpu know to check for interrupts.
+
+  """
+  __slots__ = ('mmu', 'io', 'zram')
+
+  def __init__(self, mmu, io, zram):
+    self.mmu = mmu
+    self.io = io
+    self.zram = zram
+
+  def __getitem__(self, offset):
+    if offset < 0x80:
+      if offset == IF_REG:
+        return 0xE0 | self.mmu.interrupt_flag
+      return self.io[offset]
+    return self.zram[offset - 0x80]
+
+  def __setitem__(self, offset, value):
+    if offset < 0x80:
+      if offset == IF_REG:
+        self.mmu.interrupt_flag = value & INT_MASK
+        self.mmu.interrupts_changed()
+        return
+      self.io[offset] = value
+      if offset == DMA_REG:
+        self.mmu.dma(value)
+    else:
+      self.zram[offset - 0x80] = value
+      if offset == IE_REG:
+        self.mmu.interrupts_changed()
+
+
+class _WriteTrap(object):
+  """Write handler put over a page by Mmu.trap_writes. The first write to the page calls
+  the trap callbacks and puts the original handler back, before carrying out the write.
+
+  """
+  __slots__ = ('mmu', 'page', 'handler', 'span')
+
+  def __init__(self, mmu, page, handler, span):
+    self.mmu = mmu
+    self.page = page
+    self.handler = handler
+    self.span = span
+
+  def __setitem__(self, offset, value):
+    self.mmu._spring_traps(self.page)
+    self.handler[offset] = value
+
+
+class _ReadWatch(object):
+  """Read handler put over a page by Mmu.watch. Reads of the watched offsets of the page
+  call their callbacks with (address, value read, False).
+
+  """
+  __slots__ = ('page', 'handler', 'span', 'callbacks')
+
+  def __init__(self, page, handler, span, callbacks):
+    self.page = page
+    self.handler = handler
+    self.span = span
+    # Callbacks by offset, shared with the mmu's table of watches, see Mmu.watch.
+    self.callbacks = callbacks
+
+  def __getitem__(self, offset):
+    value = self.handler[offset]
+    callbacks = self.callbacks.get(offset)
+    if callbacks:
+      addr = self.page << PAGE_SHIFT | offset
+      for callback in list(callbacks):
+        callback(addr, value, False)
+    return value
+
+
+class _WriteWatch(object):
+  """Write handler put over a page by Mmu.watch. Writes to the watched offsets of the page
+  call their callbacks with (address, value written, True), after carrying out the write.
+
+  """
+  __slots__ = ('page', 'handler', 'span', 'callbacks')
+
+  def __init__(self, page, handler, span, callbacks):
+    self.page = page
+    self.handler = handler
+    self.span = span
+    self.callbacks = callbacks
+
+  def __setitem__(self, offset, value):
+    self.handler[offset] = value
+    callbacks = self.callbacks.get(offset)
+    if callbacks:
+      addr = self.page << PAGE_SHIFT | offset
+      for callback in list(callbacks):
+        callback(addr, value, True)
+
+
+class _CopyOnWrite(object):
+  """Write handler for the page at offset in the buffer name, while the page is shared
+  with a fork. The first write copies just that page (see Mmu._copy_page), which replaces
+  the shared one wherever it is mapped, before carrying out the write.
+
+  """
+  __slots__ = ('mmu', 'name', 'offset')
+
+  def __init__(self, mmu, name, offset):
+    self.mmu = mmu
+    self.name = name
+    self.offset = offset
+
+  def __setitem__(self, offset, value):
+    # Write to the copy directly, rather than through the new handlers of the page, which
+    # may be watched: this is already being called through the watch.
+    self.mmu._copy_page(self.name, self.offset)[offset] = value
+
+
+class PageLock(object):
+  """Switch for pages locked with Mmu.lock: while locked is true, reads of them return
+  0xFF and writes to them are dropped. Flipping it costs nothing, however many pages it
+  locks.
+
+  """
+  __slots__ = ('locked',)
+
+  def __init__(self, locked=False):
+    self.locked = locked
+
+
+class _Locked(object):
+  """Read or write handler put under any traps and watches of a page by Mmu.lock."""
+  __slots__ = ('lock', 'handler', 'span')
+
+  def __init__(self, lock, handler, span):
+    self.lock = lock
+    self.handler = handler
+    self.span = span
+
+  def __getitem__(self, offset):
+    if self.lock.locked:
+      return 0xFF
+    return self.handler[offset]
+
+  def __setitem__(self, offset, value):
+    if not self.lock.locked:
+      self.handler[offset] = value
+
+
+# Handlers which wrap another handler of a page, see Mmu._innermost.
+_WRAPPERS = (_WriteTrap, _ReadWatch, _WriteWatch, _Locked)
+
+
+def _buffer_property(name):
+  """Make a property for the buffer name (wram, vram or oam). If the buffer is shared with
+  a fork, getting it first gathers its pages into a buffer of the mmu's own, since the
+  caller may write to it. Reading it without unsharing it is done with Mmu.contents.
+
+  """
+  attr = '_' + name
+
+  def fget(self):
+    if name in self._shared:
+      self._unshare(name)
+    return getattr(self, attr)
+
+  def fset(self, value):
+    self._shared.pop(name, None)
+    self._cow_handlers.pop(name, None)
+    setattr(self, attr, value)
+
+  return property(fget, fset)
 
 
 class Mmu(object):
+
+  wram = _buffer_property('wram')
+  vram = _buffer_property('vram')
+  oam = _buffer_property('oam')
+
   def __init__(self, bios, vram, oam, io):
+    # For each buffer whose pages are shared copy-on-write with a fork, by name, the
+    # offsets of the pages copied since it was last shared.
+    self._shared = {}
+    # The _CopyOnWrite handlers for the pages of each buffer, by name, made the first time
+    # it is shared.
+    self._cow_handlers = {}
+
     self.wram = bytearray(0xE000 - 0xC000)
     self.zram = bytearray(0x10000 - 0xFF80)
 
@@ -13,10 +311,499 @@ class Mmu(object):
     self.io = io
 
     self.cartridge = Cartridge()
+    self.cartridge.add_mapping_listener(self._remap_cartridge)
+
+    # Timeline for peripheral events, driven by the cpu.
+    self.scheduler = Scheduler()
+
+    # Page tables, holding one handler per 256 byte page. A handler is anything indexable
+    # by the low byte of the address: a memoryview into one of our buffers, or a small
+    # adapter object for devices. These lists are updated in place, so it is safe to hold
+    # on to a reference to them.
+    self._read_pages = [None] * NUM_PAGES
+    self._write_pages = [None] * NUM_PAGES
+    # For each page, (buffer view, offset of the page in the buffer) if the page is backed
+    # by a buffer, else None. Used to turn block accesses into slice operations.
+    self._read_spans = [None] * NUM_PAGES
+    self._write_spans = [None] * NUM_PAGES
+    # For each buffer backed page, the (device, device address) the page starts at.
+    self._read_sources = [None] * NUM_PAGES
+    self._write_sources = [None] * NUM_PAGES
+    # Callbacks waiting for the next write to each page, see trap_writes.
+    self._write_traps = {}
+    # Callbacks watching reads and writes of addresses, by page and then offset, see watch.
+    self._read_watches = {}
+    self._write_watches = {}
+    # The PageLock of each locked page, see lock.
+    self._locks = {}
+    # Pages writing to each (id(device), offset), built when needed by _pages_writing and
+    # dropped whenever writes are remapped.
+    self._writers = None
+    # Called with (first, last) after the read mapping of pages first to last changes.
+    self._remap_listeners = []
+
+    # Requested interrupts (the IF register at 0xFF0F). The enable register, IE, is the
+    # last byte of zram.
+    self.interrupt_flag = 0
+    # Called when IF or IE change, so the cpu can stop and check for interrupts.
+    self.on_interrupts_changed = None
+
+    # (cartridge, rom0, romx, ram, in_bios) as of the last _remap_cartridge.
+    self._cartridge_mapping = None
+    self._in_bios = True
+    self.remap()
+
+    # Devices that need the mmu (e.g. to schedule events or raise interrupts) get it
+    # through an attach method.
+    for device in (bios, vram, oam, io):
+      if hasattr(device, 'attach'):
+        device.attach(self)
+
+  @property
+  def in_bios(self):
+    return self._in_bios
+
+  @in_bios.setter
+  def in_bios(self, value):
+    self._in_bios = value
+    self._remap_cartridge()
+
+  @property
+  def interrupt_enable(self):
+    return self.zram[IE_REG - 0x80]
+
+  def request_interrupt(self, mask):
+    """Raise the interrupts in mask (a combination of the INT_* bits). Devices call this,
+    typically from a scheduled event.
+
+    """
+    self.interrupt_flag |= mask & INT_MASK
+    self.interrupts_changed()
+
+  def interrupts_changed(self):
+    if self.on_interrupts_changed is not None:
+      self.on_interrupts_changed()
+
+  @property
+  def read_pages(self):
+    """The read page table: memory can be read as read_pages[addr >> 8][addr & 0xFF].
+    Hot loops can hold on to this to save the method call of __getitem__.
+
+    """
+    return self._read_pages
+
+  def _map_pages(self, pages, spans, sources, first, last, device, base, buffer_types):
+    offsets = range(base, base + ((last + 1 - first) << PAGE_SHIFT), PAGE_SIZE)
+    if isinstance(device, buffer_types):
+      view = memoryview(device)
+      pages[first:last + 1] = [view[offset:offset + PAGE_SIZE] for offset in offsets]
+      spans[first:last + 1] = [(view, offset) for offset in offsets]
+      sources[first:last + 1] = [(device, offset) for offset in offsets]
+    else:
+      pages[first:last + 1] = [_DevicePage(device, offset) for offset in offsets]
+      spans[first:last + 1] = sources[first:last + 1] = [None] * len(offsets)
+
+  def _map_read(self, first, last, device, base):
+    """Map reads from pages first through last (inclusive) to device, starting at device
+    address base. Bytearrays and memoryviews are mapped with memoryviews, so reads from
+    them never go through python code. Anything else gets a _DevicePage.
+
+    """
+    self._map_pages(self._read_pages, self._read_spans, self._read_sources, first, last,
+                    device, base, (bytearray, memoryview))
+    self._reinstall_locks(self._read_pages, self._read_spans, first, last)
+    self._reinstall_watches(self._read_watches, self._install_read_watch, first, last)
+    self._remapped(first, last)
+
+  def _map_write(self, first, last, device, base):
+    """Map writes to pages first through last (inclusive) to device. Same as _map_read,
+    except that memoryviews are assumed to be read-only and go through a _DevicePage.
+
+    """
+    self._map_pages(self._write_pages, self._write_spans, self._write_sources, first, last,
+                    device, base, bytearray)
+    self._writers = None
+    self._reinstall_locks(self._write_pages, self._write_spans, first, last)
+    self._reinstall_watches(self._write_watches, self._install_write_watch, first, last)
+    self._reinstall_traps(first, last)
+
+  def _map(self, first, last, device, base):
+    self._map_read(first, last, device, base)
+    self._map_write(first, last, device, base)
+
+  def _map_handler(self, page, handler):
+    """Map reads and writes of page to handler, a page adapter object."""
+    self._read_pages[page] = self._write_pages[page] = handler
+    self._read_spans[page] = self._write_spans[page] = None
+    self._read_sources[page] = self._write_sources[page] = None
+    self._writers = None
+    self._reinstall_locks(self._read_pages, self._read_spans, page, page)
+    self._reinstall_locks(self._write_pages, self._write_spans, page, page)
+    self._reinstall_watches(self._read_watches, self._install_read_watch, page, page)
+    self._remapped(page, page)
+    self._reinstall_watches(self._write_watches, self._install_write_watch, page, page)
+    self._reinstall_traps(page, page)
 
-    self.in_bios = True
+  def add_remap_listener(self, listener):
+    """Register listener to be called with (first, last) whenever the reads of pages
+    first through last (inclusive) are remapped, e.g. on a cartridge bank switch.
+
+    """
+    self._remap_listeners.append(listener)
+
+  def remove_remap_listener(self, listener):
+    self._remap_listeners = [l for l in self._remap_listeners if l != listener]
+
+  def _remapped(self, first, last):
+    for listener in self._remap_listeners:
+      listener(first, last)
+
+  def page_source(self, page):
+    """Return (buffer, offset) if reads from page come straight from offset in buffer,
+    else None. The buffer is the object that was mapped (e.g. wram, or a rom bank), so it
+    identifies the memory behind the page even when it is mapped in several places.
+    Locked pages (see lock) have no source, since their reads may be locked out.
+
+    """
+    if page in self._locks:
+      return None
+    return self._read_sources[page]
+
+  def trap_writes(self, page, callback):
+    """Call callback(page) once, just before the next write to the memory read from page.
+    If that memory is also mapped elsewhere (e.g. echo ram), writes through any of its
+    pages spring the trap, and callback gets the page actually written.
+
+    Traps work by swapping in a _WriteTrap write handler, so pages which aren't trapped
+    don't pay anything for them. Note that writes straight into the buffers, bypassing
+    the mmu, don't spring traps.
+
+    """
+    source = self._read_sources[page]
+    for other in [page] if source is None else self._pages_writing(source):
+      callbacks = self._write_traps.setdefault(other, [])
+      if callback not in callbacks:
+        callbacks.append(callback)
+      self._install_trap(other)
+
+  def _pages_writing(self, source):
+    """Return the pages whose writes go to source, a (device, offset) pair."""
+    writers = self._writers
+    if writers is None:
+      writers = self._writers = {}
+      for page, written in enumerate(self._write_sources):
+        if written is not None:
+          writers.setdefault((id(written[0]), written[1]), []).append(page)
+    device, offset = source
+    return writers.get((id(device), offset), ())
+
+  def _install_trap(self, page):
+    handler = self._write_pages[page]
+    if not isinstance(handler, _WriteTrap):
+      self._write_pages[page] = _WriteTrap(self, page, handler, self._write_spans[page])
+      self._write_spans[page] = None
+
+  def _reinstall_traps(self, first, last):
+    """Put traps back over pages first through last after they have been remapped."""
+    for page in self._write_traps:
+      if first <= page <= last:
+        self._install_trap(page)
+
+  def _remove_trap(self, page):
+    handler = self._write_pages[page]
+    if isinstance(handler, _WriteTrap):
+      self._write_pages[page] = handler.handler
+      self._write_spans[page] = handler.span
+    return self._write_traps.pop(page, ())
+
+  def _spring_traps(self, page):
+    source = self._write_sources[page]
+    callbacks = self._remove_trap(page)
+    # Each callback is only called once per write, so take it off any aliases of the page
+    # too.
+    for other in () if source is None else self._pages_writing(source):
+      waiting = self._write_traps.get(other)
+      if waiting is not None:
+        waiting[:] = [callback for callback in waiting if callback not in callbacks]
+        if not waiting:
+          self._remove_trap(other)
+    for callback in callbacks:
+      callback(page)
+
+  def spring_all_traps(self):
+    """Spring every pending write trap, e.g. after writing to the buffers directly."""
+    for page in list(self._write_traps):
+      self._spring_traps(page)
+
+  def watch(self, addr, callback, reads=False, writes=True):
+    """Call callback(addr, value, is_write) on every read of addr, if reads is true, and
+    every write to it, if writes is true, until unwatch is called. Write callbacks are
+    called after the write.
+
+    Like traps, watches work by swapping in a watching handler over just the pages
+    watched, so the rest of memory is accessed as fast as ever. Block reads and writes
+    (read_block, write_block, dma) see them too. Note that fetching instructions reads
+    memory, so reads of code are seen. Unlike traps, watches are on addresses rather than
+    the memory behind them, so accesses through another mapping of it (e.g. echo ram)
+    aren't seen unless that address is watched too.
+
+    """
+    page = addr >> PAGE_SHIFT
+    for enabled, watches, install in (
+        (reads, self._read_watches, self._install_read_watch),
+        (writes, self._write_watches, self._install_write_watch)):
+      if enabled:
+        callbacks = watches.setdefault(page, {}).setdefault(addr & PAGE_MASK, [])
+        if callback not in callbacks:
+          callbacks.append(callback)
+        install(page)
+
+  @property
+  def reads_watched(self):
+    """Whether any address has its reads watched, see watch."""
+    return bool(self._read_watches)
+
+  def unwatch(self, addr, callback):
+    """Stop calling callback for accesses to addr, see watch."""
+    page = addr >> PAGE_SHIFT
+    for watches, remove in ((self._read_watches, self._remove_read_watch),
+                            (self._write_watches, self._remove_write_watch)):
+      offsets = watches.get(page)
+      callbacks = offsets.get(addr & PAGE_MASK) if offsets is not None else None
+      if callbacks is None or callback not in callbacks:
+        continue
+      callbacks.remove(callback)
+      if not callbacks:
+        del offsets[addr & PAGE_MASK]
+      if not offsets:
+        del watches[page]
+        remove(page)
+
+  def _reinstall_watches(self, watches, install, first, last):
+    """Put watches back over pages first through last after they have been remapped."""
+    for page in watches:
+      if first <= page <= last:
+        install(page)
+
+  def _install_read_watch(self, page):
+    handler = self._read_pages[page]
+    if not isinstance(handler, _ReadWatch):
+      self._read_pages[page] = _ReadWatch(page, handler, self._read_spans[page],
+                                          self._read_watches[page])
+      self._read_spans[page] = None
+
+  def _remove_read_watch(self, page):
+    handler = self._read_pages[page]
+    if isinstance(handler, _ReadWatch):
+      self._read_pages[page] = handler.handler
+      self._read_spans[page] = handler.span
+
+  def _install_write_watch(self, page):
+    # Watches go under any trap, which is only there until the next write.
+    handler = self._write_pages[page]
+    trap = handler if isinstance(handler, _WriteTrap) else None
+    if trap is not None:
+      handler = trap.handler
+    if isinstance(handler, _WriteWatch):
+      return
+    span = trap.span if trap is not None else self._write_spans[page]
+    handler = _WriteWatch(page, handler, span, self._write_watches[page])
+    if trap is not None:
+      trap.handler = handler
+      trap.span = None
+    else:
+      self._write_pages[page] = handler
+      self._write_spans[page] = None
+
+  def _remove_write_watch(self, page):
+    handler = self._write_pages[page]
+    trap = handler if isinstance(handler, _WriteTrap) else None
+    if trap is not None:
+      handler = trap.handler
+    if not isinstance(handler, _WriteWatch):
+      return
+    if trap is not None:
+      trap.handler = handler.handler
+      trap.span = handler.span
+    else:
+      self._write_pages[page] = handler.handler
+      self._write_spans[page] = handler.span
+
+  def lock(self, first, last, lock):
+    """Lock pages first through last (inclusive) with lock, a PageLock: whenever it is
+    locked, reads of the pages return 0xFF and writes to them are dropped, as for vram and
+    oam while the lcd is using them. Locking pages makes every access to them go through a
+    handler, so only lock pages which do need it, but locking and unlocking them then only
+    flips lock.locked.
+
+    Locks go under any traps and watches, which still see the accesses. Block reads and
+    writes see locks too. Locked pages have no page_source, so code on them is always
+    interpreted (see gb.blocks), and fetched through the lock like any other read.
+
+    """
+    locks = self._locks
+    for pages, spans in ((self._read_pages, self._read_spans),
+                         (self._write_pages, self._write_spans)):
+      for page in range(first, last + 1):
+        if page in locks:
+          self._remove_lock(pages, spans, page)
+        self._install_lock(pages, spans, page, lock)
+    for page in range(first, last + 1):
+      locks[page] = lock
+    self._remapped(first, last)
+
+  def unlock(self, first, last):
+    """Take the locks off pages first through last, see lock."""
+    for page in range(first, last + 1):
+      if self._locks.pop(page, None) is not None:
+        self._remove_lock(self._read_pages, self._read_spans, page)
+        self._remove_lock(self._write_pages, self._write_spans, page)
+    self._remapped(first, last)
+
+  def _reinstall_locks(self, pages, spans, first, last):
+    """Put locks back under the traps and watches of pages first through last, in the
+    page table pages, after they have been remapped.
+
+    """
+    locks = self._locks
+    if not locks:
+      return
+    for page in range(first, last + 1):
+      lock = locks.get(page)
+      if lock is not None:
+        self._install_lock(pages, spans, page, lock)
+
+  def _install_lock(self, pages, spans, page, lock):
+    handler = pages[page]
+    if not isinstance(handler, _WRAPPERS):
+      pages[page] = _Locked(lock, handler, spans[page])
+      spans[page] = None
+      return
+    # Under traps and watches.
+    wrapper, handler = self._innermost(pages, page)
+    if not isinstance(wrapper, _Locked):
+      wrapper.handler = _Locked(lock, handler, wrapper.span)
+      wrapper.span = None
+
+  def _remove_lock(self, pages, spans, page):
+    outer = None
+    handler = pages[page]
+    while isinstance(handler, _WRAPPERS) and not isinstance(handler, _Locked):
+      outer, handler = handler, handler.handler
+    if not isinstance(handler, _Locked):
+      return
+    if outer is not None:
+      outer.handler = handler.handler
+      outer.span = handler.span
+    else:
+      pages[page] = handler.handler
+      spans[page] = handler.span
+
+  @staticmethod
+  def _innermost(pages, page):
+    """Return (wrapper, handler), where handler is the handler of page in the page table
+    pages under any trap, watch and lock, and wrapper is the innermost of those over it,
+    or None.
+
+    """
+    wrapper = None
+    handler = pages[page]
+    while isinstance(handler, _WRAPPERS):
+      wrapper, handler = handler, handler.handler
+    return wrapper, handler
+
+  def _base_write_handler(self, page):
+    """Return (wrapper, handler), where handler is the write handler of page under any
+    trap, watch and lock, and wrapper is the innermost of those over it, or None.
+
+    """
+    return self._innermost(self._write_pages, page)
+
+  def _remap_cartridge(self):
+    """Bring the cartridge pages up to date, using the banks the cartridge currently has
+    mapped where it exposes them. Registered as the cartridge's mapping listener, so this
+    runs on every bank switch. Only the regions whose bank (or cartridge) changed are
+    remapped.
+
+    """
+    cart = self.cartridge
+    rom0, romx, ram = cart.mapped_banks()
+    mapped = self._cartridge_mapping
+    self._cartridge_mapping = cart, rom0, romx, ram, self._in_bios
+    # Everything is remapped while the bios is (or just was) mapped over the first pages.
+    stale = mapped is None or self._in_bios or mapped[4]
+    new_cart = stale or cart is not mapped[0]
+
+    # Writes to rom always go to the cartridge, since they set its banking registers.
+    if new_cart:
+      self._map_write(0x00, 0x7F, cart, 0x0000)
+    if stale or rom0 is not mapped[1] or (rom0 is None and new_cart):
+      self._map_read(0x00, 0x3F, rom0 if rom0 is not None else cart, 0x0000)
+    if stale or romx is not mapped[2] or (romx is None and new_cart):
+      if romx is not None:
+        self._map_read(0x40, 0x7F, romx, 0x0000)
+      else:
+        self._map_read(0x40, 0x7F, cart, 0x4000)
+    # The bios sits over the first page until it is unmapped.
+    if self._in_bios:
+      self._map(0x00, 0x00, self.bios, 0x0000)
+      self._map_handler(0x01, _BiosExitPage(self, cart, 0x0100))
+
+    if stale or ram is not mapped[3] or (ram is None and new_cart):
+      if ram is not None:
+        self._map(0xA0, 0xBF, ram, 0x0000)
+      else:
+        # Cartridge ram lives at 0x8000 in the cartridge address space.
+        self._map(0xA0, 0xBF, cart, 0x8000)
+
+  def remap(self):
+    """Rebuild the page tables. This is done automatically when the bios is unmapped, when
+    the cartridge is changed and when it switches banks. It only needs to be called
+    manually after replacing one of the other devices.
+
+    """
+    self._cartridge_mapping = None
+    self._remap_cartridge()
+    for name, ranges in BUFFER_PAGES:
+      if name in self._shared:
+        self._remap_shared(name)
+        continue
+      device = getattr(self, '_' + name)
+      for first, last in ranges:
+        self._map(first, last, device, 0x0000)
+    # Page 0xFF is handled specially by _runs, since it is only half backed by a buffer.
+    self._map_handler(0xFF, _HighPage(self, self.io, self.zram))
+
+  def _remap_shared(self, name):
+    """Map the pages of the buffer name, which is shared with a fork, back to the memory
+    they were mapped to, shared or copied, and share them all again.
+
+    """
+    first, last = _BUFFER_RANGES[name][0]
+    sources = self._write_sources[first:last + 1]
+    for first, last in _BUFFER_RANGES[name]:
+      for page in range(first, last + 1):
+        device, offset = sources[page - first]
+        self._map(page, page, device, offset)
+    self._share(name)
+
+  def _buffer_addr(self, name, offset):
+    """Return (buffer, offset in it) holding offset of the buffer name: the buffer itself,
+    unless the page has been copied since the buffer was shared with a fork.
+
+    """
+    if name not in self._shared:
+      return getattr(self, '_' + name), offset
+    device, base = self._write_sources[_BUFFER_RANGES[name][0][0] + (offset >> PAGE_SHIFT)]
+    return device, base + (offset & PAGE_MASK)
 
   def addr_trans(self, addr):
+    """Translate addr to a (device, device address) pair. This is the slow, descriptive
+    version of the translation done by the page tables, and is not used when accessing
+    memory through the Mmu. Like accessing it through the Mmu, translating 0x0100 unmaps
+    the bios.
+
+    """
     if addr < 0x0000 or addr > 0xFFFF:
       raise KeyError("Invalid memory address")
 
@@ -38,22 +825,22 @@ class Mmu(object):
       return self.cartridge, addr
 
     if dig1 < 0xA000:
-      return self.vram, (addr - 0x8000)
+      return self._buffer_addr('vram', addr - 0x8000)
 
     if dig1 < 0xC000:
       return self.cartridge, (addr - 0xA000 + 0x8000)
 
-    if dig1 < 0xF000:
-      return self.wram, (addr - 0xC000)
+    if dig1 < 0xE000:
+      return self._buffer_addr('wram', addr - 0xC000)
 
     else:
       dig2 = addr & 0x0F00
 
-      if dig2 < 0xE00:
-        return self.wram, (addr - 0xF000)
+      if dig1 < 0xF000 or dig2 < 0xE00:
+        return self._buffer_addr('wram', addr - 0xE000)
 
       elif dig2 == 0xE00:
-        return self.oam, (addr - 0xFE00)
+        return self._buffer_addr('oam', addr - 0xFE00)
 
       else:
         if addr >= 0xFF80:
@@ -62,23 +849,371 @@ class Mmu(object):
           return self.io, (addr - 0xFF00)
 
   def __getitem__(self, addr):
-    device, device_addr = self.addr_trans(addr)
-    return device[device_addr]
+    # Note: for speed, addr is not range checked. Addresses above 0xFFFF raise an
+    # IndexError, but negative addresses wrap around to the top of memory.
+    return self._read_pages[addr >> PAGE_SHIFT][addr & PAGE_MASK]
 
   def __setitem__(self, addr, value):
-    self.addr_trans(addr)[addr] = value
+    self._write_pages[addr >> PAGE_SHIFT][addr & PAGE_MASK] = value
+
+  def _runs(self, spans, addr, n):
+    """Split the range [addr, addr + n) into runs. Yields (addr, length, view), where view
+    is a memoryview covering the whole run if it is backed by a single buffer, or None if
+    the run has to be accessed one byte at a time through the page tables.
+
+    """
+    if addr < 0 or n < 0 or addr + n > 0x10000:
+      raise KeyError("Invalid memory range")
+    end = addr + n
+    while addr < end:
+      page = addr >> PAGE_SHIFT
+      run_end = min(end, (page + 1) << PAGE_SHIFT)
+      span = spans[page]
+
+      if page == 0xFF:
+        # Only zram in the top page is sliced, io registers are always accessed per byte,
+        # as is zram while watched.
+        watches = self._read_watches if spans is self._read_spans else self._write_watches
+        if addr < 0xFF80 or page in watches:
+          run_end = min(end, 0xFF80)
+          yield addr, run_end - addr, None
+        else:
+          yield addr, run_end - addr, memoryview(self.zram)[addr - 0xFF80:run_end - 0xFF80]
+      elif span is None:
+        # Merge neighbouring unbuffered pages into one run.
+        while run_end < end and spans[run_end >> PAGE_SHIFT] is None and run_end < 0xFF00:
+          run_end = min(end, run_end + PAGE_SIZE)
+        yield addr, run_end - addr, None
+      else:
+        view, start = span
+        start += addr & PAGE_MASK
+        stop = start + run_end - addr
+        # Merge following pages which continue the same buffer.
+        while run_end < end:
+          following = spans[run_end >> PAGE_SHIFT]
+          if following is None or following[0].obj is not view.obj or following[1] != stop:
+            break
+          length = min(end - run_end, PAGE_SIZE)
+          run_end += length
+          stop += length
+        yield addr, run_end - addr, view[start:stop]
+      addr = run_end
+
+  def read_block(self, addr, n):
+    """Read n bytes starting at addr. If the whole range is backed by a single buffer, the
+    result is a memoryview of that buffer, so no data is copied (but note that it will
+    reflect later writes). Otherwise the bytes are gathered into a new bytearray.
+
+    """
+    runs = list(self._runs(self._read_spans, addr, n))
+    if len(runs) == 1 and runs[0][2] is not None:
+      return runs[0][2]
+
+    data = bytearray(n)
+    pos = 0
+    read_pages = self._read_pages
+    for run_addr, length, view in runs:
+      if view is not None:
+        data[pos:pos + length] = view
+      else:
+        for a in range(run_addr, run_addr + length):
+          data[pos + a - run_addr] = read_pages[a >> PAGE_SHIFT][a & PAGE_MASK]
+      pos += length
+    return data
+
+  def write_block(self, addr, data):
+    """Write the bytes-like object data to memory starting at addr. Buffer backed regions
+    are written with slice assignment, everything else is written a byte at a time, so
+    device side effects (e.g. cartridge bank switching) still happen.
+
+    """
+    data = memoryview(data)
+    pos = 0
+    write_pages = self._write_pages
+    for run_addr, length, view in self._runs(self._write_spans, addr, len(data)):
+      if view is not None:
+        view[:] = data[pos:pos + length]
+      else:
+        for a in range(run_addr, run_addr + length):
+          write_pages[a >> PAGE_SHIFT][a & PAGE_MASK] = data[pos + a - run_addr]
+      pos += length
+
+  def dma(self, src_page):
+    """Perform an oam dma transfer, copying 0xA0 bytes from src_page << 8 to oam."""
+    data = self.read_block(src_page << PAGE_SHIFT, DMA_LENGTH)
+    # The transfer gets into oam even while the lcd has it locked.
+    lock = self._locks.get(0xFE)
+    if lock is None or not lock.locked:
+      self.write_block(0xFE00, data)
+      return
+    lock.locked = False
+    try:
+      self.write_block(0xFE00, data)
+    finally:
+      lock.locked = True
 
   def reset(self):
-    self.wram.clear()
-    self.zram.clear()
+    """Zero wram, zram, the interrupt flags, vram and oam (if they are bytearrays) and the
+    cartridge ram.
+
+    """
+    # Zero in place rather than clearing: the page tables hold views of these buffers.
+    buffers = [self.zram]
+    for name, _ in BUFFER_PAGES:
+      device = getattr(self, '_' + name)
+      if not isinstance(device, bytearray):
+        continue
+      if name in self._shared:
+        # Rather than zeroing memory a fork shares.
+        self._replace_buffer(name, bytearray(len(device)))
+      else:
+        buffers.append(device)
+    buffers.extend(bank for _, bank in self.cartridge.memory_regions())
+    for buf in buffers:
+      buf[:] = bytearray(len(buf))
+    self.interrupt_flag = 0
+    # Memory changed underneath the page tables.
+    self.spring_all_traps()
+    self.interrupts_changed()
+
+  def save_state(self, memory=True):
+    """Return the contents of memory as a save state blob (see gb.state): wram, zram, the
+    interrupt flags, whether the bios is mapped, the vram, oam and io devices, and the
+    cartridge state. Devices which are bytearrays are saved as they are, other devices
+    are saved if they have a save_state method of their own.
+
+    If memory is false, the buffers returned by memory_regions are left out.
+
+    """
+    state = StateWriter(STATE_MAGIC, STATE_VERSION)
+    state.pack('?B', self._in_bios, self.interrupt_flag)
+    state.section(self.contents('wram') if memory else b'')
+    state.section(self.zram)
+    for name in ('vram', 'oam'):
+      if isinstance(getattr(self, '_' + name), bytearray):
+        state.section(self.contents(name) if memory else b'')
+      else:
+        _save_device(state, getattr(self, '_' + name))
+    _save_device(state, self.io)
+    state.section(self.cartridge.save_state(memory))
+    return state.value()
 
-    self.vram.clear()
-    self.oam.clear()
+  def memory_regions(self):
+    """Return the memory that save_state leaves out when memory is false, as a list of
+    (name, buffer, page ranges): wram, vram and oam if they are bytearrays, and the
+    cartridge's ram banks (see Cartridge.memory_regions). The page ranges are the
+    (first, last) pages the buffer is mapped at, or can be, in the case of cartridge ram.
 
-    self.cartridge.eram.clear()
+    Buffers shared with a fork are unshared first, so that they can be written to. Call
+    spring_all_traps after doing so.
+
+    """
+    regions = []
+    for name, ranges in BUFFER_PAGES:
+      device = getattr(self, name)
+      if isinstance(device, bytearray):
+        regions.append((name, device, ranges))
+    for name, bank in self.cartridge.memory_regions():
+      regions.append(('cartridge.' + name, bank, ((0xA0, 0xBF),)))
+    return regions
+
+  def load_state(self, data):
+    """Restore a blob from save_state, into the same kinds of devices and cartridge it
+    was saved from. Buffers are restored in place, so the page tables stay valid.
+
+    """
+    state = StateReader(data, STATE_MAGIC, STATE_VERSION)
+    in_bios, self.interrupt_flag = state.unpack('?B')
+    self._load_buffer(state, 'wram')
+    state.buffer(self.zram)
+    for name in ('vram', 'oam'):
+      if isinstance(getattr(self, '_' + name), bytearray):
+        self._load_buffer(state, name)
+      else:
+        _load_device(state, getattr(self, '_' + name))
+    _load_device(state, self.io)
+    self.cartridge.load_state(state.section())
+    if in_bios != self._in_bios:
+      self.in_bios = in_bios
+    # Memory changed underneath the page tables.
+    self.spring_all_traps()
+    self.interrupts_changed()
+
+  def _load_buffer(self, state, name):
+    """Restore the buffer name from the next section of state, like StateReader.buffer,
+    but into a new buffer rather than over memory shared with a fork.
+
+    """
+    buffer = getattr(self, '_' + name)
+    if name not in self._shared:
+      state.buffer(buffer)
+      return
+    data = state.section()
+    if not len(data):
+      return
+    if len(data) != len(buffer):
+      raise StateError(
+        "Save state section is %d bytes, expected %d." % (len(data), len(buffer)))
+    self._replace_buffer(name, bytearray(data))
+
+  def fork(self):
+    """Return a new mmu with the same contents as this one, for forking a whole machine
+    (see Machine.fork). Very little is copied up front:
+
+      - the cartridge is forked, see Cartridge.fork. Rom is shared outright, and ram a bank
+        at a time until either cartridge writes to it.
+      - the pages of wram, and of vram and oam if they are bytearrays, are shared by both
+        mmus, copy-on-write: the first write to a page through either mmu copies just
+        that page (see _CopyOnWrite), so a fork only costs memory for the pages it
+        dirties. The copy-on-write handlers are made once per mmu and buffer, and only
+        put back over the pages copied since, so forking again is about as cheap as
+        forking the first time. Reading these buffers without unsharing them is done
+        with contents; getting one through its attribute gathers it into a buffer of the
+        mmu's own.
+      - zram, and the io registers if they are a bytearray, are only half a page each, so
+        they are simply copied.
+      - other devices are forked if they have a fork method, and attached to the new mmu
+        if they have an attach method. Otherwise they are shared.
+
+    The new mmu has no remap listeners, write traps or scheduled events. Note that writes
+    straight into the buffers, bypassing the page tables, would be seen by both mmus.
+
+    """
+    cartridge = self.cartridge.fork()
+
+    child = Mmu.__new__(Mmu)
+    child._shared = {}
+    child._cow_handlers = {}
+    child.zram = bytearray(self.zram)
+    child.bios = _fork_device(self.bios)
+    child.io = bytearray(self.io) if isinstance(self.io, bytearray) else _fork_device(self.io)
+    child.scheduler = Scheduler()
+    child.interrupt_flag = self.interrupt_flag
+    child.on_interrupts_changed = None
+    child._in_bios = self._in_bios
+    child._cartridge_mapping = self._cartridge_mapping
+    child._write_traps = {}
+    child._read_watches = {}
+    child._write_watches = {}
+    child._locks = {}
+    child._writers = None
+    child._remap_listeners = []
+
+    # Start from our page tables, without our traps, watches and locks, and put the pages
+    # that refer to our cartridge and devices right.
+    child._read_pages = list(self._read_pages)
+    child._write_pages = list(self._write_pages)
+    child._read_spans = list(self._read_spans)
+    child._write_spans = list(self._write_spans)
+    child._read_sources = list(self._read_sources)
+    child._write_sources = list(self._write_sources)
+    for page in set(self._write_traps) | set(self._write_watches) | set(self._locks):
+      wrapper, handler = self._base_write_handler(page)
+      child._write_pages[page] = handler
+      child._write_spans[page] = wrapper.span
+    for page in set(self._read_watches) | set(self._locks):
+      wrapper, handler = self._innermost(self._read_pages, page)
+      child._read_pages[page] = handler
+      child._read_spans[page] = wrapper.span
+    child.cartridge = cartridge
+    cartridge.add_mapping_listener(child._remap_cartridge)
+    child._remap_cartridge()
+    for name, ranges in BUFFER_PAGES:
+      device = getattr(self, '_' + name)
+      if isinstance(device, bytearray):
+        # Both mmus now share every page, including any we had copied since last sharing
+        # the buffer, which the child's page tables map too.
+        if self._shared.get(name) != set():
+          self._share(name)
+        setattr(child, '_' + name, device)
+        child._share(name)
+        continue
+      forked = _fork_device(device)
+      setattr(child, '_' + name, forked)
+      if forked is not device:
+        for first, last in ranges:
+          child._map(first, last, forked, 0x0000)
+    child._map_handler(0xFF, _HighPage(child, child.io, child.zram))
+
+    for ours, theirs in ((self.bios, child.bios), (self._vram, child._vram),
+                         (self._oam, child._oam), (self.io, child.io)):
+      if theirs is not ours and hasattr(theirs, 'attach'):
+        theirs.attach(child)
+    return child
+
+  def _share(self, name):
+    """Make writes to the pages of the buffer name copy-on-write, leaving any trap, watch
+    or lock on them in place. Reads still go to whatever the pages are mapped to.
+
+    """
+    handlers = self._cow_handlers.get(name)
+    if handlers is None:
+      handlers = self._cow_handlers[name] = [
+        _CopyOnWrite(self, name, offset)
+        for offset in range(0, len(getattr(self, '_' + name)), PAGE_SIZE)]
+    pages = self._write_pages
+    spans = self._write_spans
+    for first, last in _BUFFER_RANGES[name]:
+      count = last + 1 - first
+      pages[first:last + 1] = handlers[:count]
+      spans[first:last + 1] = [None] * count
+      self._reinstall_locks(pages, spans, first, last)
+      self._reinstall_watches(self._write_watches, self._install_write_watch, first, last)
+      self._reinstall_traps(first, last)
+    self._shared[name] = set()
+
+  def _copy_page(self, name, offset):
+    """Copy-on-write fault on the page at offset in the buffer name: copy the memory the
+    page is mapped to, and map the copy wherever the page is mapped (e.g. in echo ram too).
+    Returns the copy.
+
+    """
+    ranges = _BUFFER_RANGES[name]
+    index = offset >> PAGE_SHIFT
+    device, base = self._write_sources[ranges[0][0] + index]
+    copy = device[base:base + PAGE_SIZE]
+    for first, last in ranges:
+      if first + index <= last:
+        self._map(first + index, first + index, copy, 0x0000)
+    self._shared[name].add(offset)
+    return copy
+
+  def _unshare(self, name):
+    """Stop sharing the buffer name with forks: gather its pages into a buffer of our
+    own, and map that in their place. Returns the new buffer.
+
+    """
+    buffer = bytearray(self.contents(name))
+    self._replace_buffer(name, buffer)
+    return buffer
+
+  def _replace_buffer(self, name, buffer):
+    """Replace the buffer name with buffer, of the same size, and map it in its place."""
+    setattr(self, name, buffer)
+    for first, last in _BUFFER_RANGES[name]:
+      self._map(first, last, buffer, 0x0000)
+
+  def contents(self, name):
+    """Return what the buffer name (wram, vram or oam) holds, for reading: the buffer
+    itself, unless some of its pages have been copied since it was shared with a fork
+    (see fork), in which case they are gathered into a new bytearray. Unlike getting the
+    buffer through its attribute, this never unshares it.
+
+    """
+    buffer = getattr(self, '_' + name)
+    if name not in self._shared:
+      return buffer
+    first, last = _BUFFER_RANGES[name][0]
+    sources = self._write_sources[first:last + 1]
+    if all(device is buffer for device, _ in sources):
+      return buffer
+    return bytearray().join(device[offset:offset + PAGE_SIZE] for device, offset in sources)
 
   def load_cartridge(self, cartridge):
+    self.cartridge.remove_mapping_listener(self._remap_cartridge)
     self.cartridge = cartridge
+    self.cartridge.add_mapping_listener(self._remap_cartridge)
+    self._remap_cartridge()
 
   def unload_cartridge(self, cartridge):
-    self.cartridge = Cartridge()
+    self.load_cartridge(Cartridge())
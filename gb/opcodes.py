@@ -0,0 +1,433 @@
+"""Decoding of the cpu instruction set into python source.
+
+Every opcode (and every 0xCB-prefixed opcode) is decoded once, up front, into a few lines of
+python with all of its operands resolved: register indices, bit numbers and conditions are
+constants in the source. The cpu compiles these into its dispatch tables.
+
+The generated source runs with these locals available:
+
+  cpu   the Cpu
+  regs  cpu.regs
+  mmu   cpu.mmu
+  n     the 8 bit immediate operand, for instructions that have one
+  nn    the 16 bit immediate operand, for instructions that have one
+
+and with cpu.pc already pointing at the next instruction. Conditional branches return
+their taken cycle count from inside the branch; the compiled functions return the cycle
+count of every other path. Arithmetic is done by table lookups, with the tables from
+gb.alu as globals.
+
+"""
+
+from gb.alu import ALU_TABLES
+
+REG_A = 0b111
+REG_B = 0b000
+REG_C = 0b001
+REG_D = 0b010
+REG_E = 0b011
+REG_H = 0b100
+REG_L = 0b101
+# Encoding 0b110 refers to (HL) in operands, never to a register, so the register file
+# stores the flags in that slot.
+REG_F = 0b110
+
+# Flag bits in F.
+FLAG_Z = 0x80
+FLAG_N = 0x40
+FLAG_H = 0x20
+FLAG_C = 0x10
+
+# The (high, low) register file indices of the 16 bit register pairs.
+PAIR_BC = (REG_B, REG_C)
+PAIR_DE = (REG_D, REG_E)
+PAIR_HL = (REG_H, REG_L)
+PAIR_AF = (REG_A, REG_F)
+
+REG_NAMES = ['b', 'c', 'd', 'e', 'h', 'l', '(hl)', 'a']
+# 16 bit registers as encoded in bits 4-5 of an opcode.
+RR_PAIRS = [PAIR_BC, PAIR_DE, PAIR_HL, None]
+RR_NAMES = ['bc', 'de', 'hl', 'sp']
+COND_NAMES = ['nz', 'z', 'nc', 'c']
+
+HL = "(regs[%d] << 8 | regs[%d])" % PAIR_HL
+
+
+def read_r8(r):
+  """Expression reading the 8 bit operand encoded as r."""
+  if r == REG_F:
+    return "mmu[%s]" % HL
+  return "regs[%d]" % r
+
+
+def write_r8(r, value):
+  """Statement writing value to the 8 bit operand encoded as r."""
+  if r == REG_F:
+    return "mmu[%s] = %s" % (HL, value)
+  return "regs[%d] = %s" % (r, value)
+
+
+def read_rr(rr):
+  """Expression reading the 16 bit register encoded as rr in bits 4-5 of an opcode."""
+  if RR_PAIRS[rr] is None:
+    return "cpu.sp"
+  return "(regs[%d] << 8 | regs[%d])" % RR_PAIRS[rr]
+
+
+def write_rr(rr, value):
+  """Statements writing value, which must be in range, to the 16 bit register rr."""
+  if RR_PAIRS[rr] is None:
+    return ["cpu.sp = %s" % value]
+  hi, lo = RR_PAIRS[rr]
+  return ["v = %s" % value, "regs[%d] = v >> 8" % hi, "regs[%d] = v & 0xFF" % lo]
+
+
+def cond(cc):
+  """Expression evaluating the condition encoded as cc in bits 3-4 of an opcode."""
+  flag = FLAG_C if cc & 0x2 else FLAG_Z
+  if cc & 0x1:
+    return "regs[%d] & 0x%02X" % (REG_F, flag)
+  return "not regs[%d] & 0x%02X" % (REG_F, flag)
+
+
+def push(value):
+  return [
+    "sp = (cpu.sp - 2) & 0xFFFF",
+    "cpu.sp = sp",
+    "v = %s" % value,
+    "mmu[(sp + 1) & 0xFFFF] = v >> 8",
+    "mmu[sp] = v & 0xFF",
+  ]
+
+
+def pop(target):
+  """Statements popping a word from the stack into the local named target."""
+  return [
+    "sp = cpu.sp",
+    "%s = mmu[(sp + 1) & 0xFFFF] << 8 | mmu[sp]" % target,
+    "cpu.sp = (sp + 2) & 0xFFFF",
+  ]
+
+
+def alu(kind, value):
+  """Statements applying the 8 bit alu operation kind to A and value. Arithmetic looks the
+  result and flags up in the gb.alu tables.
+
+  """
+  if kind in ('add', 'adc', 'sub', 'sbc', 'cp'):
+    table = 'ALU_ADC' if kind in ('add', 'adc') else 'ALU_SBC'
+    carry = "(regs[6] & 0x10) << 12 | " if kind in ('adc', 'sbc') else ""
+    lines = ["x = %s[%sregs[7] << 8 | %s]" % (table, carry, value)]
+    if kind == 'cp':
+      return lines + ["regs[6] = x & 0xFF"]
+    return lines + ["regs[7] = x >> 8", "regs[6] = x & 0xFF"]
+  op, flags = {'and': ('&', 0x20), 'xor': ('^', 0x00), 'or': ('|', 0x00)}[kind]
+  return [
+    "r = regs[7] %s %s" % (op, value),
+    "regs[7] = r",
+    "regs[6] = 0x%02X if r else 0x%02X" % (flags, flags | FLAG_Z),
+  ]
+
+
+def shift(kind, value):
+  """Expression looking up the 0xCB rotate/shift kind of value in ALU_SHIFT."""
+  index = EXT_KINDS.index(kind) << 9
+  if kind in ('rl', 'rr'):
+    return "ALU_SHIFT[0x%03X | (regs[6] & 0x10) << 4 | %s]" % (index, value)
+  return "ALU_SHIFT[0x%03X | %s]" % (index, value)
+
+
+# Clock cycles taken by each base opcode. For conditional branches this is the time taken
+# when the branch isn't taken, see CYCLES_TAKEN. The 0xCB prefix is accounted for in
+# EXT_CYCLES. Illegal opcodes lock up the cpu, so they are given 0.
+CYCLES = [
+  # x0  x1  x2  x3  x4  x5  x6  x7  x8  x9  xA  xB  xC  xD  xE  xF
+     4, 12,  8,  8,  4,  4,  8,  4, 20,  8,  8,  8,  4,  4,  8,  4,  # 0x
+     4, 12,  8,  8,  4,  4,  8,  4, 12,  8,  8,  8,  4,  4,  8,  4,  # 1x
+     8, 12,  8,  8,  4,  4,  8,  4,  8,  8,  8,  8,  4,  4,  8,  4,  # 2x
+     8, 12,  8,  8, 12, 12, 12,  4,  8,  8,  8,  8,  4,  4,  8,  4,  # 3x
+     4,  4,  4,  4,  4,  4,  8,  4,  4,  4,  4,  4,  4,  4,  8,  4,  # 4x
+     4,  4,  4,  4,  4,  4,  8,  4,  4,  4,  4,  4,  4,  4,  8,  4,  # 5x
+     4,  4,  4,  4,  4,  4,  8,  4,  4,  4,  4,  4,  4,  4,  8,  4,  # 6x
+     8,  8,  8,  8,  8,  8,  4,  8,  4,  4,  4,  4,  4,  4,  8,  4,  # 7x
+     4,  4,  4,  4,  4,  4,  8,  4,  4,  4,  4,  4,  4,  4,  8,  4,  # 8x
+     4,  4,  4,  4,  4,  4,  8,  4,  4,  4,  4,  4,  4,  4,  8,  4,  # 9x
+     4,  4,  4,  4,  4,  4,  8,  4,  4,  4,  4,  4,  4,  4,  8,  4,  # Ax
+     4,  4,  4,  4,  4,  4,  8,  4,  4,  4,  4,  4,  4,  4,  8,  4,  # Bx
+     8, 12, 12, 16, 12, 16,  8, 16,  8, 16, 12,  0, 12, 24,  8, 16,  # Cx
+     8, 12, 12,  0, 12, 16,  8, 16,  8, 16, 12,  0, 12,  0,  8, 16,  # Dx
+    12, 12,  8,  0,  0, 16,  8, 16, 16,  4, 16,  0,  0,  0,  8, 16,  # Ex
+    12, 12,  8,  4,  0, 16,  8, 16, 12,  8, 16,  4,  0,  0,  8, 16,  # Fx
+]
+
+# Clock cycles taken by conditional branches when the branch is taken.
+CYCLES_TAKEN = dict(
+  [(op, 12) for op in (0x20, 0x28, 0x30, 0x38)] +
+  [(op, 20) for op in (0xC0, 0xC8, 0xD0, 0xD8)] +
+  [(op, 16) for op in (0xC2, 0xCA, 0xD2, 0xDA)] +
+  [(op, 24) for op in (0xC4, 0xCC, 0xD4, 0xDC)])
+
+# Clock cycles taken by each 0xCB-prefixed opcode, including the prefix: 8 for registers,
+# 16 for read-modify-write of (HL), and 12 for BIT n,(HL), which only reads.
+EXT_CYCLES = [
+  8 if op & 0x7 != REG_F else (12 if op >> 6 == 1 else 16) for op in range(256)]
+
+ALU_KINDS = ['add', 'adc', 'sub', 'sbc', 'and', 'xor', 'or', 'cp']
+EXT_KINDS = ['rlc', 'rrc', 'rl', 'rr', 'sla', 'sra', 'swap', 'srl']
+ILLEGAL = frozenset([0xD3, 0xDB, 0xDD, 0xE3, 0xE4, 0xEB, 0xEC, 0xED, 0xF4, 0xFC, 0xFD])
+
+
+def taken(op):
+  """Statement returning the cycles taken by the conditional branch op when taken."""
+  return "return %d" % CYCLES_TAKEN[op]
+
+
+def decode(op):
+  """Decode the base opcode op. Returns (length, mnemonic, lines): the instruction length
+  in bytes including the opcode, a mnemonic with n/nn standing for immediates, and the
+  python source lines executing it.
+
+  """
+  x, y, z = op >> 6, (op >> 3) & 0x7, op & 0x7
+  rr = y >> 1
+
+  if op in ILLEGAL:
+    return 1, "ill", [
+      "raise IllegalInstructionError("
+      "'Illegal opcode %02x at %%04x' %% ((cpu.pc - 1) & 0xFFFF))" % op]
+
+  if op == 0x00:
+    return 1, "nop", ["pass"]
+  if op == 0x10:
+    # STOP is followed by a padding byte.
+    return 2, "stop", ["cpu.stopped = True", "cpu._yield_at = 0"]
+  if op == 0x76:
+    return 1, "halt", ["cpu.halted = True", "cpu._yield_at = 0"]
+  if op == 0xCB:
+    return 2, "prefix cb", ["return ext_ops[n](cpu)"]
+  if op == 0xF3:
+    return 1, "di", ["cpu.interrupts_enabled = False"]
+  if op == 0xFB:
+    # Note: on hardware EI takes effect after the following instruction. Either way the run
+    # loop has to stop to check for pending interrupts.
+    return 1, "ei", ["cpu.interrupts_enabled = True", "cpu._yield_at = 0"]
+
+  if op == 0x27:
+    return 1, "daa", [
+      "x = ALU_DAA[(regs[6] & 0x70) << 4 | regs[7]]", "regs[7] = x >> 8",
+      "regs[6] = x & 0xFF"]
+  if op == 0x37:
+    return 1, "scf", ["regs[6] = (regs[6] & 0x80) | 0x10"]
+  if op == 0x3F:
+    return 1, "ccf", ["regs[6] = (regs[6] & 0x80) | (~regs[6] & 0x10)"]
+  if op == 0x2F:
+    return 1, "cpl", ["regs[7] ^= 0xFF", "regs[6] |= 0x60"]
+
+  if op in (0x07, 0x17, 0x0F, 0x1F):
+    # The same as the 0xCB rotates of A, except that Z is always cleared.
+    kind = EXT_KINDS[y]
+    return 1, kind + "a", [
+      "x = %s" % shift(kind, "regs[7]"), "regs[7] = x >> 8", "regs[6] = x & 0x10"]
+
+  # 8-bit loads
+  if x == 0 and z == 6:
+    return 2, "ld %s,n" % REG_NAMES[y], [write_r8(y, "n")]
+  if x == 1:
+    return 1, "ld %s,%s" % (REG_NAMES[y], REG_NAMES[z]), [write_r8(y, read_r8(z))]
+  if op in (0x02, 0x12):
+    pair = PAIR_DE if op & 0x10 else PAIR_BC
+    return 1, "ld (%s),a" % RR_NAMES[rr], ["mmu[regs[%d] << 8 | regs[%d]] = regs[7]" % pair]
+  if op in (0x0A, 0x1A):
+    pair = PAIR_DE if op & 0x10 else PAIR_BC
+    return 1, "ld a,(%s)" % RR_NAMES[rr], ["regs[7] = mmu[regs[%d] << 8 | regs[%d]]" % pair]
+  if op in (0x22, 0x32, 0x2A, 0x3A):
+    step = "+ 1" if op & 0x10 == 0 else "- 1"
+    sign = "+" if op & 0x10 == 0 else "-"
+    access = "mmu[hl] = regs[7]" if op & 0x8 == 0 else "regs[7] = mmu[hl]"
+    mnemonic = "ld (hl%s),a" % sign if op & 0x8 == 0 else "ld a,(hl%s)" % sign
+    return 1, mnemonic, [
+      "hl = %s" % HL, access, "hl = (hl %s) & 0xFFFF" % step,
+      "regs[4] = hl >> 8", "regs[5] = hl & 0xFF"]
+  if op == 0xE0:
+    return 2, "ldh (n),a", ["mmu[0xFF00 | n] = regs[7]"]
+  if op == 0xF0:
+    return 2, "ldh a,(n)", ["regs[7] = mmu[0xFF00 | n]"]
+  if op == 0xE2:
+    return 1, "ld (c),a", ["mmu[0xFF00 | regs[1]] = regs[7]"]
+  if op == 0xF2:
+    return 1, "ld a,(c)", ["regs[7] = mmu[0xFF00 | regs[1]]"]
+  if op == 0xEA:
+    return 3, "ld (nn),a", ["mmu[nn] = regs[7]"]
+  if op == 0xFA:
+    return 3, "ld a,(nn)", ["regs[7] = mmu[nn]"]
+
+  # 16-bit loads
+  if x == 0 and z == 1 and not y & 0x1:
+    return 3, "ld %s,nn" % RR_NAMES[rr], write_rr(rr, "nn")
+  if op == 0xF9:
+    return 1, "ld sp,hl", ["cpu.sp = %s" % HL]
+  if op in (0xF8, 0xE8):
+    lines = [
+      "sp = cpu.sp",
+      "regs[6] = (0x20 if (sp & 0xF) + (n & 0xF) > 0xF else 0)"
+      " | (0x10 if (sp & 0xFF) + n > 0xFF else 0)",
+      "r = (sp + (n - 0x100 if n & 0x80 else n)) & 0xFFFF",
+    ]
+    if op == 0xF8:
+      return 2, "ld hl,sp+n", lines + write_rr(2, "r")
+    return 2, "add sp,n", lines + ["cpu.sp = r"]
+  if op == 0x08:
+    return 3, "ld (nn),sp", [
+      "sp = cpu.sp", "mmu[nn] = sp & 0xFF", "mmu[(nn + 1) & 0xFFFF] = sp >> 8"]
+
+  # 16-bit arithmetic
+  if x == 0 and z == 3:
+    if y & 0x1:
+      return 1, "dec %s" % RR_NAMES[rr], write_rr(rr, "(%s - 1) & 0xFFFF" % read_rr(rr))
+    return 1, "inc %s" % RR_NAMES[rr], write_rr(rr, "(%s + 1) & 0xFFFF" % read_rr(rr))
+  if x == 0 and z == 1:
+    return 1, "add hl,%s" % RR_NAMES[rr], [
+      "hl = %s" % HL,
+      "v = %s" % read_rr(rr),
+      "r = hl + v",
+      "regs[6] = (regs[6] & 0x80) | (0x20 if (hl & 0xFFF) + (v & 0xFFF) > 0xFFF else 0)"
+      " | (0x10 if r > 0xFFFF else 0)",
+      "regs[4] = (r >> 8) & 0xFF",
+      "regs[5] = r & 0xFF",
+    ]
+
+  # 8-bit arithmetic
+  if x == 0 and z in (4, 5):
+    kind = "inc" if z == 4 else "dec"
+    return 1, "%s %s" % (kind, REG_NAMES[y]), [
+      "x = ALU_%s[%s]" % (kind.upper(), read_r8(y)),
+      write_r8(y, "x >> 8"),
+      "regs[6] = (regs[6] & 0x10) | (x & 0xFF)",
+    ]
+  if x == 2:
+    return 1, "%s %s" % (ALU_KINDS[y], REG_NAMES[z]), alu(ALU_KINDS[y], read_r8(z))
+  if x == 3 and z == 6:
+    return 2, "%s n" % ALU_KINDS[y], alu(ALU_KINDS[y], "n")
+
+  # Stack ops and branches
+  if x == 3 and z == 5 and not y & 0x1:
+    if rr == 3:
+      return 1, "push af", push("regs[7] << 8 | regs[6]")
+    return 1, "push %s" % RR_NAMES[rr], push(read_rr(rr))
+  if x == 3 and z == 1 and not y & 0x1:
+    if rr == 3:
+      # The low nibble of F doesn't exist.
+      return 1, "pop af", pop("v") + ["regs[7] = v >> 8", "regs[6] = v & 0xF0"]
+    return 1, "pop %s" % RR_NAMES[rr], pop("r") + write_rr(rr, "r")
+  if x == 3 and z == 7:
+    return 1, "rst %02xh" % (y << 3), push("cpu.pc") + ["cpu.pc = 0x%02X" % (y << 3)]
+  if op == 0xCD:
+    return 3, "call nn", push("cpu.pc") + ["cpu.pc = nn"]
+  if x == 3 and z == 4:
+    return 3, "call %s,nn" % COND_NAMES[y], ["if %s:" % cond(y)] + [
+      "  " + line for line in push("cpu.pc") + ["cpu.pc = nn", taken(op)]]
+  if op == 0xC9:
+    return 1, "ret", pop("cpu.pc")
+  if op == 0xD9:
+    return 1, "reti", pop("cpu.pc") + [
+      "cpu.interrupts_enabled = True", "cpu._yield_at = 0"]
+  if x == 3 and z == 0 and y < 4:
+    return 1, "ret %s" % COND_NAMES[y], ["if %s:" % cond(y)] + [
+      "  " + line for line in pop("cpu.pc") + [taken(op)]]
+  if op == 0xC3:
+    return 3, "jp nn", ["cpu.pc = nn"]
+  if x == 3 and z == 2 and y < 4:
+    return 3, "jp %s,nn" % COND_NAMES[y], [
+      "if %s:" % cond(y), "  cpu.pc = nn", "  " + taken(op)]
+  if op == 0xE9:
+    return 1, "jp hl", ["cpu.pc = %s" % HL]
+  if op == 0x18:
+    return 2, "jr n", ["cpu.pc = (cpu.pc + (n - 0x100 if n & 0x80 else n)) & 0xFFFF"]
+  if x == 0 and z == 0 and y >= 4:
+    return 2, "jr %s,n" % COND_NAMES[y - 4], [
+      "if %s:" % cond(y - 4),
+      "  cpu.pc = (cpu.pc + (n - 0x100 if n & 0x80 else n)) & 0xFFFF",
+      "  " + taken(op)]
+
+  raise AssertionError("Opcode %02x was not decoded" % op)
+
+
+def decode_ext(op):
+  """Decode the 0xCB-prefixed opcode op. Returns (mnemonic, lines), as for decode."""
+  x, y, z = op >> 6, (op >> 3) & 0x7, op & 0x7
+  if x == 0:
+    kind = EXT_KINDS[y]
+    return "%s %s" % (kind, REG_NAMES[z]), [
+      "x = %s" % shift(kind, read_r8(z)), write_r8(z, "x >> 8"), "regs[6] = x & 0xFF"]
+  if x == 1:
+    return "bit %d,%s" % (y, REG_NAMES[z]), [
+      "regs[6] = (regs[6] & 0x10) | 0x20 | (0 if %s & 0x%02X else 0x80)"
+      % (read_r8(z), 1 << y)]
+  if x == 2:
+    return "res %d,%s" % (y, REG_NAMES[z]), [
+      write_r8(z, "%s & 0x%02X" % (read_r8(z), ~(1 << y) & 0xFF))]
+  return "set %d,%s" % (y, REG_NAMES[z]), [
+    write_r8(z, "%s | 0x%02X" % (read_r8(z), 1 << y))]
+
+
+def fetch(length):
+  """Statements fetching the immediate operand of a length byte instruction into n or nn,
+  leaving cpu.pc past the instruction. Expects pc to hold the address after the opcode.
+
+  """
+  if length == 2:
+    return ["n = mmu[pc]", "cpu.pc = (pc + 1) & 0xFFFF"]
+  if length == 3:
+    return ["nn = mmu[pc] | mmu[(pc + 1) & 0xFFFF] << 8", "cpu.pc = (pc + 2) & 0xFFFF"]
+  return []
+
+
+def function_source(name, lines, length=1, cycles=None):
+  """Source for a function name(cpu) which fetches the operands of a length byte
+  instruction, executes lines and returns cycles.
+
+  """
+  body = fetch(length) + lines
+  if cycles is not None:
+    body.append("return %d" % cycles)
+  prologue = []
+  code = "\n".join(body)
+  if length > 1:
+    prologue.append("pc = cpu.pc")
+  if "regs" in code:
+    prologue.append("regs = cpu.regs")
+  if "mmu" in code:
+    prologue.append("mmu = cpu.mmu")
+  return "def %s(cpu):\n%s\n" % (name, "\n".join("  " + line for line in prologue + body))
+
+
+def build_tables(namespace):
+  """Compile every base and 0xCB-prefixed opcode into a function of the cpu, returning the
+  clock cycles it took. Returns the
+  (ops, ext_ops, mnemonics, ext_mnemonics, lengths) tables, each indexed by opcode.
+  namespace supplies the globals of the generated functions, and gets ext_ops and the alu
+  tables added to it.
+
+  """
+  ops = [None] * 256
+  ext_ops = [None] * 256
+  mnemonics = [None] * 256
+  ext_mnemonics = [None] * 256
+  lengths = [None] * 256
+  namespace['ext_ops'] = ext_ops
+  namespace.update(ALU_TABLES)
+
+  source = []
+  for op in range(256):
+    lengths[op], mnemonics[op], lines = decode(op)
+    # The prefix and illegal opcodes don't fall through to a return of their own.
+    cycles = CYCLES[op] if op != 0xCB and op not in ILLEGAL else None
+    source.append(function_source("op_%02x" % op, lines, lengths[op], cycles))
+    ext_mnemonics[op], lines = decode_ext(op)
+    source.append(function_source("cb_%02x" % op, lines, cycles=EXT_CYCLES[op]))
+  exec(compile("\n".join(source), "<gb.opcodes>", "exec"), namespace)
+
+  for op in range(256):
+    ops[op] = namespace["op_%02x" % op]
+    ext_ops[op] = namespace["cb_%02x" % op]
+  return ops, ext_ops, mnemonics, ext_mnemonics, lengths
@@ -0,0 +1,303 @@
+"""Rendering the screen from vram, oam and the lcd registers, with NumPy.
+
+This needs the optional NumPy dependency: pip install pyGB[render].
+
+A Renderer draws whole frames, or batches of lines, into a reusable frame buffer of shades
+(0 is the lightest, 3 the darkest), without any per pixel Python:
+
+  - tile data is decoded from its 2 bits per pixel planes through a lookup table of the
+    pixels of every byte, and each tile map is assembled into a 256x256 pixel layer, by a
+    TileCache, which only redoes the tiles and rows of the maps that vram writes changed,
+  - the background and window are gathered from the layers with fancy indexing, for every
+    pixel of the batch at once,
+  - sprites are drawn a sprite at a time, as a block of pixels each, lowest priority
+    first, after working out which ones each line shows as array operations, and
+  - palettes and sprite priority are applied with lookups and masks over the batch.
+
+Registers are read once per batch, so changes made partway through the lines of a batch
+(e.g. scrolling effects done in an interrupt) take effect for the whole batch. Render a
+line at a time for those.
+
+"""
+
+import struct
+import zlib
+
+import numpy as np
+
+from gb.io import (BGP_REG, LCDC_BG_ENABLE, LCDC_BG_MAP, LCDC_ENABLE, LCDC_OBJ_ENABLE,
+                   LCDC_OBJ_SIZE, LCDC_REG, LCDC_TILE_DATA, LCDC_WINDOW_ENABLE,
+                   LCDC_WINDOW_MAP, OBP0_REG, OBP1_REG, SCX_REG, SCY_REG, WX_REG, WY_REG)
+from gb.mmu import BUFFER_PAGES, PAGE_SIZE
+
+SCREEN_WIDTH = 160
+SCREEN_HEIGHT = 144
+
+# Tile data: 384 tiles of 16 bytes from the start of vram, then two 32x32 tile maps.
+TILE_COUNT = 384
+TILE_BYTES = 16
+TILE_DATA_SIZE = TILE_COUNT * TILE_BYTES
+TILE_MAP_0 = 0x1800
+TILE_MAP_1 = 0x1C00
+TILE_MAP_SIZE = 32
+TILE_MAP_BYTES = TILE_MAP_SIZE * TILE_MAP_SIZE
+LAYER_SIZE = TILE_MAP_SIZE * 8
+
+# The pages vram is mapped at.
+VRAM_FIRST_PAGE, VRAM_LAST_PAGE = dict(BUFFER_PAGES)['vram'][0]
+VRAM_SIZE = (VRAM_LAST_PAGE + 1 - VRAM_FIRST_PAGE) * PAGE_SIZE
+
+# Sprites: 40 entries of y, x, tile and flags in oam, at most 10 of them on any line.
+SPRITE_COUNT = 40
+SPRITES_PER_LINE = 10
+SPRITE_BEHIND_BG = 0x80
+SPRITE_FLIP_Y = 0x40
+SPRITE_FLIP_X = 0x20
+SPRITE_PALETTE = 0x10
+
+# The shades as RGB, lightest first, see to_rgb.
+SHADES_RGB = np.array([[0xFF, 0xFF, 0xFF], [0xAA, 0xAA, 0xAA], [0x55, 0x55, 0x55],
+                       [0x00, 0x00, 0x00]], np.uint8)
+
+# _BITS[byte, x] is the bit for pixel x (from the left) of a tile row plane holding byte.
+_BITS = ((np.arange(256)[:, None] >> np.arange(7, -1, -1)) & 1).astype(np.uint8)
+
+# _PALETTES[value] is the shade for each colour number under the palette register value.
+_PALETTES = ((np.arange(256)[:, None] >> np.arange(0, 8, 2)) & 3).astype(np.uint8)
+
+# Tiles numbered from 0x9000 (LCDC_TILE_DATA clear): tile numbers are signed, so 0-127
+# are tiles 256-383 and 128-255 are tiles 128-255.
+_SIGNED_TILES = np.concatenate([np.arange(256, 384), np.arange(128, 256)])
+
+
+def decode_tiles(data):
+  """Decode 2 bits per pixel tile data, 16 bytes per tile, into an array of the colour
+  numbers of its pixels indexed by [tile, y, x].
+
+  """
+  planes = np.frombuffer(data, np.uint8).reshape(-1, 8, 2)
+  return _BITS[planes[:, :, 0]] | (_BITS[planes[:, :, 1]] << 1)
+
+
+def to_rgb(frame, out=None):
+  """Convert a frame of shades to RGB, as an array indexed by [y, x, channel]."""
+  return np.take(SHADES_RGB, frame, axis=0, out=out)
+
+
+def write_png(frame, f):
+  """Write a frame of shades to the binary file f as a greyscale PNG."""
+  height, width = frame.shape
+  # Each row starts with its filter type, 0 for none.
+  rows = np.zeros((height, width + 1), np.uint8)
+  rows[:, 1:] = SHADES_RGB[frame, 0]
+
+  def chunk(kind, data):
+    return (struct.pack('>I', len(data)) + kind + data +
+            struct.pack('>I', zlib.crc32(kind + data) & 0xFFFFFFFF))
+  f.write(b'\x89PNG\r\n\x1a\n')
+  f.write(chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 0, 0, 0, 0)))
+  f.write(chunk(b'IDAT', zlib.compress(rows.tobytes())))
+  f.write(chunk(b'IEND', b''))
+
+
+class TileCache(object):
+  """The tiles in the vram of mmu, decoded (see decode_tiles), and its tile maps assembled
+  into layers of colour numbers, kept up to date a tile and a tile map row at a time.
+
+  Vram pages are watched with write traps (see Mmu.trap_writes), so the cpu only pays for
+  the first write to each page after each update. update then compares vram with the copy
+  the cache was made from, decodes just the tiles which changed, and marks stale the rows
+  of the layers whose map entries, or whose tiles, changed. Layers reassemble their stale
+  rows when next asked for. Writes straight into the vram buffer, bypassing the mmu, aren't
+  seen until invalidate is called.
+
+  """
+
+  def __init__(self, mmu):
+    self.mmu = mmu
+    # Decoded tiles, indexed by [tile, y, x].
+    self.tiles = np.zeros((TILE_COUNT, 8, 8), np.uint8)
+    # The vram the tiles and layers are up to date with.
+    self._vram = np.zeros(VRAM_SIZE, np.uint8)
+    # [layer, stale rows of tiles] by (second map, signed tile numbers).
+    self._layers = {}
+    # Pages written since the last update, or not yet trapped.
+    self._dirty = set()
+    self.invalidate()
+
+  def invalidate(self):
+    """Check all of vram for changes on the next update."""
+    self._dirty.update(range(VRAM_FIRST_PAGE, VRAM_LAST_PAGE + 1))
+
+  def _written(self, page):
+    """Write trap callback."""
+    self._dirty.add(page)
+
+  def update(self):
+    """Bring the tiles, and the layers, up to date with vram."""
+    if not self._dirty:
+      return
+    for page in self._dirty:
+      self.mmu.trap_writes(page, self._written)
+    self._dirty.clear()
+
+    vram = np.frombuffer(self.mmu.contents('vram'), np.uint8)
+    # Which 16 byte units changed: a tile each, or half a tile map row.
+    changed = (vram != self._vram).reshape(-1, TILE_BYTES).any(axis=1)
+    if not changed.any():
+      return
+    self._vram[:] = vram
+    tiles = np.flatnonzero(changed[:TILE_COUNT])
+    if len(tiles):
+      self.tiles[tiles] = decode_tiles(self._vram[:TILE_DATA_SIZE].reshape(
+        TILE_COUNT, TILE_BYTES)[tiles])
+    rows = changed[TILE_COUNT:].reshape(2, TILE_MAP_SIZE, -1).any(axis=2)
+    for (second_map, signed), (_, stale) in self._layers.items():
+      stale |= rows[second_map]
+      if len(tiles):
+        stale |= np.isin(self._tile_numbers(second_map, signed), tiles).any(axis=1)
+
+  def _tile_numbers(self, second_map, signed):
+    """The tiles of a tile map, indexed by [row, column]."""
+    base = TILE_MAP_1 if second_map else TILE_MAP_0
+    numbers = self._vram[base:base + TILE_MAP_BYTES].reshape(TILE_MAP_SIZE, TILE_MAP_SIZE)
+    return _SIGNED_TILES[numbers] if signed else numbers
+
+  def layer(self, second_map, signed):
+    """Return the colour numbers of a 256x256 pixel tile map, indexed by [y, x]: the second
+    map (at 0x9C00) if second_map is true, else the first, with tiles numbered from 0x9000
+    if signed is true, else from 0x8000. Call update first.
+
+    """
+    key = int(bool(second_map)), bool(signed)
+    entry = self._layers.get(key)
+    if entry is None:
+      entry = self._layers[key] = [np.zeros((LAYER_SIZE, LAYER_SIZE), np.uint8),
+                                   np.ones(TILE_MAP_SIZE, bool)]
+    layer, stale = entry
+    if stale.any():
+      rows = np.flatnonzero(stale)
+      # Tiles indexed by [row, column, y, x], laid out as [row, y, column, x].
+      pixels = self.tiles[self._tile_numbers(*key)[rows]].transpose(0, 2, 1, 3)
+      layer.reshape(TILE_MAP_SIZE, 8, LAYER_SIZE)[rows] = pixels.reshape(
+        len(rows), 8, LAYER_SIZE)
+      stale[:] = False
+    return layer
+
+
+class Renderer(object):
+  """Renders the screen from the vram, oam and lcd registers of mmu into frame, an array of
+  shades indexed by [y, x].
+
+  """
+
+  def __init__(self, mmu):
+    self.mmu = mmu
+    self.frame = np.zeros((SCREEN_HEIGHT, SCREEN_WIDTH), np.uint8)
+    self.cache = TileCache(mmu)
+    # The line of the window to draw next. The window only moves down a line on lines it
+    # is drawn on.
+    self.window_line = 0
+
+  def render_frame(self):
+    """Render the whole frame, and return it."""
+    self.render_lines(0, SCREEN_HEIGHT)
+    return self.frame
+
+  def render_lines(self, first, last):
+    """Render lines first up to last, with the registers as they are now."""
+    if first == 0:
+      self.window_line = 0
+    io = self.mmu.io
+    lcdc = io[LCDC_REG]
+    out = self.frame[first:last]
+    if not lcdc & LCDC_ENABLE:
+      out[:] = 0
+      return
+
+    self.cache.update()
+    lines = np.arange(first, last)
+
+    # Colour numbers of the background and window.
+    colours = np.zeros(out.shape, np.uint8)
+    if lcdc & LCDC_BG_ENABLE:
+      rows = (lines + io[SCY_REG]) & 0xFF
+      cols = (np.arange(SCREEN_WIDTH) + io[SCX_REG]) & 0xFF
+      colours[:] = self._layer(lcdc, LCDC_BG_MAP)[rows[:, None], cols[None, :]]
+      self._window(lcdc, lines, colours)
+    np.take(_PALETTES[io[BGP_REG]], colours, out=out)
+
+    if lcdc & LCDC_OBJ_ENABLE:
+      self._sprites(self.cache.tiles, lcdc, lines, colours, out)
+
+  def _layer(self, lcdc, map_bit):
+    """The layer of the tile map selected by map_bit of lcdc, see TileCache.layer."""
+    return self.cache.layer(lcdc & map_bit, not lcdc & LCDC_TILE_DATA)
+
+  def _window(self, lcdc, lines, colours):
+    if not lcdc & LCDC_WINDOW_ENABLE:
+      return
+    io = self.mmu.io
+    left = io[WX_REG] - 7
+    if left >= SCREEN_WIDTH:
+      return
+    # Lines are consecutive, so the window covers the ones from WY on.
+    skip = max(0, io[WY_REG] - lines[0])
+    count = len(lines) - skip
+    if count <= 0:
+      return
+    rows = (self.window_line + np.arange(count)) & 0xFF
+    self.window_line += count
+    start = max(0, left)
+    cols = np.arange(start, SCREEN_WIDTH) - left
+    layer = self._layer(lcdc, LCDC_WINDOW_MAP)
+    colours[skip:, start:] = layer[rows[:, None], cols[None, :]]
+
+  def _sprites(self, tiles, lcdc, lines, colours, out):
+    io = self.mmu.io
+    sprites = np.frombuffer(self.mmu.contents('oam'), np.uint8)[:SPRITE_COUNT * 4].reshape(
+      SPRITE_COUNT, 4)
+    height = 16 if lcdc & LCDC_OBJ_SIZE else 8
+    tops = sprites[:, 0].astype(np.intp) - 16
+    lefts = sprites[:, 1].astype(np.intp) - 8
+
+    # Which sprites each line shows: the first 10 in oam order covering it, whether or
+    # not they are on screen horizontally.
+    shown = (lines[None, :] >= tops[:, None]) & (lines[None, :] < tops[:, None] + height)
+    shown &= np.cumsum(shown, axis=0) <= SPRITES_PER_LINE
+    drawn = np.flatnonzero(shown.any(axis=1))
+    if not len(drawn):
+      return
+
+    # Where sprites overlap, the one further left wins, then the one first in oam. Drawing
+    # them from the lowest priority up leaves the winner's opaque pixels on top.
+    order = drawn[np.lexsort((drawn, lefts[drawn]))][::-1]
+    numbers = np.zeros(out.shape, np.uint8)
+    flags = np.zeros(out.shape, np.uint8)
+    for sprite in order:
+      left = lefts[sprite]
+      lo = max(0, -left)
+      hi = min(8, SCREEN_WIDTH - left)
+      if lo >= hi:
+        continue
+      tile, sprite_flags = sprites[sprite, 2:]
+      rows = np.flatnonzero(shown[sprite])
+      tile_rows = lines[rows] - tops[sprite]
+      if sprite_flags & SPRITE_FLIP_Y:
+        tile_rows = height - 1 - tile_rows
+      if height == 16:
+        tile &= 0xFE
+      pixels = tiles[tile + (tile_rows >> 3), tile_rows & 7]
+      if sprite_flags & SPRITE_FLIP_X:
+        pixels = pixels[:, ::-1]
+      pixels = pixels[:, lo:hi]
+      opaque = pixels != 0
+      cols = slice(left + lo, left + hi)
+      numbers[rows, cols] = np.where(opaque, pixels, numbers[rows, cols])
+      flags[rows, cols] = np.where(opaque, sprite_flags, flags[rows, cols])
+
+    palettes = np.stack([_PALETTES[io[OBP0_REG]], _PALETTES[io[OBP1_REG]]])
+    shades = palettes[(flags & SPRITE_PALETTE) >> 4, numbers]
+    # Sprites behind the background only show over its colour 0.
+    visible = (numbers != 0) & ~((flags & SPRITE_BEHIND_BG != 0) & (colours != 0))
+    np.copyto(out, shades, where=visible)
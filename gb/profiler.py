@@ -0,0 +1,285 @@
+"""Profiling guest code: which instructions run, where, and how many cycles they take.
+
+A Profiler counts, in flat arrays:
+
+  - executions of each base and 0xCB-prefixed opcode,
+  - executions of each address, per rom bank for the switchable rom region,
+  - cycles spent executing from each page of the address space, and
+  - cycles spent in each call stack, as followed through CALL, RST, interrupts and RET.
+
+Profiling costs nothing while it is off. Starting it swaps the cpu's class for a subclass
+with an instrumented run loop, which executes an instruction at a time rather than
+translated blocks, so it is several times slower than the normal run. Stopping it swaps
+the class back. Cycles skipped while halted are not counted anywhere.
+
+The results can be written as a report (see report), or as collapsed stacks (see
+write_collapsed) for flamegraph.pl and compatible tools.
+
+"""
+
+from array import array
+
+from gb.cpu import Cpu
+from gb.mem import BANK_SIZE
+
+# Start of the switchable rom region.
+ROMX_START = 0x4000
+ROMX_END = ROMX_START + BANK_SIZE
+
+# Address space regions, for the report: (name, first page, last page).
+REGIONS = (
+  ('rom0', 0x00, 0x3F),
+  ('romx', 0x40, 0x7F),
+  ('vram', 0x80, 0x9F),
+  ('cartridge ram', 0xA0, 0xBF),
+  ('wram', 0xC0, 0xDF),
+  ('echo', 0xE0, 0xFD),
+  ('oam', 0xFE, 0xFE),
+  ('io and zram', 0xFF, 0xFF),
+)
+
+# How each opcode moves through the call stack, when its branch is taken.
+_CALL = 1
+_RET = 2
+_STACK_OPS = bytearray(256)
+for _op in (0xCD, 0xC4, 0xCC, 0xD4, 0xDC, 0xC7, 0xCF, 0xD7, 0xDF, 0xE7, 0xEF, 0xF7, 0xFF):
+  _STACK_OPS[_op] = _CALL
+for _op in (0xC9, 0xD9, 0xC0, 0xC8, 0xD0, 0xD8):
+  _STACK_OPS[_op] = _RET
+
+# Call stacks deeper than this are cut off, rather than growing without bound in code that
+# leaves calls with something other than RET.
+MAX_DEPTH = 64
+
+
+def _counts(size):
+  return array('Q', bytes(8 * size))
+
+
+class Profiler(object):
+  """Profiles cpu between start and stop. The counts accumulate over any number of runs
+  until reset.
+
+  """
+
+  def __init__(self, cpu):
+    self.cpu = cpu
+    self.reset()
+
+  def reset(self):
+    self.opcode_counts = _counts(256)
+    self.ext_opcode_counts = _counts(256)
+    # Executions of each address outside the switchable rom region.
+    self.pc_counts = _counts(0x10000)
+    # Executions of each address in the switchable rom region, per bank, allocated as banks
+    # are first seen.
+    self.bank_counts = []
+    self.page_cycles = _counts(256)
+
+    # The stacks seen so far, as tuples of (bank, address) frames, outermost first, by id,
+    # and the ids by stack. Cycles are counted per stack id.
+    self.stacks = [()]
+    self._stack_ids = {(): 0}
+    self.stack_cycles = _counts(1)
+    self._stack = ()
+    self.stack_id = 0
+    # Calls deeper than MAX_DEPTH that haven't returned yet.
+    self._overflow = 0
+
+    self._bank = None
+    self.romx_counts = None
+    self._bank_changed()
+
+  @property
+  def running(self):
+    return type(self.cpu) is _ProfilingCpu
+
+  def start(self):
+    if self.running:
+      return
+    cpu = self.cpu
+    if type(cpu) is not Cpu:
+      raise ValueError("Can't profile the cpu while a debugger is watching memory.")
+    cpu.profiler = self
+    cpu.__class__ = _ProfilingCpu
+    cpu.mmu.add_remap_listener(self._remapped)
+    self._bank_changed()
+
+  def stop(self):
+    if not self.running:
+      return
+    cpu = self.cpu
+    cpu.__class__ = Cpu
+    cpu.profiler = None
+    cpu.mmu.remove_remap_listener(self._remapped)
+
+  def _remapped(self, first, last):
+    if first < ROMX_END >> 8 and last >= ROMX_START >> 8:
+      self._bank_changed()
+
+  def _bank_changed(self):
+    """Point romx_counts at the counts of the rom bank now mapped."""
+    bank = getattr(self.cpu.mmu.cartridge, 'rom_bank', 1)
+    if bank == self._bank:
+      return
+    self._bank = bank
+    counts = self.bank_counts
+    if bank >= len(counts):
+      counts.extend([None] * (bank + 1 - len(counts)))
+    if counts[bank] is None:
+      counts[bank] = _counts(BANK_SIZE)
+    self.romx_counts = counts[bank]
+
+  def _frame(self, addr):
+    """The (bank, address) frame for code at addr. The bank is 0 outside switchable rom."""
+    return (self._bank if ROMX_START <= addr < ROMX_END else 0), addr
+
+  def _set_stack(self, stack):
+    stack_id = self._stack_ids.get(stack)
+    if stack_id is None:
+      stack_id = self._stack_ids[stack] = len(self.stacks)
+      self.stacks.append(stack)
+      self.stack_cycles.append(0)
+    self._stack = stack
+    self.stack_id = stack_id
+    return stack_id
+
+  def _call(self, target):
+    """Enter the function at target. Returns the new stack id."""
+    if len(self._stack) >= MAX_DEPTH:
+      self._overflow += 1
+      return self.stack_id
+    return self._set_stack(self._stack + (self._frame(target),))
+
+  def _return(self):
+    """Leave the current function, if any. Returns the new stack id."""
+    if self._overflow:
+      self._overflow -= 1
+      return self.stack_id
+    if not self._stack:
+      return self.stack_id
+    return self._set_stack(self._stack[:-1])
+
+  def hot_addresses(self, top=None):
+    """Return ((bank, address), executions) for the most executed addresses, most first.
+    The bank is 0 outside the switchable rom region.
+
+    """
+    counts = [((0, pc), count) for pc, count in enumerate(self.pc_counts) if count]
+    for bank, bank_counts in enumerate(self.bank_counts):
+      if bank_counts is not None:
+        counts.extend(((bank, ROMX_START + offset), count)
+                      for offset, count in enumerate(bank_counts) if count)
+    counts.sort(key=lambda item: (-item[1], item[0]))
+    return counts[:top]
+
+  def region_cycles(self):
+    """Return (region name, cycles) for each of REGIONS."""
+    return [(name, sum(self.page_cycles[first:last + 1])) for name, first, last in REGIONS]
+
+  def report(self, top=20):
+    """Return a text report of the top opcodes, 0xCB opcodes and addresses by executions,
+    and of the cycles spent in each region.
+
+    """
+    lines = []
+
+    def table(title, rows, total):
+      lines.append(title)
+      for count, label in rows:
+        lines.append("  %12d %6.2f%%  %s" % (count, 100.0 * count / (total or 1), label))
+      lines.append("")
+
+    def top_opcodes(counts, mnemonics, fmt):
+      ops = sorted((op for op in range(256) if counts[op]), key=lambda op: -counts[op])
+      return [(counts[op], fmt % (op, mnemonics[op])) for op in ops[:top]]
+
+    executed = sum(self.opcode_counts)
+    table("Opcodes (%d instructions)" % executed,
+          top_opcodes(self.opcode_counts, Cpu.mnemonics, "%02X     %s"), executed)
+    table("0xCB opcodes", top_opcodes(self.ext_opcode_counts, Cpu.ext_mnemonics,
+                                      "CB %02X  %s"), executed)
+    table("Addresses", [(count, _frame_name(frame))
+                        for frame, count in self.hot_addresses(top)], executed)
+    regions = self.region_cycles()
+    cycles = sum(count for _, count in regions)
+    table("Cycles by region (%d cycles)" % cycles,
+          [(count, name) for name, count in regions if count], cycles)
+    return '\n'.join(lines)
+
+  def write_collapsed(self, f, root='root'):
+    """Write the cycles spent in each call stack to the text file f, in the collapsed
+    stack format read by flamegraph.pl: one line per stack, of its frames from the
+    outermost separated by semicolons, a space, and its cycles.
+
+    """
+    lines = []
+    for stack_id, stack in enumerate(self.stacks):
+      cycles = self.stack_cycles[stack_id]
+      if cycles:
+        frames = [root] + [_frame_name(frame) for frame in stack]
+        lines.append('%s %d\n' % (';'.join(frames), cycles))
+    f.writelines(sorted(lines))
+
+
+def _frame_name(frame):
+  bank, addr = frame
+  if ROMX_START <= addr < ROMX_END:
+    return '%02X:%04X' % (bank, addr)
+  return '%04X' % addr
+
+
+class _ProfilingCpu(Cpu):
+  """What a Cpu becomes while profiled, see Profiler.start. Only the run loop differs."""
+  __slots__ = ()
+
+  def run(self, max_cycles):
+    """Cpu.run, an instruction at a time, counting everything into the profiler."""
+    profiler = self.profiler
+    start = self.cycles
+    end = start + max_cycles
+    ops = self.ops
+    pages = self.mmu.read_pages
+    stack_ops = _STACK_OPS
+    opcode_counts = profiler.opcode_counts
+    ext_opcode_counts = profiler.ext_opcode_counts
+    pc_counts = profiler.pc_counts
+    page_cycles = profiler.page_cycles
+    stack_cycles = profiler.stack_cycles
+    stack_id = profiler.stack_id
+
+    sp = self.sp
+    reason = self._service(end)
+    while reason is None:
+      if self.sp == (sp - 2) & 0xFFFF:
+        # An interrupt was dispatched.
+        stack_id = profiler._call(self.pc)
+      while self.cycles < self._yield_at:
+        pc = self.pc
+        op = pages[pc >> 8][pc & 0xFF]
+        self.pc = (pc + 1) & 0xFFFF
+        if op == 0xCB:
+          # Before the instruction runs, since it can write over its own sub-opcode.
+          ext_pc = (pc + 1) & 0xFFFF
+          ext_opcode_counts[pages[ext_pc >> 8][ext_pc & 0xFF]] += 1
+        stack_op = stack_ops[op]
+        sp = self.sp
+        cycles = ops[op](self)
+        self.cycles += cycles
+
+        opcode_counts[op] += 1
+        if ROMX_START <= pc < ROMX_END:
+          profiler.romx_counts[pc - ROMX_START] += 1
+        else:
+          pc_counts[pc] += 1
+        page_cycles[pc >> 8] += cycles
+        stack_cycles[stack_id] += cycles
+
+        if stack_op:
+          if stack_op == _CALL and self.sp == (sp - 2) & 0xFFFF:
+            stack_id = profiler._call(self.pc)
+          elif stack_op == _RET and self.sp == (sp + 2) & 0xFFFF:
+            stack_id = profiler._return()
+      sp = self.sp
+      reason = self._service(end)
+    return self.cycles - start, reason
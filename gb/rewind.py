@@ -0,0 +1,246 @@
+"""Stepping back through execution, with a ring buffer of snapshots of a machine.
+
+A snapshot is taken in two parts. The registers of every component are small, so they are
+saved whole, as a save state blob without memory (see gb.state). Memory (wram, vram, oam
+and cartridge ram, see Mmu.memory_regions) is saved a page at a time, and only the pages
+written since the previous snapshot are saved, as the xor of their old and new contents,
+which is mostly zeros and compresses well. Written pages are found with write traps (see
+Mmu.trap_writes): a page costs nothing until its first write after a snapshot, and taking
+a snapshot never looks at the pages that weren't written, so recording can be left on.
+
+Every keyframe_interval snapshots, a keyframe saves all of memory instead. Restoring a
+snapshot starts from the keyframe before it and applies the deltas since. When the
+snapshots take up more than max_bytes, the oldest keyframe is dropped, along with the
+deltas that depend on it.
+
+"""
+
+import zlib
+
+from gb.cpu import FRAME_CYCLES
+from gb.mmu import PAGE_SHIFT, PAGE_SIZE
+
+# zlib level snapshots are compressed with. Speed matters more than size here, and the
+# deltas compress well regardless.
+COMPRESSION = 1
+
+
+def _xor(a, b):
+  """Return the xor of the bytes-like objects a and b, which are the same length. They are
+  xored as two whole numbers, which keeps the loop over the bytes out of python code.
+
+  """
+  return (int.from_bytes(a, 'little') ^ int.from_bytes(b, 'little')).to_bytes(
+    len(a), 'little')
+
+
+class _Snapshot(object):
+  __slots__ = ('cycles', 'registers', 'keyframe', 'pages', 'data')
+
+  def __init__(self, cycles, registers, keyframe, pages, data):
+    self.cycles = cycles
+    # The compressed save state blob without memory.
+    self.registers = registers
+    # For a keyframe, the (region name, size) of each region in data, which holds all of
+    # them. Otherwise the (region name, page) of each page in data, which holds their
+    # deltas from the previous snapshot.
+    self.keyframe = keyframe
+    self.pages = pages
+    self.data = data
+
+  @property
+  def size(self):
+    return len(self.registers) + len(self.data)
+
+
+class Rewind(object):
+  """Records snapshots of machine, and puts it back in the state of any of them.
+
+  Snapshots are taken by calling snapshot, or every interval clock cycles after start is
+  called. interval defaults to a frame.
+
+  """
+
+  def __init__(self, machine, interval=FRAME_CYCLES, keyframe_interval=60,
+               max_bytes=64 << 20):
+    self.machine = machine
+    self.interval = interval
+    self.keyframe_interval = keyframe_interval
+    self.max_bytes = max_bytes
+    # Compressed bytes held by the snapshots.
+    self.memory_used = 0
+
+    self._snapshots = []
+    # Snapshots taken since the last keyframe, including it.
+    self._since_keyframe = 0
+    # (region name, size) of each memory region, as of the last keyframe.
+    self._layout = None
+    # Contents of each memory region as of the last snapshot, by name.
+    self._shadow = {}
+    # The (region name, page) of the region pages written through each page of the
+    # address space.
+    self._page_map = {}
+    # Region pages written since the last snapshot, and the pages of the address space
+    # they were written through.
+    self._dirty = set()
+    self._sprung = set()
+    self._event = None
+
+  def __len__(self):
+    return len(self._snapshots)
+
+  @property
+  def times(self):
+    """The cycle count each snapshot was taken at, oldest first."""
+    return [snapshot.cycles for snapshot in self._snapshots]
+
+  def start(self):
+    """Take a snapshot now, and every interval cycles from then on, from an event on the
+    machine's scheduler.
+
+    """
+    if self._event is None:
+      self.snapshot()
+      cpu = self.machine.cpu
+      self._event = cpu.scheduler.schedule(cpu.cycles + self.interval, self._tick)
+
+  def stop(self):
+    if self._event is not None:
+      self.machine.cpu.scheduler.cancel(self._event)
+      self._event = None
+
+  def _tick(self, deadline):
+    self.snapshot()
+    self.machine.cpu.scheduler.reschedule(self._event, deadline + self.interval)
+
+  def _written(self, page):
+    """Write trap callback."""
+    self._dirty.update(self._page_map.get(page, ()))
+    self._sprung.add(page)
+
+  def snapshot(self):
+    """Record the current state of the machine."""
+    machine = self.machine
+    regions = machine.mmu.memory_regions()
+    registers = zlib.compress(machine.save_state(memory=False), COMPRESSION)
+    layout = tuple((name, len(buffer)) for name, buffer, _ in regions)
+    if (not self._snapshots or self._since_keyframe >= self.keyframe_interval or
+        layout != self._layout):
+      snapshot = self._keyframe(registers, regions, layout)
+    else:
+      snapshot = self._delta(registers, regions)
+    self._snapshots.append(snapshot)
+    self._since_keyframe += 1
+    self.memory_used += snapshot.size
+    self._evict()
+
+  def _keyframe(self, registers, regions, layout):
+    self._layout = layout
+    self._shadow = dict((name, bytearray(buffer)) for name, buffer, _ in regions)
+    data = zlib.compress(b''.join(buffer for _, buffer, _ in regions), COMPRESSION)
+    self._since_keyframe = 0
+    self._track(regions)
+    return _Snapshot(self.machine.cpu.cycles, registers, True, layout, data)
+
+  def _delta(self, registers, regions):
+    buffers = dict((name, buffer) for name, buffer, _ in regions)
+    pages = tuple(sorted(self._dirty))
+    deltas = []
+    for name, page in pages:
+      start = page << PAGE_SHIFT
+      new = buffers[name][start:start + PAGE_SIZE]
+      old = self._shadow[name]
+      deltas.append(_xor(old[start:start + PAGE_SIZE], new))
+      old[start:start + PAGE_SIZE] = new
+    data = zlib.compress(b''.join(deltas), COMPRESSION)
+
+    # Wait for the next write to the pages that were written.
+    mmu = self.machine.mmu
+    for page in self._sprung:
+      mmu.trap_writes(page, self._written)
+    self._dirty = set()
+    self._sprung = set()
+    return _Snapshot(self.machine.cpu.cycles, registers, False, pages, data)
+
+  def _track(self, regions):
+    """Map the pages of the address space to the region pages they write, and trap writes
+    to all of them.
+
+    """
+    page_map = self._page_map = {}
+    for name, buffer, ranges in regions:
+      for first, last in ranges:
+        for page in range(first, last + 1):
+          if (page - first) << PAGE_SHIFT < len(buffer):
+            page_map.setdefault(page, []).append((name, page - first))
+    mmu = self.machine.mmu
+    for page in page_map:
+      mmu.trap_writes(page, self._written)
+    self._dirty = set()
+    self._sprung = set()
+
+  def _evict(self):
+    """Drop the oldest keyframes and their deltas until we are within max_bytes, keeping
+    at least the newest keyframe.
+
+    """
+    snapshots = self._snapshots
+    while self.memory_used > self.max_bytes:
+      end = next((i for i in range(1, len(snapshots)) if snapshots[i].keyframe), None)
+      if end is None:
+        break
+      self.memory_used -= sum(snapshot.size for snapshot in snapshots[:end])
+      del snapshots[:end]
+
+  def _contents(self, index):
+    """Return the contents of each memory region as of snapshot index, by name, and the
+    number of snapshots from the keyframe they were rebuilt from up to index.
+
+    """
+    snapshots = self._snapshots
+    key = index
+    while not snapshots[key].keyframe:
+      key -= 1
+
+    data = zlib.decompress(snapshots[key].data)
+    contents = {}
+    pos = 0
+    for name, size in snapshots[key].pages:
+      contents[name] = bytearray(data[pos:pos + size])
+      pos += size
+    for snapshot in snapshots[key + 1:index + 1]:
+      data = zlib.decompress(snapshot.data)
+      pos = 0
+      for name, page in snapshot.pages:
+        buffer = contents[name]
+        start = page << PAGE_SHIFT
+        old = buffer[start:start + PAGE_SIZE]
+        buffer[start:start + PAGE_SIZE] = _xor(old, data[pos:pos + len(old)])
+        pos += len(old)
+    return contents, index - key + 1
+
+  def restore(self, index=-1):
+    """Put the machine back in the state of snapshot index, counting from the oldest, or
+    back from the newest if negative. The snapshots after it are dropped, so recording
+    carries on from there.
+
+    """
+    snapshots = self._snapshots
+    index = range(len(snapshots))[index]
+    contents, since_keyframe = self._contents(index)
+
+    machine = self.machine
+    regions = machine.mmu.memory_regions()
+    for name, buffer, _ in regions:
+      buffer[:] = contents[name]
+    # This also springs every write trap, since memory changed underneath them.
+    machine.load_state(zlib.decompress(snapshots[index].registers))
+
+    for snapshot in snapshots[index + 1:]:
+      self.memory_used -= snapshot.size
+    del snapshots[index + 1:]
+    self._since_keyframe = since_keyframe
+    self._shadow = contents
+    self._track(regions)
+    if self._event is not None:
+      machine.cpu.scheduler.reschedule(self._event, machine.cpu.cycles + self.interval)
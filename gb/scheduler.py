@@ -0,0 +1,111 @@
+import heapq
+import itertools
+
+# Deadline of a scheduler with nothing scheduled. Larger than any cycle count we will reach,
+# but still an int so comparisons against it stay fast.
+NEVER = 1 << 62
+
+
+class Event(object):
+  """Handle for a scheduled event, returned by Scheduler.schedule."""
+  __slots__ = ('deadline', 'callback', '_seq')
+
+  def __init__(self, deadline, callback):
+    self.deadline = deadline
+    self.callback = callback
+    self._seq = None
+
+  @property
+  def pending(self):
+    return self._seq is not None
+
+
+class Scheduler(object):
+  """Central timeline for peripherals, keyed by absolute cpu cycle.
+
+  Devices schedule callbacks at the cycle they need to run, rather than being ticked after
+  every instruction. The cpu run loop only looks at the scheduler when next_deadline is
+  reached, and calls run_due then. Callbacks are called with the deadline they were
+  scheduled for, which may be a little before the current cycle count, so periodic devices
+  should schedule their next event relative to it to avoid drifting.
+
+  Events are kept in a heap. Cancelled and rescheduled events are left in the heap and
+  skipped when they reach the top.
+
+  """
+
+  def __init__(self):
+    self._heap = []
+    self._seq = itertools.count()
+    # Deadline of the earliest pending event.
+    self.next_deadline = NEVER
+    # Object whose cycles attribute is the current time; the cpu sets itself here.
+    self.clock = None
+    # Called with the new next_deadline whenever it moves earlier, so a running loop can
+    # stop in time for it.
+    self.on_earlier_deadline = None
+
+  @property
+  def now(self):
+    return self.clock.cycles if self.clock is not None else 0
+
+  def schedule(self, deadline, callback):
+    """Call callback(deadline) once the cycle count reaches deadline. Returns an Event
+    which can be passed to reschedule and cancel.
+
+    """
+    event = Event(deadline, callback)
+    self._push(event)
+    return event
+
+  def schedule_in(self, delay, callback):
+    """Call callback(deadline) delay cycles from now."""
+    return self.schedule(self.now + delay, callback)
+
+  def reschedule(self, event, deadline):
+    """Move event to deadline. Works for events that have already run or been cancelled,
+    which puts them back on the timeline.
+
+    """
+    event.deadline = deadline
+    self._push(event)
+
+  def cancel(self, event):
+    if event._seq is None:
+      return
+    event._seq = None
+    if self._heap and self._heap[0][2] is event:
+      self._pop_stale()
+      self.next_deadline = self._heap[0][0] if self._heap else NEVER
+
+  def _push(self, event):
+    event._seq = next(self._seq)
+    heapq.heappush(self._heap, (event.deadline, event._seq, event))
+    if event.deadline < self.next_deadline:
+      self.next_deadline = event.deadline
+      if self.on_earlier_deadline is not None:
+        self.on_earlier_deadline(event.deadline)
+    elif self._heap[0][1] != self._heap[0][2]._seq:
+      # The top may be the old entry of an event that was just rescheduled later.
+      self._pop_stale()
+      self.next_deadline = self._heap[0][0]
+
+  def _pop_stale(self):
+    heap = self._heap
+    while heap and heap[0][1] != heap[0][2]._seq:
+      heapq.heappop(heap)
+
+  def run_due(self, now):
+    """Run every event with a deadline at or before now, in deadline order. Events
+    scheduled by the callbacks are run too if they are due.
+
+    """
+    heap = self._heap
+    while heap and heap[0][0] <= now:
+      deadline, seq, event = heapq.heappop(heap)
+      if seq != event._seq:
+        continue
+      event._seq = None
+      event.callback(deadline)
+    self._pop_stale()
+    self.next_deadline = heap[0][0] if heap else NEVER
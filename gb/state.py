@@ -0,0 +1,84 @@
+"""The binary save state format.
+
+Each component saves itself as a blob starting with a header of a four byte magic string
+and a version number. The rest is struct-packed fields and length-prefixed sections,
+which are raw copies of memory buffers or the nested blobs of other components. Nothing
+is pickled, so loading a state is a handful of struct unpacks and buffer copies.
+
+Components can also leave their memory out of a blob (save_state(memory=False)), which
+saves empty sections in place of the memory buffers. Loading such a blob leaves the memory
+as it is. The rewind buffer (see gb.rewind) stores memory itself, a page at a time.
+
+"""
+
+import struct
+
+_HEADER = struct.Struct('<4sB')
+_LENGTH = struct.Struct('<I')
+
+
+class StateError(Exception):
+  """Error raised when loading a save state that is corrupt or of the wrong kind."""
+  pass
+
+
+class StateWriter(object):
+  """Accumulates the parts of a blob. Call value to get the blob."""
+
+  def __init__(self, magic, version):
+    self._parts = [_HEADER.pack(magic, version)]
+
+  def pack(self, fmt, *values):
+    self._parts.append(struct.pack('<' + fmt, *values))
+
+  def section(self, data):
+    """Add a length-prefixed section holding the bytes-like object data."""
+    self._parts.append(_LENGTH.pack(len(data)))
+    self._parts.append(data)
+
+  def value(self):
+    return b''.join(self._parts)
+
+
+class StateReader(object):
+  """Reads back the parts of a blob written by StateWriter, checking its header."""
+
+  def __init__(self, data, magic, version):
+    self._data = memoryview(data)
+    self._pos = 0
+    found, found_version = self.unpack('4sB')
+    if found != magic:
+      raise StateError("Expected a %r save state, found %r." % (magic, found))
+    if found_version != version:
+      raise StateError(
+        "Unsupported %r save state version %d (expected %d)." % (magic, found_version, version))
+
+  def unpack(self, fmt):
+    fmt = struct.Struct('<' + fmt)
+    if self._pos + fmt.size > len(self._data):
+      raise StateError("Save state is truncated.")
+    values = fmt.unpack_from(self._data, self._pos)
+    self._pos += fmt.size
+    return values
+
+  def section(self):
+    """Return the next section as a memoryview of the blob."""
+    length, = self.unpack('I')
+    if self._pos + length > len(self._data):
+      raise StateError("Save state is truncated.")
+    data = self._data[self._pos:self._pos + length]
+    self._pos += length
+    return data
+
+  def buffer(self, dest):
+    """Copy the next section into the buffer dest, in place. It must be the same size, or
+    empty, meaning the buffer was left out of the blob, in which case dest is left alone.
+
+    """
+    data = self.section()
+    if not len(data):
+      return
+    if len(data) != len(dest):
+      raise StateError(
+        "Save state section is %d bytes, expected %d." % (len(data), len(dest)))
+    dest[:] = data
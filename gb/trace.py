@@ -0,0 +1,349 @@
+"""Instruction traces: recording every instruction a cpu runs to a file, and reading and
+comparing the results.
+
+A Tracer writes a fixed size binary record per instruction, of the cycle count, pc, rom
+bank and opcode, and the registers before the instruction runs. Records are packed straight
+into preallocated chunks, and a background thread writes full chunks to the file while the
+cpu fills the next one, so that tracing can be left on for runs of many millions of
+instructions. If the file can't keep up, the cpu waits for a free chunk rather than
+dropping records.
+
+Like profiling, tracing costs nothing while it is off: starting it swaps the cpu's class
+for a subclass whose run loop executes an instruction at a time and records it, and
+stopping it swaps the class back. The interpreter (execute_instr, run_until) isn't traced,
+and breakpoints (see gb.debug) aren't seen while tracing.
+
+Traces can be listed and compared from the command line:
+
+  python -m gb.trace show trace.bin --start 1000 --count 20
+  python -m gb.trace diff good.bin bad.bin
+
+where diff prints the first record where the traces differ, with the records before it.
+
+"""
+
+import argparse
+import collections
+import queue
+import struct
+import sys
+import threading
+
+from gb.cpu import Cpu
+from gb.opcodes import PAIR_AF, PAIR_BC, PAIR_DE, PAIR_HL
+
+# File header: magic, format version and record size.
+TRACE_MAGIC = b'GBTR'
+TRACE_VERSION = 1
+HEADER = struct.Struct('<4sHH')
+
+# A record: cycles, pc, the switchable rom bank mapped, opcode, a padding byte, the register
+# file (see Cpu.regs) and sp.
+RECORD = struct.Struct('<QHHBx8sH')
+RECORD_SIZE = RECORD.size
+
+# Records per chunk, and chunks, of the buffer records are packed into.
+CHUNK_RECORDS = 1 << 14
+CHUNKS = 4
+
+# Records read at a time from trace files.
+READ_RECORDS = 1 << 12
+
+# A record as read back, with the register pairs put together.
+Record = collections.namedtuple(
+  'Record', ['cycles', 'pc', 'bank', 'opcode', 'af', 'bc', 'de', 'hl', 'sp'])
+
+
+class TraceError(Exception):
+  """Error raised for files which aren't traces, and for failures writing them."""
+  pass
+
+
+class Tracer(object):
+  """Traces cpu to f, a binary file, between start and stop. Tracing can be started and
+  stopped any number of times, appending to the same trace. Each stop waits until every
+  record so far is in f.
+
+  """
+
+  def __init__(self, cpu, f, chunk_records=CHUNK_RECORDS, chunks=CHUNKS):
+    self.cpu = cpu
+    self.f = f
+    self._chunk_size = chunk_records * RECORD_SIZE
+    self._chunks = chunks
+    # Whether the header and chunks have been made, on the first start.
+    self._begun = False
+    # Records handed to the writer so far.
+    self._written = 0
+    # The chunk being filled and the offset of the next record in it, while tracing.
+    self._chunk = None
+    self._offset = 0
+    # The switchable rom bank mapped, for the records.
+    self.bank = 0
+    # Chunks waiting to be written, as (chunk, length), and chunks free to be filled.
+    self._full = queue.Queue()
+    self._free = queue.Queue()
+    self._writer = None
+    self._error = None
+
+  @property
+  def running(self):
+    return type(self.cpu) is _TracingCpu
+
+  @property
+  def records(self):
+    """The number of instructions traced."""
+    return self._written + self._offset // RECORD_SIZE
+
+  def start(self):
+    if self.running:
+      return
+    cpu = self.cpu
+    if type(cpu) is not Cpu:
+      raise ValueError("Can't trace the cpu while it is being profiled or watched.")
+    if not self._begun:
+      self.f.write(HEADER.pack(TRACE_MAGIC, TRACE_VERSION, RECORD_SIZE))
+      for _ in range(self._chunks):
+        self._free.put(bytearray(self._chunk_size))
+      self._begun = True
+    self._chunk = self._free.get()
+    self._offset = 0
+    self._writer = threading.Thread(target=self._write_chunks, name='gb.trace writer')
+    self._writer.daemon = True
+    self._writer.start()
+    cpu.tracer = self
+    cpu.__class__ = _TracingCpu
+    cpu.mmu.add_remap_listener(self._remapped)
+    self._remapped(0x40, 0x7F)
+
+  def stop(self):
+    """Stop tracing, and wait for every record so far to be written."""
+    if not self.running:
+      return
+    cpu = self.cpu
+    cpu.__class__ = Cpu
+    cpu.tracer = None
+    cpu.mmu.remove_remap_listener(self._remapped)
+    self._next_chunk(self._offset, last=True)
+    self._full.put(None)
+    self._writer.join()
+    self._writer = None
+    self.f.flush()
+    if self._error is not None:
+      error, self._error = self._error, None
+      raise TraceError("Writing the trace failed: %s" % error)
+
+  def _remapped(self, first, last):
+    if first <= 0x7F and last >= 0x40:
+      self.bank = getattr(self.cpu.mmu.cartridge, 'rom_bank', 1)
+      # Make the run loop pick up the new bank.
+      self.cpu._yield_at = 0
+
+  def _next_chunk(self, offset, last=False):
+    """Hand the chunk being filled, filled up to offset, to the writer, and return the
+    next one to fill, waiting for the writer to free one if need be, unless last.
+
+    """
+    self._written += offset // RECORD_SIZE
+    self._full.put((self._chunk, offset))
+    self._chunk = None if last else self._free.get()
+    self._offset = 0
+    return self._chunk
+
+  def _write_chunks(self):
+    """The writer thread: write chunks until stop."""
+    f = self.f
+    while True:
+      item = self._full.get()
+      if item is None:
+        return
+      chunk, length = item
+      try:
+        if self._error is None:
+          f.write(memoryview(chunk)[:length])
+      except Exception as e:
+        # Keep freeing chunks, so the cpu doesn't wait forever, and report it at stop.
+        self._error = e
+      self._free.put(chunk)
+
+
+class _TracingCpu(Cpu):
+  """What a Cpu becomes while traced, see Tracer.start. Only the run loop differs."""
+  __slots__ = ()
+
+  def run(self, max_cycles):
+    """Cpu.run, an instruction at a time, recording each one into the tracer."""
+    tracer = self.tracer
+    start = self.cycles
+    end = start + max_cycles
+    ops = self.ops
+    pages = self.mmu.read_pages
+    regs = self.regs
+    pack_into = RECORD.pack_into
+    chunk_size = tracer._chunk_size
+
+    reason = self._service(end)
+    while reason is None:
+      chunk = tracer._chunk
+      offset = tracer._offset
+      bank = tracer.bank
+      try:
+        while self.cycles < self._yield_at:
+          pc = self.pc
+          op = pages[pc >> 8][pc & 0xFF]
+          pack_into(chunk, offset, self.cycles, pc, bank, op, regs, self.sp)
+          offset += RECORD_SIZE
+          if offset == chunk_size:
+            chunk = tracer._next_chunk(offset)
+            offset = 0
+          self.pc = (pc + 1) & 0xFFFF
+          self.cycles += ops[op](self)
+      finally:
+        # Keep what was recorded even if an instruction raised.
+        tracer._offset = offset
+      reason = self._service(end)
+    return self.cycles - start, reason
+
+
+def _record(fields):
+  cycles, pc, bank, opcode, regs, sp = fields
+  regs = bytearray(regs)
+  return Record(cycles, pc, bank, opcode,
+                regs[PAIR_AF[0]] << 8 | regs[PAIR_AF[1]],
+                regs[PAIR_BC[0]] << 8 | regs[PAIR_BC[1]],
+                regs[PAIR_DE[0]] << 8 | regs[PAIR_DE[1]],
+                regs[PAIR_HL[0]] << 8 | regs[PAIR_HL[1]], sp)
+
+
+def _read_header(f):
+  header = f.read(HEADER.size)
+  if len(header) < HEADER.size:
+    raise TraceError("Not a trace: too short.")
+  magic, version, record_size = HEADER.unpack(header)
+  if magic != TRACE_MAGIC:
+    raise TraceError("Not a trace: bad magic %r." % magic)
+  if version != TRACE_VERSION or record_size != RECORD_SIZE:
+    raise TraceError("Unsupported trace version %d." % version)
+
+
+def _blocks(f, start=0):
+  """Yield the records of the trace in f, from record start, as blocks of packed
+  records.
+
+  """
+  _read_header(f)
+  if start:
+    f.seek(start * RECORD_SIZE, 1)
+  while True:
+    block = f.read(READ_RECORDS * RECORD_SIZE)
+    # A partly written last record is left out.
+    block = block[:len(block) - len(block) % RECORD_SIZE]
+    if not block:
+      return
+    yield block
+
+
+def read_trace(f, start=0):
+  """Yield the Records of the trace in the binary file f, from record start."""
+  for block in _blocks(f, start):
+    for fields in RECORD.iter_unpack(block):
+      yield _record(fields)
+
+
+def first_divergence(f1, f2):
+  """Find the first record where the traces in the binary files f1 and f2 differ. Returns
+  (index, record from f1, record from f2), where a record is None if its trace ended
+  first, or None if the traces are the same.
+
+  """
+  blocks1 = _blocks(f1)
+  blocks2 = _blocks(f2)
+  index = 0
+  pending1 = pending2 = b''
+  while True:
+    if not pending1:
+      pending1 = next(blocks1, b'')
+    if not pending2:
+      pending2 = next(blocks2, b'')
+    if not pending1 and not pending2:
+      return None
+    length = min(len(pending1), len(pending2))
+    # Whole blocks are compared at once; records only once they differ.
+    if length and pending1[:length] == pending2[:length]:
+      pending1 = pending1[length:]
+      pending2 = pending2[length:]
+      index += length // RECORD_SIZE
+      continue
+    for offset in range(0, length, RECORD_SIZE):
+      end = offset + RECORD_SIZE
+      if pending1[offset:end] != pending2[offset:end]:
+        return (index + offset // RECORD_SIZE,
+                _record(RECORD.unpack(pending1[offset:end])),
+                _record(RECORD.unpack(pending2[offset:end])))
+    # One trace ended.
+    return (index + length // RECORD_SIZE,
+            _record(RECORD.unpack(pending1[length:length + RECORD_SIZE]))
+            if len(pending1) > length else None,
+            _record(RECORD.unpack(pending2[length:length + RECORD_SIZE]))
+            if len(pending2) > length else None)
+
+
+def format_record(record):
+  """Return a line of text for record."""
+  return "%12d %02X:%04X  %02X %-14s AF=%04X BC=%04X DE=%04X HL=%04X SP=%04X" % (
+    record.cycles, record.bank, record.pc, record.opcode, Cpu.mnemonics[record.opcode],
+    record.af, record.bc, record.de, record.hl, record.sp)
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(
+    prog='python -m gb.trace', description="List and compare instruction traces.")
+  commands = parser.add_subparsers(dest='command')
+  show = commands.add_parser('show', help="list the records of a trace")
+  show.add_argument('trace')
+  show.add_argument('--start', type=int, default=0, help="first record to list")
+  show.add_argument('--count', type=int, default=None,
+                    help="records to list (default: all)")
+  diff = commands.add_parser(
+    'diff', help="find the first record where two traces differ, exiting with status 1 if "
+                 "they do")
+  diff.add_argument('trace1')
+  diff.add_argument('trace2')
+  diff.add_argument('--context', type=int, default=5,
+                    help="records to list before the difference (default: 5)")
+  args = parser.parse_args(argv)
+
+  out = sys.stdout
+  if args.command == 'show':
+    with open(args.trace, 'rb') as f:
+      for number, record in enumerate(read_trace(f, args.start), args.start):
+        if args.count is not None and number >= args.start + args.count:
+          break
+        out.write("%10d %s\n" % (number, format_record(record)))
+    return 0
+
+  if args.command == 'diff':
+    with open(args.trace1, 'rb') as f1, open(args.trace2, 'rb') as f2:
+      divergence = first_divergence(f1, f2)
+    if divergence is None:
+      out.write("The traces are the same.\n")
+      return 0
+    index, record1, record2 = divergence
+    start = max(0, index - args.context)
+    with open(args.trace1, 'rb') as f:
+      for number, record in enumerate(read_trace(f, start), start):
+        if number >= index:
+          break
+        out.write("  %10d %s\n" % (number, format_record(record)))
+    out.write("The traces differ at record %d:\n" % index)
+    for sign, record in (('-', record1), ('+', record2)):
+      out.write("%s %10d %s\n" % (sign, index, format_record(record) if record is not None
+                                  else "(end of trace)"))
+    return 1
+
+  parser.print_help()
+  return 2
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -17,8 +17,11 @@ setup(
   long_description=read("README.md"),
   packages=["gb"],
   test_suite="test",
-  install_requires=[
-    # Python 2/3 compatibility:
-    "six",
-  ],
+  # The page tables index memoryviews for ints, and the roms are memoryview casts of an
+  # mmap: neither works on Python 2.
+  python_requires=">=3.6",
+  extras_require={
+    # Rendering the screen, see gb.ppu:
+    "render": ["numpy"],
+  },
 )
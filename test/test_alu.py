@@ -0,0 +1,56 @@
+import unittest
+
+from gb.alu import *
+
+def unpack(entry):
+  return entry >> 8, entry & 0xFF
+
+class TestAluTables(unittest.TestCase):
+
+  def test_sizes(self):
+    self.assertEqual(len(ALU_ADC), 0x20000)
+    self.assertEqual(len(ALU_SBC), 0x20000)
+    self.assertEqual(len(ALU_INC), 0x100)
+    self.assertEqual(len(ALU_DAA), 0x800)
+    self.assertEqual(len(ALU_SHIFT), 0x1000)
+
+  def test_add(self):
+    self.assertEqual(unpack(ALU_ADC[0x0F << 8 | 0x01]), (0x10, FLAG_H))
+    self.assertEqual(unpack(ALU_ADC[0xFF << 8 | 0x01]), (0x00, FLAG_Z | FLAG_H | FLAG_C))
+    # adc with the carry in.
+    self.assertEqual(unpack(ALU_ADC[1 << 16 | 0x0E << 8 | 0x01]), (0x10, FLAG_H))
+    for a in range(256):
+      for v in range(256):
+        r, f = unpack(ALU_ADC[a << 8 | v])
+        self.assertEqual(r, (a + v) & 0xFF)
+        self.assertEqual(bool(f & FLAG_C), a + v > 0xFF)
+
+  def test_sub(self):
+    self.assertEqual(unpack(ALU_SBC[0x10 << 8 | 0x01]), (0x0F, FLAG_N | FLAG_H))
+    self.assertEqual(unpack(ALU_SBC[0x01 << 8 | 0x02]), (0xFF, FLAG_N | FLAG_H | FLAG_C))
+    self.assertEqual(unpack(ALU_SBC[1 << 16 | 0x01 << 8 | 0x00]), (0x00, FLAG_N | FLAG_Z))
+
+  def test_inc_dec(self):
+    self.assertEqual(unpack(ALU_INC[0xFF]), (0x00, FLAG_Z | FLAG_H))
+    self.assertEqual(unpack(ALU_DEC[0x00]), (0xFF, FLAG_N | FLAG_H))
+    self.assertEqual(unpack(ALU_DEC[0x01]), (0x00, FLAG_N | FLAG_Z))
+
+  def test_daa(self):
+    # 0x19 + 0x28 = 0x41 with a half carry, which daa corrects to 0x47.
+    self.assertEqual(unpack(ALU_DAA[FLAG_H << 4 | 0x41]), (0x47, 0))
+    self.assertEqual(unpack(ALU_DAA[0x9A]), (0x00, FLAG_Z | FLAG_C))
+    # After a subtraction.
+    self.assertEqual(unpack(ALU_DAA[(FLAG_N | FLAG_H) << 4 | 0x0F]), (0x09, FLAG_N))
+
+  def test_shift(self):
+    rlc, rrc, rl, rr, sla, sra, swap, srl = range(8)
+    self.assertEqual(unpack(ALU_SHIFT[rlc << 9 | 0x81]), (0x03, FLAG_C))
+    self.assertEqual(unpack(ALU_SHIFT[rl << 9 | 1 << 8 | 0x80]), (0x01, FLAG_C))
+    self.assertEqual(unpack(ALU_SHIFT[rr << 9 | 0x01]), (0x00, FLAG_Z | FLAG_C))
+    self.assertEqual(unpack(ALU_SHIFT[sra << 9 | 0x81]), (0xC0, FLAG_C))
+    self.assertEqual(unpack(ALU_SHIFT[swap << 9 | 0x12]), (0x21, 0))
+    self.assertEqual(unpack(ALU_SHIFT[srl << 9 | 0x01]), (0x00, FLAG_Z | FLAG_C))
+
+  def test_shared_values(self):
+    # Equal entries share one int object, so the big tables stay small.
+    self.assertIs(ALU_ADC[0x0101], ALU_ADC[1 << 16 | 0x0100])
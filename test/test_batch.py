@@ -0,0 +1,165 @@
+import io
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+from gb.batch import *
+from gb.cartridge import ROM_TYPE_BYTE
+from gb.machine import Machine
+from gb.trace import read_trace
+
+
+def make_rom(code, data=b''):
+  rom = bytearray(0x8000)
+  rom[ROM_TYPE_BYTE] = 0x01
+  rom[0x100:0x100 + len(code)] = bytearray(code)
+  rom[0x150:0x150 + len(data)] = data
+  return bytes(rom)
+
+
+# Sends the zero terminated string at 0x150 over the serial port, then halts.
+SERIAL_ROM = make_rom([
+  0x21, 0x50, 0x01,  # ld hl,0x150
+  0x2A,              # loop: ld a,(hl+)
+  0xB7,              # or a
+  0x28, 0x0E,        # jr z,done
+  0xE0, 0x01,        # ldh (SB),a
+  0x3E, 0x81,        # ld a,0x81
+  0xE0, 0x02,        # ldh (SC),a
+  0xF0, 0x02,        # wait: ldh a,(SC)
+  0xE6, 0x80,        # and 0x80
+  0x20, 0xFA,        # jr nz,wait
+  0x18, 0xEE,        # jr loop
+  0x76,              # done: halt
+], b'ok\n\0')
+
+# Selects the action buttons and copies P1 to 0xC000 forever.
+JOYPAD_ROM = make_rom([
+  0x3E, 0x10,        # ld a,0x10
+  0xE0, 0x00,        # ldh (P1),a
+  0xF0, 0x00,        # loop: ldh a,(P1)
+  0xEA, 0x00, 0xC0,  # ld (0xC000),a
+  0x18, 0xF9,        # jr loop
+])
+
+
+class TestBatch(unittest.TestCase):
+
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    self.serial_rom = self.write('serial.gb', SERIAL_ROM)
+    self.joypad_rom = self.write('joypad.gb', JOYPAD_ROM)
+
+  def tearDown(self):
+    shutil.rmtree(self.dir)
+
+  def write(self, name, data):
+    path = os.path.join(self.dir, name)
+    with open(path, 'wb') as f:
+      f.write(data)
+    return path
+
+  def test_serial(self):
+    result = run_job(Job(self.serial_rom, frames=10, serial=True))
+    self.assertNotIn('error', result)
+    self.assertEqual(result['serial'], 'ok\n')
+    self.assertEqual(result['reason'], 'halt')
+    self.assertGreater(result['cycles_per_second'], 0)
+
+  def test_inputs(self):
+    jobs = [Job(self.joypad_rom, frames=3, inputs=inputs, memory=[(0xC000, 1)], name=i)
+            for i, inputs in enumerate([(), [(1, ['a'])], [(1, ['a', 'b']), (2, [])]])]
+    results = [run_job(job) for job in jobs]
+    self.assertEqual([result['memory'] for result in results],
+                     [{'0xC000': 'df'}, {'0xC000': 'de'}, {'0xC000': 'df'}])
+    self.assertEqual([result['cycles'] // 1000 for result in results],
+                     [3 * FRAME_CYCLES // 1000] * 3)
+
+  def test_breakpoints(self):
+    result = run_job(Job(self.serial_rom, frames=10, serial=True, breakpoints=['0x113']))
+    self.assertEqual(result['reason'], 'break')
+    self.assertEqual(result['hit']['pc'], 0x113)
+    self.assertEqual(result['serial'], 'o')
+
+    result = run_job(Job(self.joypad_rom, frames=1, watches=[(0xC000, 1, 'w')]))
+    self.assertEqual(result['reason'], 'break')
+    self.assertEqual((result['hit']['kind'], result['hit']['address'], result['hit']['pc']),
+                     ('write', 0xC000, 0x106))
+    with self.assertRaises(ValueError):
+      Job(self.joypad_rom, frames=1, watches=[(0xC000, 1, 'x')])
+
+  def test_trace(self):
+    path = os.path.join(self.dir, 'trace.bin')
+    result = run_job(Job(self.serial_rom, frames=1, trace=path))
+    self.assertNotIn('error', result)
+    with open(path, 'rb') as f:
+      records = list(read_trace(f))
+    self.assertEqual(records[0].pc, 0x100)
+    self.assertEqual(records[-1].opcode, 0x76)
+    with self.assertRaises(ValueError):
+      Job(self.serial_rom, frames=1, trace=path, breakpoints=[0x100])
+
+  @unittest.skipIf(numpy is None, "needs numpy")
+  def test_screenshots(self):
+    shot = os.path.join(self.dir, 'end.png')
+    pattern = os.path.join(self.dir, 'frame%d.png')
+    result = run_job(Job(self.joypad_rom, frames=7, screenshot=shot,
+                         screenshots=[pattern, 3]))
+    self.assertNotIn('error', result)
+    self.assertEqual(result['frames'], 7)
+    with open(shot, 'rb') as f:
+      self.assertEqual(f.read(8), b'\x89PNG\r\n\x1a\n')
+    # Frame 0 was already under way when the job started.
+    self.assertEqual(sorted(name for name in os.listdir(self.dir) if 'frame' in name),
+                     ['frame3.png', 'frame6.png'])
+    with self.assertRaises(ValueError):
+      Job(self.joypad_rom, frames=1, screenshots=[pattern, 0])
+
+  def test_state(self):
+    machine = Machine.from_rom_file(self.joypad_rom)
+    machine.run(1000)
+    machine.mmu[0xC001] = 0x42
+    state = self.write('state', machine.save_state())
+    result = run_job(Job(self.joypad_rom, state, cycles=100, memory=[('0xC001', 1)]))
+    self.assertEqual(result['memory'], {'0xC001': '42'})
+
+  def test_pool(self):
+    jobs = [Job(self.serial_rom, frames=1, serial=True, name=i) for i in range(8)]
+    jobs.append(Job(os.path.join(self.dir, 'missing.gb'), frames=1))
+    results = sorted(run_batch(jobs, processes=2), key=lambda result: result['job'])
+    self.assertEqual([result['job'] for result in results], list(range(9)))
+    self.assertEqual([result['serial'] for result in results[:8]], ['ok\n'] * 8)
+    self.assertIn('error', results[8])
+
+  def test_read_jobs(self):
+    jobs = read_jobs([
+      json.dumps({'rom': 'a.gb', 'frames': 2, 'memory': [['0xFF80', 4]]}),
+      '',
+      json.dumps({'rom': 'b.gb', 'cycles': 5, 'inputs': [[1, ['start']]]}),
+    ])
+    self.assertEqual(jobs[0].cycles, 2 * FRAME_CYCLES)
+    self.assertEqual(jobs[0].memory, [(0xFF80, 4)])
+    self.assertEqual(jobs[1].inputs, [(1, 0x80)])
+    for bad in ({'frames': 1}, {'rom': 'a.gb'}, {'rom': 'a.gb', 'frames': 1, 'speed': 2},
+                {'rom': 'a.gb', 'frames': 1, 'memory': 5}, {'rom': 'a.gb', 'frames': '10'},
+                {'rom': 'a.gb', 'cycles': 1.5}, ['a.gb']):
+      with self.assertRaises(ValueError) as raised:
+        read_jobs(['', json.dumps(bad)])
+      self.assertIn('Job on line 2', str(raised.exception))
+
+  def test_main(self):
+    jobs = self.write('jobs.jsonl', (json.dumps(
+      {'rom': self.serial_rom, 'frames': 1, 'serial': True}) + '\n').encode())
+    output = os.path.join(self.dir, 'results.jsonl')
+    self.assertEqual(main([jobs, '-j', '1', '-o', output]), 0)
+    with open(output) as f:
+      results = [json.loads(line) for line in f]
+    self.assertEqual(len(results), 1)
+    self.assertEqual(results[0]['serial'], 'ok\n')
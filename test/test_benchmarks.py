@@ -0,0 +1,61 @@
+import copy
+import unittest
+
+from benchmarks.roms import *
+from benchmarks.suite import *
+from gb.cartridge import Cartridge
+from gb.machine import Machine
+
+
+class TestRoms(unittest.TestCase):
+
+  def test_assemble(self):
+    code = assemble(['start:', 0x00, 0x18, ('rel', 'start'), 0xC3, ('abs', 'end'), 'end:'])
+    self.assertEqual(code, bytes(bytearray([0x00, 0x18, 0xFD, 0xC3, 0x06, 0x01])))
+    with self.assertRaises(ValueError):
+      assemble(['start:'] + [0x00] * 200 + [0x18, ('rel', 'start')])
+
+  def test_roms_run(self):
+    for name, rom in sorted(ROMS.items()):
+      machine = Machine(Cartridge(rom()))
+      self.assertEqual(machine.run(FRAME_CYCLES)[1], 'cycles', name)
+
+  def test_copy_rom(self):
+    machine = Machine(Cartridge(copy_rom()))
+    machine.run(FRAME_CYCLES)
+    # The code is copied through every region.
+    expected = machine.mmu.read_block(0x100, 0x100)
+    for addr in (0xC000, 0x8000, 0xA000, 0xC100):
+      self.assertEqual(machine.mmu.read_block(addr, 0x100), expected)
+
+  def test_banking_rom(self):
+    machine = Machine(Cartridge(banking_rom()))
+    machine.run(FRAME_CYCLES)
+    # Each ram bank gets the number of the rom bank switched in with it.
+    self.assertEqual([bank[0] for bank in machine.cartridge.rambanks], [0, 1, 2, 3])
+
+
+class TestSuite(unittest.TestCase):
+
+  def test_run_suite(self):
+    results = run_suite(names(), duration=0.001, repeat=1)
+    self.assertEqual(sorted(results['benchmarks']), sorted(names()))
+    for name, metrics in results['benchmarks'].items():
+      self.assertTrue(metrics, name)
+      for metric, value in metrics.items():
+        self.assertTrue(metric.endswith('_per_second'))
+        self.assertGreater(value, 0, '%s %s' % (name, metric))
+
+  def test_compare(self):
+    baseline = {'version': RESULTS_VERSION, 'benchmarks': {
+      'a': {'x_per_second': 100.0, 'y_per_second': 100.0}}}
+    results = copy.deepcopy(baseline)
+    results['benchmarks']['a'].update(x_per_second=95.0, y_per_second=80.0)
+    results['benchmarks']['b'] = {'x_per_second': 1.0}
+    self.assertEqual(compare(baseline, results), [
+      ('a', 'x_per_second', 100.0, 95.0, 0.95, False),
+      ('a', 'y_per_second', 100.0, 80.0, 0.8, True),
+    ])
+    self.assertFalse(any(row[-1] for row in compare(baseline, results, threshold=0.25)))
+    with self.assertRaises(ValueError):
+      compare({'version': 0}, results)
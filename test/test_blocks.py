@@ -0,0 +1,201 @@
+import unittest
+
+from gb.blocks import *
+from gb.cartridge import *
+from gb.cpu import *
+from gb.mem import *
+from gb.mmu import *
+
+class TestBlocks(unittest.TestCase):
+
+  def setUp(self):
+    self.mmu = Mmu(DummyMem(), DummyMem(), DummyMem(), DummyMem())
+    self.mmu.in_bios = False
+    self.cpu = Cpu(self.mmu)
+    self.cpu.sp = 0xFFFE
+
+  def load(self, program, addr=0xC000):
+    self.mmu.write_block(addr, bytearray(program))
+    self.cpu.pc = addr
+
+  def test_block_source(self):
+    code = bytearray(PAGE_SIZE)
+    # ld b,2; loop: dec b; jr nz,loop
+    code[0x10:0x15] = bytearray([0x06, 0x02, 0x05, 0x20, 0xFD])
+    block = compile_block("block", block_source("block", code, 0xC010))
+    self.cpu._yield_at = 1000
+    self.assertEqual(block(self.cpu), 8 + 4 + 12)
+    self.assertEqual(self.cpu.pc, 0xC012)
+    self.assertEqual(self.cpu.b, 1)
+
+    # A block that would run past _yield_at only runs the instructions starting before it.
+    self.cpu._yield_at = 8
+    self.cpu.pc = 0xC010
+    self.mmu.write_block(0xC010, code[0x10:0x15])
+    self.assertEqual(block(self.cpu), 8)
+    self.assertEqual(self.cpu.pc, 0xC012)
+    self.cpu._yield_at = 9
+    self.cpu.pc = 0xC010
+    self.assertEqual(block(self.cpu), 8 + 4)
+    self.assertEqual(self.cpu.pc, 0xC013)
+    self.assertEqual(self.cpu.b, 1)
+
+    # Illegal instructions are left to the interpreter.
+    code[0x20] = 0xD3
+    self.assertIsNone(block_source("block", code, 0xC020))
+
+  def test_matches_interpreter(self):
+    # ld hl,0xC100; ld b,0x20; loop: ld a,b; rlca; xor (hl); ld (hl+),a; call sub;
+    # dec b; jr nz,loop; halt; sub: swap a; push af; pop de; ret
+    program = [0x21, 0x00, 0xC1, 0x06, 0x20, 0x78, 0x07, 0xAE, 0x22, 0xCD, 0x14, 0xC0,
+               0x05, 0x20, 0xF6, 0x76, 0x00, 0x00, 0x00, 0x00, 0xCB, 0x37, 0xF5, 0xD1, 0xC9]
+    self.load(program)
+    cycles, reason = self.cpu.run(100000)
+    state = (self.cpu.af, self.cpu.bc, self.cpu.de, self.cpu.hl, self.cpu.pc, self.cpu.sp,
+             bytes(self.mmu.read_block(0xC100, 0x20)))
+
+    self.setUp()
+    self.load(program)
+    # run_until with a predicate interprets one instruction at a time.
+    self.assertEqual(self.cpu.run_until(predicate=lambda cpu: False), (cycles, reason))
+    self.assertEqual(state, (
+      self.cpu.af, self.cpu.bc, self.cpu.de, self.cpu.hl, self.cpu.pc, self.cpu.sp,
+      bytes(self.mmu.read_block(0xC100, 0x20))))
+
+  def test_fault_location(self):
+    # ld a,5; inc a; ld (0xC100),a; inc a; ld (0xC101),a (which fails); inc a; halt
+    program = [0x3E, 0x05, 0x3C, 0xEA, 0x00, 0xC1, 0x3C, 0xEA, 0x01, 0xC1, 0x3C, 0x76]
+
+    def fail(addr, value, is_write):
+      raise ValueError("Bad write")
+
+    # A failing instruction leaves the cpu past it, without its cycles, whichever way it
+    # runs.
+    states = []
+    for run in (lambda cpu: cpu.run(1000),
+                lambda cpu: cpu.run_until(predicate=lambda cpu: False)):
+      self.setUp()
+      self.load(program)
+      self.mmu.watch(0xC101, fail)
+      with self.assertRaises(ValueError):
+        run(self.cpu)
+      states.append((self.cpu.pc, self.cpu.cycles, self.cpu.a))
+    self.assertEqual(states, [(0xC00A, 8 + 4 + 16 + 4, 7)] * 2)
+
+  def test_self_modifying_code(self):
+    # ld a,0x3C; ld (0xC008),a; nop; nop; nop; nop (becomes inc a); halt
+    self.load([0x3E, 0x3C, 0xEA, 0x08, 0xC0, 0x00, 0x00, 0x00, 0x00, 0x76])
+    self.cpu.run(1000)
+    self.assertEqual(self.cpu.a, 0x3D)
+
+    # Blocks are translated again after the code is rewritten.
+    self.load([0x3E, 0x10, 0x3C, 0x76])
+    self.cpu.halted = False
+    self.cpu.run(1000)
+    self.assertEqual(self.cpu.a, 0x11)
+
+  def test_bank_switch(self):
+    rom = bytearray(0x10000)
+    rom[ROM_TYPE_BYTE] = 0x01
+    # Bank 1: inc b; ret. Bank 2: inc c; ret.
+    rom[0x4000:0x4002] = bytearray([0x04, 0xC9])
+    rom[0x8000:0x8002] = bytearray([0x0C, 0xC9])
+    self.mmu.load_cartridge(Cartridge(bytes(rom)))
+    # ld a,1; ld (0x2000),a; call 0x4000; ld a,2; ld (0x2000),a; call 0x4000; halt
+    self.load([0x3E, 0x01, 0xEA, 0x00, 0x20, 0xCD, 0x00, 0x40,
+               0x3E, 0x02, 0xEA, 0x00, 0x20, 0xCD, 0x00, 0x40, 0x76])
+    bank1 = self.cpu.blocks.page_blocks(0x40)
+    self.cpu.run(1000)
+    self.assertEqual((self.cpu.b, self.cpu.c), (1, 1))
+
+    # Each bank keeps its own blocks.
+    self.assertIsNot(self.cpu.blocks.page_blocks(0x40), bank1)
+    self.mmu[0x2000] = 0x01
+    self.assertIs(self.cpu.blocks.page_blocks(0x40), bank1)
+    self.assertIn(0x4000, bank1)
+
+  def test_interpreted_pages(self):
+    # Code in hram isn't translated.
+    self.load([0x3C, 0x76], addr=0xFF80)
+    self.cpu.run(1000)
+    self.assertEqual(self.cpu.a, 1)
+    self.assertIs(self.cpu.blocks.pages[0xFF][0xFF80], interpret)
+
+
+class TestIdleLoops(unittest.TestCase):
+
+  class Io(bytearray):
+    """Io registers which count reads."""
+    reads = 0
+
+    def __getitem__(self, offset):
+      self.reads += 1
+      return super(TestIdleLoops.Io, self).__getitem__(offset)
+
+  def run_poll(self, run):
+    io = self.Io(0x80)
+    mmu = Mmu(DummyMem(), DummyMem(), DummyMem(), io)
+    mmu.in_bios = False
+    cpu = Cpu(mmu)
+    # loop: ldh a,(0x44); cp 0x90; jr nz,loop; halt
+    mmu.write_block(0xC000, bytearray([0xF0, 0x44, 0xFE, 0x90, 0x20, 0xFA, 0x76]))
+    cpu.pc = 0xC000
+    mmu.scheduler.schedule(10000, lambda deadline: io.__setitem__(0x44, 0x90))
+    return run(cpu), cpu, io.reads
+
+  def test_poll_loop(self):
+    result, cpu, reads = self.run_poll(lambda cpu: cpu.run(100000))
+    self.assertEqual(result[1], REASON_HALT)
+    self.assertEqual(cpu.pc, 0xC007)
+    # Most of the polling is skipped...
+    self.assertLess(reads, 10)
+
+    # ...but it ends up at the same place as running every iteration.
+    expected, interpreted, all_reads = self.run_poll(
+      lambda cpu: cpu.run_until(predicate=lambda cpu: False))
+    self.assertEqual(result, expected)
+    self.assertGreater(all_reads, 300)
+
+  def test_watched_poll_loop(self):
+    # Read watches see every poll, as when interpreting.
+    def run(cpu, polls):
+      cpu.mmu.watch(0xFF44, lambda addr, value, is_write: polls.append(value), reads=True)
+      return cpu.run(100000)
+    polls = []
+    result, cpu, reads = self.run_poll(lambda cpu: run(cpu, polls))
+    self.assertEqual(result[1], REASON_HALT)
+    self.assertEqual(polls[-1], 0x90)
+    self.assertEqual(len(polls), reads)
+    self.assertGreater(reads, 300)
+
+  def test_counting_loop(self):
+    # A loop that changes registers on every iteration is not idle.
+    mmu = Mmu(DummyMem(), DummyMem(), DummyMem(), DummyMem())
+    mmu.in_bios = False
+    cpu = Cpu(mmu)
+    # loop: inc a; jr loop
+    mmu.write_block(0xC000, bytearray([0x3C, 0x18, 0xFD]))
+    cpu.pc = 0xC000
+    cpu.run(160)
+    self.assertEqual(cpu.a, 10)
+
+  def test_wait_for_interrupt(self):
+    # ei; loop: jr loop, with a vblank interrupt handled in rom at 0x40: inc b; reti
+    rom = bytearray(0x8000)
+    rom[ROM_TYPE_BYTE] = 0x01
+    rom[0x40:0x42] = bytearray([0x04, 0xD9])
+    mmu = Mmu(DummyMem(), DummyMem(), DummyMem(), DummyMem())
+    mmu.in_bios = False
+    mmu.load_cartridge(Cartridge(bytes(rom)))
+    cpu = Cpu(mmu)
+    cpu.sp = 0xFFFE
+    mmu[0xFFFF] = INT_VBLANK
+    mmu.write_block(0xC000, bytearray([0xFB, 0x18, 0xFE]))
+    cpu.pc = 0xC000
+    def vblank(deadline):
+      mmu.request_interrupt(INT_VBLANK)
+      mmu.scheduler.schedule(deadline + 70224, vblank)
+    mmu.scheduler.schedule(70224, vblank)
+    cycles, reason = cpu.run(70224 * 60 - 100)
+    self.assertEqual(cpu.b, 59)
+    self.assertEqual(cpu.pc, 0xC001)
@@ -1,5 +1,6 @@
-import six
+import os
 import struct
+import tempfile
 import unittest
 
 from gb.cartridge import *
@@ -7,8 +8,7 @@ from gb.cartridge import *
 class TestCartridgeMeta(unittest.TestCase):
 
   def setUp(self):
-    @six.add_metaclass(CartridgeMeta)
-    class base(object):
+    class base(object, metaclass=CartridgeMeta):
       pass
     self.base = base
 
@@ -198,3 +198,64 @@ class TestMbc1Cartridge(unittest.TestCase):
       self.assertEqual(cart.rom_select, rom)
       self.assertEqual(cart.bankset_select, bank)
       self.assertEqual(cart.mode_select, mode)
+
+
+  def testMappingListener(self):
+    cart = Mbc1Cartridge(self.full_cartridge_string)
+    calls = []
+    listener = lambda: calls.append(cart.mapped_banks())
+    cart.add_mapping_listener(listener)
+
+    cart[0x2000] = 2
+    self.assertEqual(len(calls), 1)
+    self.assertEqual(calls[0][1][0], 7)
+    self.assertIsNone(calls[0][2])
+
+    # Writes which don't change the mapping don't notify.
+    cart[0x2000] = 2
+    cart[0x6000] = 0
+    self.assertEqual(len(calls), 1)
+
+    cart[0x0] = 0xA
+    self.assertIs(calls[-1][2], cart.rambanks[0])
+
+    cart.remove_mapping_listener(listener)
+    cart[0x2000] = 3
+    self.assertEqual(len(calls), 2)
+
+class TestLoadRom(unittest.TestCase):
+  def setUp(self):
+    fd, self.path = tempfile.mkstemp()
+    with os.fdopen(fd, "wb") as f:
+      f.write(bytearray().join(bytearray([i + 5]) * 0x4000 for i in range(3)))
+      f.write(b"\x07" * 0x10)
+    # Mark it as an mbc1 cartridge.
+    with open(self.path, "r+b") as f:
+      f.seek(ROM_TYPE_BYTE)
+      f.write(b"\x01")
+
+  def tearDown(self):
+    os.remove(self.path)
+
+  def testRomImage(self):
+    image = RomImage.from_file(self.path)
+    self.assertIs(image, RomImage.from_file(self.path))
+    self.assertEqual(image.num_banks, 4)
+    self.assertEqual(image.bank(1)[0], 6)
+    # The partial last bank is padded, and banks past the end are the shared zero bank.
+    self.assertEqual(len(image.bank(3)), 0x4000)
+    self.assertEqual(image.bank(3)[0xF], 7)
+    self.assertEqual(image.bank(3)[0x10], 0)
+    self.assertIs(image.bank(4), ZERO_BANK)
+
+  def testLoadRom(self):
+    cart = load_rom_from_file(self.path)
+    self.assertIs(type(cart), Mbc1Cartridge)
+    self.assertEqual(len(cart.rombanks), 128)
+    self.assertEqual(cart[0x0], 5)
+    self.assertEqual(cart[0x4000], 6)
+    cart[0x2000] = 3
+    self.assertEqual(cart[0x400F], 7)
+    # Missing banks all share one empty bank.
+    self.assertIs(cart.rombanks[5], cart.rombanks[6])
+
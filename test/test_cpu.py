@@ -0,0 +1,328 @@
+import unittest
+
+from gb.cpu import *
+from gb.mem import *
+from gb.mmu import *
+
+class TestCpuRegisters(unittest.TestCase):
+
+  def setUp(self):
+    self.cpu = Cpu(Mmu(DummyMem(), DummyMem(), DummyMem(), DummyMem()))
+
+  def test_slots(self):
+    with self.assertRaises(AttributeError):
+      self.cpu.not_a_register = 1
+
+  def test_shared_tables(self):
+    other = Cpu(self.cpu.mmu)
+    self.assertIs(self.cpu.ops, other.ops)
+    self.assertEqual(len(Cpu.ops), 256)
+    self.assertEqual(len(Cpu.ext_ops), 256)
+    self.assertEqual(Cpu.mnemonics[0x7E], "ld a,(hl)")
+    self.assertEqual(Cpu.ext_mnemonics[0x5A], "bit 3,d")
+    self.assertEqual(Cpu.lengths[0xC3], 3)
+
+  def test_save_state(self):
+    self.cpu.af = 0x12F0
+    self.cpu.hl = 0xBEEF
+    self.cpu.pc = 0x4321
+    self.cpu.halted = True
+    self.cpu.cycles = 1 << 40
+    state = self.cpu.save_state()
+
+    other = Cpu(self.cpu.mmu)
+    other.load_state(state)
+    self.assertEqual((other.af, other.hl, other.pc), (0x12F0, 0xBEEF, 0x4321))
+    self.assertTrue(other.halted)
+    self.assertFalse(other.interrupts_enabled)
+    self.assertEqual(other.cycles, 1 << 40)
+
+  def test_pairs(self):
+    self.cpu.bc = 0x1234
+    self.assertEqual(self.cpu.b, 0x12)
+    self.assertEqual(self.cpu.c, 0x34)
+    self.assertEqual(self.cpu.regs[REG_B], 0x12)
+
+    self.cpu.h = 0xAB
+    self.cpu.l = 0xCD
+    self.assertEqual(self.cpu.hl, 0xABCD)
+    self.assertEqual(self.cpu.get_pair(PAIR_HL), 0xABCD)
+
+    self.cpu.af = 0x56F0
+    self.assertEqual(self.cpu.a, 0x56)
+    self.assertEqual(self.cpu.f, 0xF0)
+
+    self.cpu.set_pair(PAIR_DE, 0xFFFF + 1)
+    self.assertEqual(self.cpu.de, 0x0)
+
+
+class TestCpuInstructions(unittest.TestCase):
+
+  def setUp(self):
+    self.mmu = Mmu(DummyMem(), DummyMem(), DummyMem(), DummyMem())
+    self.mmu.in_bios = False
+    self.cpu = Cpu(self.mmu)
+    self.cpu.sp = 0xFFFE
+
+  def run_program(self, program, count=None):
+    """Load program into wram at 0xC000 and execute count instructions (by default, until
+    the pc runs off the end of the program).
+
+    """
+    self.mmu.write_block(0xC000, bytearray(program))
+    self.cpu.pc = 0xC000
+    if count is None:
+      while self.cpu.pc < 0xC000 + len(program):
+        self.cpu.execute_instr()
+    else:
+      for _ in range(count):
+        self.cpu.execute_instr()
+
+  def test_loads(self):
+    # ld b,0x12; ld c,b; ld hl,0xC100; ld (hl),c; ld a,(hl+); ld (0xC200),a
+    self.run_program([0x06, 0x12, 0x48, 0x21, 0x00, 0xC1, 0x71, 0x2A, 0xEA, 0x00, 0xC2])
+    self.assertEqual(self.cpu.c, 0x12)
+    self.assertEqual(self.mmu[0xC100], 0x12)
+    self.assertEqual(self.cpu.hl, 0xC101)
+    self.assertEqual(self.mmu[0xC200], 0x12)
+
+  def test_add_flags(self):
+    # ld a,0x0F; add a,0x01
+    self.run_program([0x3E, 0x0F, 0xC6, 0x01])
+    self.assertEqual(self.cpu.a, 0x10)
+    self.assertEqual(self.cpu.f, FLAG_H)
+
+    # ld a,0xFF; add a,0x01
+    self.run_program([0x3E, 0xFF, 0xC6, 0x01])
+    self.assertEqual(self.cpu.a, 0x00)
+    self.assertEqual(self.cpu.f, FLAG_Z | FLAG_H | FLAG_C)
+
+    # scf; ld a,0x01; adc a,0x01
+    self.run_program([0x37, 0x3E, 0x01, 0xCE, 0x01])
+    self.assertEqual(self.cpu.a, 0x03)
+    self.assertEqual(self.cpu.f, 0)
+
+  def test_sub_flags(self):
+    # ld a,0x10; ld b,0x01; sub b
+    self.run_program([0x3E, 0x10, 0x06, 0x01, 0x90])
+    self.assertEqual(self.cpu.a, 0x0F)
+    self.assertEqual(self.cpu.f, FLAG_N | FLAG_H)
+
+    # ld a,0x01; cp 0x02
+    self.run_program([0x3E, 0x01, 0xFE, 0x02])
+    self.assertEqual(self.cpu.a, 0x01)
+    self.assertEqual(self.cpu.f, FLAG_N | FLAG_H | FLAG_C)
+
+  def test_inc_dec(self):
+    # ld a,0xFF; inc a; dec a
+    self.run_program([0x3E, 0xFF, 0x3C])
+    self.assertEqual(self.cpu.a, 0x00)
+    self.assertEqual(self.cpu.f, FLAG_Z | FLAG_H)
+    self.run_program([0x3D])
+    self.assertEqual(self.cpu.a, 0xFF)
+    self.assertEqual(self.cpu.f, FLAG_N | FLAG_H)
+
+  def test_daa(self):
+    # ld a,0x19; add a,0x28; daa
+    self.run_program([0x3E, 0x19, 0xC6, 0x28, 0x27])
+    self.assertEqual(self.cpu.a, 0x47)
+
+  def test_stack(self):
+    # ld bc,0x1234; push bc; pop af
+    self.run_program([0x01, 0x34, 0x12, 0xC5, 0xF1])
+    self.assertEqual(self.cpu.af, 0x1230)
+    self.assertEqual(self.cpu.sp, 0xFFFE)
+
+  def test_call_ret(self):
+    # call 0xC010; ...; 0xC010: inc b; ret
+    self.mmu.write_block(0xC010, bytearray([0x04, 0xC9]))
+    self.run_program([0xCD, 0x10, 0xC0], count=3)
+    self.assertEqual(self.cpu.b, 1)
+    self.assertEqual(self.cpu.pc, 0xC003)
+
+  def test_loop(self):
+    # ld b,5; xor a; loop: inc a; dec b; jr nz,loop
+    self.run_program([0x06, 0x05, 0xAF, 0x3C, 0x05, 0x20, 0xFC])
+    self.assertEqual(self.cpu.a, 5)
+    self.assertEqual(self.cpu.b, 0)
+
+  def test_ext_ops(self):
+    # ld a,0x81; rlc a; then swap a; bit 7,a; set 0,b
+    self.run_program([0x3E, 0x81, 0xCB, 0x07])
+    self.assertEqual(self.cpu.a, 0x03)
+    self.assertEqual(self.cpu.f, FLAG_C)
+    self.run_program([0xCB, 0x37, 0xCB, 0x7F, 0xCB, 0xC0])
+    self.assertEqual(self.cpu.a, 0x30)
+    self.assertEqual(self.cpu.f, FLAG_Z | FLAG_H)
+    self.assertEqual(self.cpu.b, 0x01)
+
+  def test_ext_ops_hl(self):
+    # ld hl,0xC100; ld (hl),0x81; sla (hl)
+    self.mmu[0xC100] = 0x0
+    self.run_program([0x21, 0x00, 0xC1, 0x36, 0x81, 0xCB, 0x26])
+    self.assertEqual(self.mmu[0xC100], 0x02)
+    self.assertEqual(self.cpu.f, FLAG_C)
+
+  def test_cycles(self):
+    for program, cycles in (
+        ([0x00], 4),                # nop
+        ([0x36, 0x12], 12),         # ld (hl),n
+        ([0xCB, 0x46], 12),         # bit 0,(hl)
+        ([0xCB, 0xC6], 16),         # set 0,(hl)
+        ([0xCB, 0x11], 8),          # rl c
+        ([0xC5], 16),               # push bc
+        ([0xFA, 0x00, 0xC1], 16),   # ld a,(nn)
+        ([0xCD, 0x00, 0xC1], 24),   # call nn
+        ([0x08, 0x00, 0xC1], 20)):  # ld (nn),sp
+      self.cpu.hl = 0xC100
+      self.mmu.write_block(0xC000, bytearray(program))
+      self.cpu.pc = 0xC000
+      start = self.cpu.cycles
+      self.assertEqual(self.cpu.execute_instr(), cycles, Cpu.mnemonics[program[0]])
+      self.assertEqual(self.cpu.cycles - start, cycles)
+
+  def test_branch_cycles(self):
+    self.cpu.f = 0
+    self.mmu.write_block(0xC000, bytearray([0x20, 0x00, 0x28, 0x00, 0xC0, 0xC8]))
+    self.cpu.pc = 0xC000
+    self.assertEqual(self.cpu.execute_instr(), 12)  # jr nz (taken)
+    self.assertEqual(self.cpu.execute_instr(), 8)   # jr z (not taken)
+    self.mmu[0xFFFC] = 0x05
+    self.mmu[0xFFFD] = 0xC0
+    self.cpu.sp = 0xFFFC
+    self.assertEqual(self.cpu.execute_instr(), 20)  # ret nz (taken)
+    self.assertEqual(self.cpu.execute_instr(), 8)   # ret z (not taken)
+
+  def test_cycle_table(self):
+    for op in range(256):
+      if op in ILLEGAL or op == 0xCB:
+        continue
+      self.assertGreater(CYCLES[op], 0, "%02x" % op)
+
+  def test_illegal(self):
+    with self.assertRaises(IllegalInstructionError):
+      self.run_program([0xD3])
+
+
+class TestCpuRun(unittest.TestCase):
+
+  def setUp(self):
+    self.mmu = Mmu(DummyMem(), DummyMem(), DummyMem(), DummyMem())
+    self.mmu.in_bios = False
+    self.cpu = Cpu(self.mmu)
+    self.cpu.sp = 0xFFFE
+    # ld b,5; xor a; loop: inc a; dec b; jr nz,loop; halt
+    self.mmu.write_block(0xC000, bytearray([0x06, 0x05, 0xAF, 0x3C, 0x05, 0x20, 0xFC, 0x76]))
+    self.cpu.pc = 0xC000
+
+  def test_run_to_halt(self):
+    cycles, reason = self.cpu.run(100000)
+    self.assertEqual(reason, REASON_HALT)
+    self.assertEqual(cycles, 112)
+    self.assertEqual(self.cpu.a, 5)
+    self.assertEqual(self.cpu.pc, 0xC008)
+    self.assertEqual(cycles, self.cpu.cycles)
+
+    # A halted cpu doesn't run any further.
+    self.assertEqual(self.cpu.run(100000), (0, REASON_HALT))
+
+  def test_run_cycles(self):
+    cycles, reason = self.cpu.run(1)
+    self.assertEqual(reason, REASON_CYCLES)
+    self.assertEqual(self.cpu.pc, 0xC002)
+    self.assertEqual(cycles, 8)
+
+    # The instruction that crosses the budget is completed.
+    cycles, reason = self.cpu.run(10)
+    self.assertEqual(self.cpu.pc, 0xC005)
+    self.assertEqual(cycles, 12)
+
+  def test_run_until_pc(self):
+    cycles, reason = self.cpu.run_until(pc=0xC007)
+    self.assertEqual(reason, REASON_PC)
+    self.assertEqual(self.cpu.pc, 0xC007)
+    self.assertEqual(self.cpu.b, 0)
+
+  def test_run_until_predicate(self):
+    cycles, reason = self.cpu.run_until(predicate=lambda cpu: cpu.a == 3)
+    self.assertEqual(reason, REASON_PREDICATE)
+    self.assertEqual(self.cpu.a, 3)
+    self.assertEqual(self.cpu.b, 3)
+
+  def test_run_until_cycles(self):
+    cycles, reason = self.cpu.run_until(pc=0x0, cycles=8)
+    self.assertEqual(reason, REASON_CYCLES)
+    self.assertEqual(cycles, 8)
+    with self.assertRaises(ValueError):
+      self.cpu.run_until()
+
+
+class TestCpuInterrupts(unittest.TestCase):
+
+  def setUp(self):
+    self.mmu = Mmu(DummyMem(), DummyMem(), DummyMem(), DummyMem())
+    self.mmu.in_bios = False
+    # The timer interrupt handler: inc b; reti
+    rom = bytearray(0x8000)
+    rom[ROM_TYPE_BYTE] = 0x01
+    rom[0x50:0x52] = bytearray([0x04, 0xD9])
+    self.mmu.load_cartridge(Cartridge(bytes(rom)))
+    self.cpu = Cpu(self.mmu)
+    self.cpu.sp = 0xFFFE
+
+  def timer(self, period):
+    """Schedule a timer interrupt every period cycles."""
+    def overflow(deadline):
+      self.mmu.request_interrupt(INT_TIMER)
+      self.mmu.scheduler.schedule(deadline + period, overflow)
+    self.mmu.scheduler.schedule(period, overflow)
+
+  def test_halt_fast_forward(self):
+    # ld a,0x04; ldh (0xFF),a; ei; loop: halt; jr loop
+    self.mmu.write_block(0xC000, bytearray([0x3E, 0x04, 0xE0, 0xFF, 0xFB, 0x76, 0x18, 0xFD]))
+    self.cpu.pc = 0xC000
+    self.timer(1024)
+
+    cycles, reason = self.cpu.run(10000)
+    self.assertEqual(reason, REASON_CYCLES)
+    # The cpu sleeps until the end of the budget, rather than stopping short.
+    self.assertEqual(cycles, 10000)
+    self.assertTrue(self.cpu.halted)
+    self.assertEqual(self.cpu.b, 9)
+    self.assertEqual(self.mmu.interrupt_flag, 0)
+    self.assertEqual(self.cpu.sp, 0xFFFE)
+
+  def test_wake_without_dispatch(self):
+    # With interrupts disabled, an interrupt wakes the cpu without calling the handler.
+    # ld a,0x04; ldh (0xFF),a; halt; inc c; xor a; ldh (0x0F),a; halt
+    self.mmu.write_block(0xC000, bytearray(
+      [0x3E, 0x04, 0xE0, 0xFF, 0x76, 0x0C, 0xAF, 0xE0, 0x0F, 0x76]))
+    self.cpu.pc = 0xC000
+    self.mmu.scheduler.schedule(500, lambda deadline: self.mmu.request_interrupt(INT_TIMER))
+
+    cycles, reason = self.cpu.run(100000)
+    self.assertEqual(reason, REASON_HALT)
+    self.assertEqual(self.cpu.b, 0)
+    self.assertEqual(self.cpu.c, 1)
+    self.assertEqual(self.cpu.pc, 0xC00A)
+    self.assertEqual(cycles, 500 + 4 + 4 + 12 + 4)
+
+  def test_halt_nothing_enabled(self):
+    # Events can't wake a cpu halted with no interrupts enabled.
+    self.mmu.write_block(0xC000, bytearray([0xFB, 0x76]))
+    self.cpu.pc = 0xC000
+    self.timer(1000)
+    self.assertEqual(self.cpu.run(100000), (8, REASON_HALT))
+
+  def test_execute_instr_halted(self):
+    self.mmu[0xFFFF] = INT_TIMER
+    self.mmu.write_block(0xC000, bytearray([0xFB, 0x76]))
+    self.cpu.pc = 0xC000
+    self.timer(1000)
+    self.assertEqual(self.cpu.execute_instr(), 4)  # ei
+    self.assertEqual(self.cpu.execute_instr(), 4)  # halt
+    # Skips ahead to the timer, then dispatches the interrupt.
+    self.assertEqual(self.cpu.execute_instr(), 1000 - 8)
+    self.assertEqual(self.cpu.execute_instr(), INTERRUPT_CYCLES + 4)  # inc b
+    self.assertEqual(self.cpu.pc, 0x51)
+    self.assertFalse(self.cpu.interrupts_enabled)
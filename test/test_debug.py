@@ -0,0 +1,110 @@
+import unittest
+
+from benchmarks.roms import make_rom
+from gb.cartridge import Cartridge
+from gb.cpu import Cpu, REASON_BREAK, REASON_CYCLES
+from gb.debug import *
+from gb.machine import Machine
+from gb.profiler import Profiler
+
+
+class TestDebugger(unittest.TestCase):
+
+  def setUp(self):
+    self.machine = Machine(Cartridge(make_rom([
+      0xAF,                    # xor a
+      0x21, 0x00, 0xC0,        # ld hl,0xC000
+      'loop:',
+      0x3C,                    # inc a
+      0x22,                    # ld (hl+),a
+      0xCB, 0xA4,              # res 4,h: stay within 0xC000-0xCFFF
+      0x18, ('rel', 'loop'),
+    ])))
+    self.cpu = self.machine.cpu
+    self.debugger = Debugger(self.cpu)
+
+  def run_to_break(self, cycles=100000):
+    _, reason = self.machine.run(cycles)
+    self.assertEqual(reason, REASON_BREAK)
+
+  def test_breakpoint(self):
+    self.debugger.add_breakpoint(0x0105)
+    self.run_to_break()
+    self.assertEqual(self.cpu.pc, 0x0105)
+    hit = self.debugger.hits[-1]
+    self.assertEqual((hit.kind, hit.address, hit.pc), (HIT_BREAK, 0x0105, 0x0105))
+    self.assertEqual(hit.cycles, self.cpu.cycles)
+    # Breakpoints stop before the instruction runs.
+    self.assertEqual(self.machine.mmu[0xC000], 0x00)
+
+    # Running on carries on from the breakpoint, round the loop and back to it.
+    self.run_to_break()
+    self.assertEqual(self.cpu.pc, 0x0105)
+    self.assertEqual(len(self.debugger.hits), 2)
+    self.assertGreater(self.debugger.hits[1].cycles, hit.cycles)
+    self.assertEqual(self.machine.mmu[0xC000], 0x01)
+    self.assertEqual(self.machine.mmu[0xC001], 0x00)
+
+    self.debugger.remove_breakpoint(0x0105)
+    _, reason = self.machine.run(1000)
+    self.assertEqual(reason, REASON_CYCLES)
+    self.assertEqual(len(self.debugger.hits), 2)
+
+  def test_no_stop(self):
+    hits = []
+    self.debugger.stop = False
+    self.debugger.on_hit = hits.append
+    self.debugger.add_breakpoint(0x0104)
+    _, reason = self.machine.run(1000)
+    self.assertEqual(reason, REASON_CYCLES)
+    self.assertGreater(len(hits), 10)
+    self.assertEqual(hits, self.debugger.hits)
+
+  def test_watch_write(self):
+    self.debugger.watch(0xC010, 2)
+    self.assertIsNot(type(self.cpu), Cpu)
+    self.run_to_break()
+    hit = self.debugger.hits[-1]
+    self.assertEqual((hit.kind, hit.address, hit.value, hit.pc),
+                     (HIT_WRITE, 0xC010, 0x11, 0x0105))
+    # Stopped right after the writing instruction, at its exact cycle.
+    self.assertEqual(self.cpu.pc, 0x0106)
+    self.assertEqual(self.cpu.cycles - hit.cycles, 8)
+
+    self.run_to_break()
+    self.assertEqual(self.debugger.hits[-1].address, 0xC011)
+
+    # And back to the normal run loop once nothing is watched.
+    self.debugger.clear()
+    self.assertIs(type(self.cpu), Cpu)
+    _, reason = self.machine.run(1000)
+    self.assertEqual(reason, REASON_CYCLES)
+
+  def test_watch_read(self):
+    self.debugger.watch(0x0105, reads=True, writes=False)
+    self.run_to_break()
+    hit = self.debugger.hits[-1]
+    # Fetching the instruction reads it.
+    self.assertEqual((hit.kind, hit.address, hit.value, hit.pc),
+                     (HIT_READ, 0x0105, 0x22, 0x0105))
+
+  def test_watch_while_profiling(self):
+    profiler = Profiler(self.cpu)
+    profiler.start()
+    with self.assertRaises(ValueError):
+      self.debugger.watch(0xC000)
+    profiler.stop()
+    self.debugger.watch(0xC000)
+    with self.assertRaises(ValueError):
+      profiler.start()
+
+  def test_fork(self):
+    self.debugger.add_breakpoint(0x0105)
+    self.debugger.watch(0xC000)
+    fork = self.machine.fork()
+    # Forks start without any breakpoints or watchpoints.
+    self.assertIs(type(fork.cpu), Cpu)
+    _, reason = fork.run(1000)
+    self.assertEqual(reason, REASON_CYCLES)
+    self.assertEqual(self.debugger.hits, [])
+    self.run_to_break()
@@ -0,0 +1,95 @@
+import multiprocessing
+import unittest
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+from gb.cpu import FRAME_CYCLES
+from gb.framebuffer import *
+from gb.framebuffer import shared_memory
+from gb.io import IoRegisters
+from gb.lcd import Lcd
+from gb.machine import Machine
+
+
+def frame_of(shade):
+  return bytes(bytearray([shade]) * FRAME_SIZE)
+
+
+def read_frame(name, queue):
+  """Report the latest frame in the shared frame buffer called name from another
+  process.
+
+  """
+  frames = FrameBuffer.attach(name)
+  sequence, frame = frames.read()
+  queue.put((sequence, bytes(frame)))
+  frames.close()
+
+
+class TestFrameBuffer(unittest.TestCase):
+
+  def test_publish(self):
+    buffer = bytearray(BUFFER_SIZE)
+    frames = FrameBuffer(buffer)
+    self.assertEqual(frames.latest(), (0, None))
+    self.assertEqual(frames.read(), (0, None))
+
+    frames.publish(frame_of(1))
+    sequence, frame = frames.latest()
+    self.assertEqual(sequence, 1)
+    self.assertEqual((frame.shape, frame[143, 159]), ((HEIGHT, WIDTH), 1))
+    # The next frame goes into the other slot, leaving the first one whole until the one
+    # after.
+    frames.publish(frame_of(2))
+    self.assertTrue(frames.valid(1))
+    self.assertEqual(frame[0, 0], 1)
+    self.assertEqual(frames.read(), (2, bytearray(frame_of(2))))
+    frames.publish(frame_of(3))
+    self.assertFalse(frames.valid(1))
+    self.assertEqual(frame[0, 0], 3)
+
+    # Readers can map a buffer that is already set up.
+    reader = FrameBuffer(buffer, init=False)
+    self.assertEqual(reader.latest()[0], 3)
+    self.assertIsNone(reader.name)
+    with self.assertRaises(FrameBufferError):
+      FrameBuffer(bytearray(BUFFER_SIZE), init=False)
+    with self.assertRaises(ValueError):
+      FrameBuffer(bytearray(FRAME_SIZE))
+
+  @unittest.skipIf(shared_memory is None, "needs multiprocessing.shared_memory")
+  def test_shared_memory(self):
+    frames = FrameBuffer.create()
+    try:
+      frames.publish(frame_of(2))
+      queue = multiprocessing.Queue()
+      reader = multiprocessing.Process(target=read_frame, args=(frames.name, queue))
+      reader.start()
+      self.assertEqual(queue.get(timeout=30), (1, frame_of(2)))
+      reader.join()
+
+      attached = FrameBuffer.attach(frames.name)
+      frames.publish(frame_of(3))
+      self.assertEqual(attached.sequence, 2)
+      attached.close()
+    finally:
+      frames.close()
+      frames.unlink()
+
+  @unittest.skipIf(numpy is None, "needs numpy")
+  def test_export(self):
+    machine = Machine(io=IoRegisters(Lcd()))
+    frames = export(machine, FrameBuffer(bytearray(BUFFER_SIZE)))
+    machine.mmu.vram[0x10:0x20] = bytearray([0xFF]) * 16
+    machine.mmu.vram[0x1800:0x1C00] = bytearray([1]) * 0x400
+    machine.run(3 * FRAME_CYCLES)
+    sequence, frame = frames.latest()
+    self.assertGreaterEqual(sequence, 2)
+    self.assertEqual(numpy.asarray(frame).tolist(), machine.io.lcd.frame.tolist())
+    self.assertEqual(frame[0, 0], 3)
+
+    with self.assertRaises(ValueError):
+      export(Machine(), frames)
@@ -0,0 +1,71 @@
+import unittest
+
+from gb.io import *
+from gb.mem import DummyMem
+from gb.mmu import INT_JOYPAD, INT_SERIAL, Mmu
+from gb.scheduler import NEVER
+
+
+class TestIoRegisters(unittest.TestCase):
+
+  def setUp(self):
+    self.io = IoRegisters()
+    self.mmu = Mmu(DummyMem(), bytearray(0x2000), bytearray(0xA0), self.io)
+
+  def test_joypad(self):
+    self.io.press(['a', 'down'])
+    # Nothing selected.
+    self.mmu[0xFF00] = 0x30
+    self.assertEqual(self.mmu[0xFF00], 0xFF)
+    # Directions.
+    self.mmu[0xFF00] = 0x20
+    self.assertEqual(self.mmu[0xFF00], 0xE7)
+    # Actions.
+    self.mmu[0xFF00] = 0x10
+    self.assertEqual(self.mmu[0xFF00], 0xDE)
+    self.io.release('a')
+    self.assertEqual(self.mmu[0xFF00], 0xDF)
+
+  def test_joypad_interrupt(self):
+    self.mmu[0xFF00] = 0x10
+    self.io.press(['up'])
+    self.assertFalse(self.mmu.interrupt_flag & INT_JOYPAD)
+    self.io.press(['start'])
+    self.assertTrue(self.mmu.interrupt_flag & INT_JOYPAD)
+
+  def test_bad_button(self):
+    with self.assertRaises(ValueError):
+      self.io.press(['turbo'])
+
+  def test_serial(self):
+    self.mmu[0xFF01] = ord('x')
+    self.mmu[0xFF02] = 0x81
+    self.assertTrue(self.mmu[0xFF02] & SC_TRANSFER)
+    self.mmu.scheduler.run_due(SERIAL_TRANSFER_CYCLES - 1)
+    self.assertEqual(self.io.serial_output, b'')
+    self.mmu.scheduler.run_due(SERIAL_TRANSFER_CYCLES)
+    self.assertEqual(self.io.serial_output, b'x')
+    self.assertFalse(self.mmu[0xFF02] & SC_TRANSFER)
+    self.assertEqual(self.mmu[0xFF01], 0xFF)
+    self.assertTrue(self.mmu.interrupt_flag & INT_SERIAL)
+
+  def test_external_clock(self):
+    # Nothing is plugged in to drive the clock, so the transfer never finishes.
+    self.mmu[0xFF02] = 0x80
+    self.assertEqual(self.mmu.scheduler.next_deadline, NEVER)
+
+  def test_save_load_fork(self):
+    self.io.press(['b'])
+    self.mmu[0xFF01] = ord('y')
+    self.mmu[0xFF02] = 0x81
+    state = self.io.save_state()
+
+    child = self.mmu.fork()
+    other = IoRegisters()
+    mmu = Mmu(DummyMem(), bytearray(0x2000), bytearray(0xA0), other)
+    other.load_state(state)
+    for io, mmu in ((child.io, child), (other, mmu)):
+      self.assertEqual(io.buttons, BUTTON_B)
+      mmu.scheduler.run_due(SERIAL_TRANSFER_CYCLES)
+      self.assertEqual(io.serial_output, b'y')
+    self.assertEqual(self.io.serial_output, b'')
@@ -0,0 +1,197 @@
+import unittest
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+from gb.io import *
+from gb.lcd import *
+from gb.machine import Machine
+from gb.mem import DummyMem
+from gb.mmu import INT_STAT, INT_VBLANK, Mmu
+from gb.scheduler import NEVER
+
+
+class Clock(object):
+  cycles = 0
+
+
+class TestLcd(unittest.TestCase):
+
+  def setUp(self):
+    self.make()
+
+  def make(self, **kwargs):
+    self.lcd = Lcd(**kwargs)
+    self.io = IoRegisters(self.lcd)
+    self.mmu = Mmu(DummyMem(), bytearray(0x2000), bytearray(0xA0), self.io)
+    self.clock = self.mmu.scheduler.clock = Clock()
+    self.mmu[0xFF40] = LCDC_ENABLE | LCDC_BG_ENABLE
+
+  def run_to(self, cycles):
+    self.clock.cycles = cycles
+    self.mmu.scheduler.run_due(cycles)
+
+  def at(self, line, dot=0, frame=0):
+    """Run to dot of line, and return (LY, mode) there."""
+    self.run_to(frame * FRAME_CYCLES + line * LINE_CYCLES + dot)
+    return self.mmu[0xFF44], self.mmu[0xFF41] & STAT_MODE
+
+  def test_timing(self):
+    self.assertEqual(self.at(0), (0, MODE_OAM))
+    self.assertEqual(self.at(0, OAM_CYCLES - 1), (0, MODE_OAM))
+    self.assertEqual(self.at(0, OAM_CYCLES), (0, MODE_TRANSFER))
+    self.assertEqual(self.at(0, OAM_CYCLES + TRANSFER_CYCLES), (0, MODE_HBLANK))
+    self.assertEqual(self.at(1), (1, MODE_OAM))
+    self.assertFalse(self.mmu.interrupt_flag)
+
+    self.assertEqual(self.at(143, LINE_CYCLES - 1), (143, MODE_HBLANK))
+    self.assertEqual(self.at(144), (144, MODE_VBLANK))
+    self.assertEqual(self.mmu.interrupt_flag, INT_VBLANK)
+    self.assertEqual(self.lcd.frames, 1)
+    self.assertEqual(self.at(153, 100), (153, MODE_VBLANK))
+    self.assertEqual(self.at(0, frame=1), (0, MODE_OAM))
+    self.assertEqual(self.at(144, frame=3), (144, MODE_VBLANK))
+    self.assertEqual(self.lcd.frames, 4)
+
+  def test_registers(self):
+    self.at(5, 10)
+    # Only the interrupt conditions of STAT can be written, and LY can't be.
+    self.mmu[0xFF41] = 0xFF
+    self.mmu[0xFF44] = 0x42
+    self.assertEqual(self.mmu[0xFF41], 0x80 | STAT_WRITABLE | MODE_OAM)
+    self.assertEqual(self.mmu[0xFF44], 5)
+    self.mmu[0xFF45] = 5
+    self.assertTrue(self.mmu[0xFF41] & STAT_COINCIDENCE)
+
+    # Switching the lcd off stops it at the start of the first line, until it is
+    # switched back on.
+    self.mmu[0xFF40] = 0
+    self.assertEqual((self.mmu[0xFF44], self.mmu[0xFF41] & STAT_MODE), (0, MODE_HBLANK))
+    self.assertEqual(self.mmu.scheduler.next_deadline, NEVER)
+    self.assertFalse(self.lcd.enabled)
+    self.mmu[0xFF40] = LCDC_ENABLE
+    self.run_to(self.clock.cycles + OAM_CYCLES)
+    self.assertEqual((self.mmu[0xFF44], self.mmu[0xFF41] & STAT_MODE), (0, MODE_TRANSFER))
+
+  def test_stat_interrupt(self):
+    self.mmu[0xFF45] = 3
+    self.mmu[0xFF41] = STAT_LYC
+    self.at(2, LINE_CYCLES - 1)
+    self.assertFalse(self.mmu.interrupt_flag)
+    self.at(3)
+    self.assertEqual(self.mmu.interrupt_flag, INT_STAT)
+    self.assertTrue(self.mmu[0xFF41] & STAT_COINCIDENCE)
+
+    # The interrupt is raised when a condition starts to hold, not again while one does.
+    self.mmu.interrupt_flag = 0
+    self.mmu[0xFF41] = STAT_HBLANK | STAT_VBLANK
+    self.at(143, OAM_CYCLES + TRANSFER_CYCLES)
+    self.assertEqual(self.mmu.interrupt_flag, INT_STAT)
+    self.mmu.interrupt_flag = 0
+    self.at(144)
+    self.assertEqual(self.mmu.interrupt_flag, INT_VBLANK)
+    self.mmu.interrupt_flag = 0
+    self.at(0, frame=1)
+    self.at(0, OAM_CYCLES + TRANSFER_CYCLES, frame=1)
+    self.assertEqual(self.mmu.interrupt_flag, INT_STAT)
+
+  def test_access(self):
+    self.mmu.vram[0] = 0x12
+    self.mmu.oam[0] = 0x34
+    self.at(0)
+    self.assertEqual((self.mmu[0x8000], self.mmu[0xFE00]), (0x12, 0xFF))
+    self.at(0, OAM_CYCLES)
+    self.assertEqual((self.mmu[0x8000], self.mmu[0xFE00]), (0xFF, 0xFF))
+    self.mmu[0x8000] = 0x56
+    self.assertEqual(self.mmu.vram[0], 0x12)
+    self.assertEqual(bytes(self.mmu.read_block(0x9FFE, 2)), b'\xff\xff')
+    # Oam dma gets through regardless.
+    self.mmu.write_block(0xC000, bytearray([0x78] * 0xA0))
+    self.mmu[0xFF46] = 0xC0
+    self.assertEqual(self.mmu.oam[0], 0x78)
+
+    self.at(0, OAM_CYCLES + TRANSFER_CYCLES)
+    self.assertEqual((self.mmu[0x8000], self.mmu[0xFE00]), (0x12, 0x78))
+    self.mmu[0x8000] = 0x56
+    self.assertEqual(self.mmu.vram[0], 0x56)
+    self.at(144)
+    self.assertEqual(self.mmu[0xFE00], 0x78)
+
+    self.make(restrict_access=False)
+    self.at(0, OAM_CYCLES)
+    self.mmu[0x8000] = 0x56
+    self.assertEqual(self.mmu[0x8000], 0x56)
+    self.assertIsInstance(self.mmu.read_pages[0x80], memoryview)
+
+  def test_code_in_vram(self):
+    # Translated code has to see the locks just like the interpreter does.
+    machine = Machine(io=IoRegisters(Lcd()))
+    machine.mmu.vram[0:4] = bytearray([
+      0x3C,              # loop: inc a
+      0x04,              # inc b
+      0x18, 0xFC,        # jr loop
+    ])
+    machine.mmu[0xFF40] = LCDC_ENABLE | LCDC_BG_ENABLE
+    machine.cpu.pc = 0x8000
+    interpreted = machine.fork()
+    machine.run(FRAME_CYCLES)
+    cpu = interpreted.cpu
+    while cpu.cycles < machine.cpu.cycles:
+      cpu.execute_instr()
+    self.assertEqual(interpreted.save_state(), machine.save_state())
+    # The first fetch from vram while it was locked read 0xFF, rst 0x38, out of the loop.
+    self.assertLess(machine.cpu.pc, 0x8000)
+
+  def test_fork_and_state(self):
+    self.mmu[0xFF45] = 7
+    self.at(6, 300)
+    state = self.io.save_state()
+    child = self.mmu.fork()
+    child.scheduler.clock = self.clock
+    io = IoRegisters(Lcd())
+    loaded = Mmu(DummyMem(), bytearray(0x2000), bytearray(0xA0), io)
+    loaded.scheduler.clock = self.clock
+    io.load_state(state)
+
+    self.run_to(7 * LINE_CYCLES + OAM_CYCLES)
+    for mmu in (child, loaded):
+      mmu.scheduler.run_due(self.clock.cycles)
+      self.assertEqual((mmu[0xFF44], mmu[0xFF41]),
+                       (7, 0x80 | STAT_COINCIDENCE | MODE_TRANSFER))
+      # The child has its own locks.
+      self.assertEqual(mmu[0x8000], 0xFF)
+    self.mmu[0xFF40] = 0
+    self.assertEqual(child[0x8000], 0xFF)
+    self.assertEqual(self.mmu[0x8000], 0x00)
+
+  @unittest.skipIf(numpy is None, "needs numpy")
+  def test_rendering(self):
+    frames = []
+    self.lcd.on_frame = lambda frame: frames.append(frame.copy())
+    self.mmu[0xFF47] = 0xE4
+    # Tile 1 is solid colour 3, and fills the background.
+    self.mmu.vram[0x10:0x20] = bytearray([0xFF]) * 16
+    self.mmu.vram[0x1800:0x1C00] = bytearray([1]) * 0x400
+    self.mmu[0xFF40] = LCDC_ENABLE | LCDC_BG_ENABLE | LCDC_TILE_DATA
+
+    # Headless: nothing is drawn.
+    self.at(0, frame=3)
+    self.assertIsNone(self.lcd.renderer)
+    self.assertEqual(self.lcd.frames_rendered, 0)
+
+    # A requested frame, with the palette changed partway through.
+    self.lcd.request_frame()
+    self.at(0, frame=4)
+    self.at(72, 100, frame=4)
+    self.mmu[0xFF47] = 0x24
+    self.at(0, frame=5)
+    self.assertEqual(len(frames), 1)
+    self.assertEqual(frames[0][:73].max(), 3)
+    self.assertEqual(frames[0][73:].max(), 0)
+
+    self.lcd.render_every = 2
+    self.at(0, frame=10)
+    self.assertEqual(self.lcd.frames_rendered, 3)
+    self.assertEqual(self.lcd.screenshot().max(), 0)
@@ -0,0 +1,199 @@
+import time
+import unittest
+
+from gb.cartridge import *
+from gb.machine import *
+from gb.state import StateError
+
+class TestMachine(unittest.TestCase):
+
+  def setUp(self):
+    rom = bytearray(0x10000)
+    rom[ROM_TYPE_BYTE] = 0x01
+    # 0x100: ld a,0x0A; ld (0x0000),a; ld a,2; ld (0x2000),a; ld hl,0xA000;
+    # loop: inc (hl); ld a,(0x4000); ld (0xC000),a; inc a; ld (0x2000),a; jr loop
+    rom[0x100:0x11A] = bytearray([
+      0x3E, 0x0A, 0xEA, 0x00, 0x00, 0x3E, 0x02, 0xEA, 0x00, 0x20, 0x21, 0x00, 0xA0,
+      0x34, 0xFA, 0x00, 0x40, 0xEA, 0x00, 0xC0, 0x3C, 0xEA, 0x00, 0x20, 0x18, 0xF3])
+    for bank in range(1, 4):
+      rom[bank * 0x4000] = bank
+    self.rom = bytes(rom)
+    self.machine = Machine(Cartridge(self.rom))
+
+  def test_skip_bios(self):
+    self.assertFalse(self.machine.mmu.in_bios)
+    self.assertEqual(self.machine.cpu.pc, 0x100)
+    self.assertEqual(self.machine.cpu.af, 0x01B0)
+
+  def test_reset(self):
+    self.machine.run(1000)
+    mmu = self.machine.mmu
+    mmu.write_block(0x8000, b'\x01\x02')
+    mmu[0xFE00] = 3
+    self.assertNotEqual(mmu[0xA000], 0)
+    self.assertNotEqual(mmu[0xC000], 0)
+    mmu.reset()
+    for addr in (0x8000, 0x8001, 0xA000, 0xC000, 0xE000, 0xFE00, 0xFF80):
+      self.assertEqual(mmu[addr], 0)
+    # Buffers shared with a fork are only reset in this machine.
+    mmu[0xC100] = 5
+    child = self.machine.fork()
+    mmu.reset()
+    self.assertEqual((mmu[0xC100], child.mmu[0xC100]), (0, 5))
+
+  def test_unusable_oam(self):
+    # 0xFEA0-0xFEFF can be read and written, by single bytes or blocks, as can the rest of
+    # oam.
+    mmu = self.machine.mmu
+    mmu[0xFEFF] = 0x12
+    self.assertEqual(mmu[0xFEFF], 0x12)
+    mmu.write_block(0xFE00, bytearray(0x100))
+    self.assertEqual(bytes(mmu.read_block(0xFE00, 0x100)), bytes(0x100))
+    # ld hl,0xFE00; loop: ld (hl+),a; ld a,h; cp 0xFF; jr nz,loop; halt
+    mmu.write_block(0xC000, bytearray([0x21, 0x00, 0xFE, 0x22, 0x7C, 0xFE, 0xFF, 0x20,
+                                       0xFA, 0x76]))
+    self.machine.cpu.pc = 0xC000
+    self.machine.run(10000)
+    self.assertEqual(self.machine.cpu.hl, 0xFF00)
+
+  def test_save_load(self):
+    self.machine.run(1000)
+    state = self.machine.save_state()
+    self.machine.run(1000)
+    expected = self.machine.save_state()
+
+    # Restoring into a fresh machine with the same rom continues the same way.
+    other = Machine(Cartridge(self.rom))
+    other.load_state(state)
+    self.assertEqual(other.save_state(), state)
+    other.run(1000)
+    self.assertEqual(other.save_state(), expected)
+    self.assertEqual(other.mmu[0xA000], self.machine.mmu[0xA000])
+    self.assertEqual(other.cartridge.rom_bank, self.machine.cartridge.rom_bank)
+
+    # And so does rewinding this one.
+    self.machine.load_state(state)
+    self.machine.run(1000)
+    self.assertEqual(self.machine.save_state(), expected)
+
+  def test_load_speed(self):
+    state = self.machine.save_state()
+    start = time.time()
+    for _ in range(100):
+      self.machine.load_state(state)
+    self.assertLess((time.time() - start) / 100, 0.001)
+
+  def test_bad_state(self):
+    state = self.machine.save_state()
+    with self.assertRaises(StateError):
+      self.machine.load_state(state[:-10])
+    with self.assertRaises(StateError):
+      self.machine.load_state(self.machine.cpu.save_state())
+    # A state for a cartridge with ram can't be loaded into one without.
+    with self.assertRaises(StateError):
+      Machine().load_state(state)
+
+  def test_fork(self):
+    self.machine.run(1000)
+    state = self.machine.save_state()
+    fork = self.machine.fork()
+    self.assertEqual(fork.save_state(), state)
+
+    # The fork carries on just like the original does, without disturbing it.
+    fork.run(1000)
+    self.assertEqual(self.machine.save_state(), state)
+    self.machine.run(1000)
+    self.assertEqual(fork.save_state(), self.machine.save_state())
+
+    # And is independent of it from then on.
+    fork.mmu[0xC100] = 0x12
+    fork.mmu[0xA100] = 0x34
+    self.assertEqual(self.machine.mmu[0xC100], 0)
+    self.assertEqual(self.machine.mmu[0xA100], 0)
+    self.assertEqual(fork.mmu[0xE100], 0x12)
+    self.assertEqual(fork.mmu.wram[0x100], 0x12)
+    self.assertEqual(self.machine.mmu.wram[0x100], 0)
+
+    # Code translated from the rom is shared.
+    self.assertIs(fork.cpu.blocks.page_blocks(0x01),
+                  self.machine.cpu.blocks.page_blocks(0x01))
+
+  def test_fork_copy_on_write(self):
+    self.machine.run(1000)
+    mmu = self.machine.mmu
+    cart = self.machine.cartridge
+    fork = self.machine.fork()
+
+    # Nothing is copied until it is written.
+    for page in (0x80, 0xC0, 0xC1, 0xE1, 0xFE):
+      self.assertIs(fork.mmu.page_source(page)[0], mmu.page_source(page)[0])
+    self.assertIs(fork.cartridge.rambanks[0], cart.rambanks[0])
+    self.assertIs(fork.cartridge.rombanks, cart.rombanks)
+
+    # Then only the page written is, and the copy replaces it in the echo too.
+    wram = mmu.page_source(0xC0)[0]
+    fork.mmu[0xC1FF] = 0x56
+    self.assertIsNot(fork.mmu.page_source(0xC1)[0], wram)
+    self.assertEqual(len(fork.mmu.page_source(0xC1)[0]), 0x100)
+    self.assertIs(fork.mmu.page_source(0xE1)[0], fork.mmu.page_source(0xC1)[0])
+    self.assertIs(fork.mmu.page_source(0xC0)[0], wram)
+    self.assertIs(fork.mmu.page_source(0x80)[0], mmu.page_source(0x80)[0])
+    self.assertEqual(mmu[0xC1FF], 0)
+    self.assertEqual(fork.mmu.contents('wram')[0x01FF], 0x56)
+    self.assertEqual(mmu.contents('wram')[0x01FF], 0)
+
+    # Writes by the original are copied the same way.
+    mmu[0x8000] = 0x78
+    self.assertEqual(fork.mmu[0x8000], 0)
+    self.assertIsNot(fork.mmu.page_source(0x80)[0], mmu.page_source(0x80)[0])
+
+    # Cartridge ram is copied a bank at a time.
+    value = mmu[0xA000]
+    fork.mmu[0xA000] = value + 1
+    self.assertEqual(mmu[0xA000], value)
+    self.assertIsNot(fork.cartridge.rambanks[0], cart.rambanks[0])
+    self.assertIs(fork.cartridge.rambanks[1], cart.rambanks[1])
+
+    # Forks of forks work too.
+    other = fork.fork()
+    other.mmu[0xC1FF] = 0x9A
+    self.assertEqual(fork.mmu[0xC1FF], 0x56)
+    self.assertEqual(other.mmu[0xE1FF], 0x9A)
+
+    # As do more forks of the same machine.
+    another = self.machine.fork()
+    another.mmu[0xC200] = 0xBC
+    self.assertEqual(mmu[0xC200], 0)
+    self.assertEqual(fork.mmu[0xC200], 0)
+    self.assertEqual(another.mmu[0xE200], 0xBC)
+
+  def test_fork_reads_stay_shared(self):
+    self.machine.run(1000)
+    mmu = self.machine.mmu
+    fork = self.machine.fork()
+    sources = [mmu.page_source(page) for page in range(0x100)]
+
+    # Reading memory and remapping it copy nothing.
+    mmu.contents('vram')
+    fork.mmu.contents('wram')
+    mmu.remap()
+    fork.mmu.remap()
+    self.assertEqual([mmu.page_source(page) for page in range(0x100)], sources)
+    self.assertIs(fork.mmu.page_source(0xC0)[0], sources[0xC0][0])
+
+    # Resetting or loading a state gives the mmu memory of its own.
+    fork.mmu[0xC000] = 0x12
+    state = fork.mmu.save_state()
+    mmu.reset()
+    self.assertEqual(fork.mmu[0xC000], 0x12)
+    mmu.load_state(state)
+    self.assertEqual(mmu[0xC000], 0x12)
+    mmu[0xC000] = 0x34
+    self.assertEqual(fork.mmu[0xC000], 0x12)
+
+  def test_fork_speed(self):
+    self.machine.run(1000)
+    start = time.time()
+    forks = [self.machine.fork() for _ in range(100)]
+    # Forking only shares memory, a page at a time, so it takes well under a millisecond.
+    self.assertLess((time.time() - start) / 100, 0.001)
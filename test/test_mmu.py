@@ -109,3 +109,213 @@ class TestMmuMethods(unittest.TestCase):
     self.assertNotEqual(zram1, wram1)
     self.assertNotEqual(zram1, oam1)
     self.assertNotEqual(zram1, io1)
+
+  def test_bios_unmapped_by_access(self):
+    bios = bytearray([0xBB]) * 0x100
+    self.mmu.bios = bios
+    self.mmu.remap()
+    self.assertEqual(self.mmu[0x0], 0xBB)
+    self.assertEqual(self.mmu[0xFF], 0xBB)
+    self.assertTrue(self.mmu.in_bios)
+
+    self.mmu[0x100]
+    self.assertFalse(self.mmu.in_bios)
+    self.assertEqual(self.mmu[0x0], 0)
+
+  def test_read_write_ram(self):
+    self.mmu[0xC000] = 0x12
+    self.mmu[0xDFFF] = 0x34
+    self.assertEqual(self.mmu.wram[0x0], 0x12)
+    self.assertEqual(self.mmu.wram[0x1FFF], 0x34)
+    self.assertEqual(self.mmu[0xC000], 0x12)
+
+    # Echo ram mirrors 0xC000-0xDDFF
+    self.assertEqual(self.mmu[0xE000], 0x12)
+    self.mmu[0xFDFF] = 0x56
+    self.assertEqual(self.mmu[0xDDFF], 0x56)
+
+    self.mmu[0xFF80] = 0x78
+    self.mmu[0xFFFF] = 0x9A
+    self.assertEqual(self.mmu.zram[0x0], 0x78)
+    self.assertEqual(self.mmu.zram[0x7F], 0x9A)
+    self.assertEqual(self.mmu[0xFFFF], 0x9A)
+
+  def test_read_write_io(self):
+    io = bytearray(0x80)
+    mmu = Mmu(DummyMem(), DummyMem(), DummyMem(), io)
+    mmu[0xFF00] = 0x1
+    mmu[0xFF7F] = 0x2
+    self.assertEqual(io[0x0], 0x1)
+    self.assertEqual(io[0x7F], 0x2)
+    self.assertEqual(mmu[0xFF7F], 0x2)
+    self.assertEqual(mmu.zram[0x0], 0x0)
+
+  def test_interrupt_registers(self):
+    changes = []
+    self.mmu.on_interrupts_changed = lambda: changes.append(self.mmu.interrupt_flag)
+    self.mmu.request_interrupt(INT_TIMER)
+    self.assertEqual(self.mmu[0xFF0F], 0xE0 | INT_TIMER)
+    self.mmu[0xFF0F] = 0xFF
+    self.assertEqual(self.mmu.interrupt_flag, INT_MASK)
+    self.mmu[0xFFFF] = INT_VBLANK
+    self.assertEqual(self.mmu.interrupt_enable, INT_VBLANK)
+    self.assertEqual(changes, [INT_TIMER, INT_MASK, INT_MASK])
+
+  def test_trap_writes(self):
+    sprung = []
+    self.mmu.trap_writes(0xC1, sprung.append)
+    self.mmu[0xC000] = 0x1
+    self.assertEqual(sprung, [])
+    # Writes through echo ram spring the trap too, and it only fires once.
+    self.mmu[0xE1FF] = 0x2
+    self.mmu[0xC100] = 0x3
+    self.assertEqual(sprung, [0xE1])
+    self.assertEqual(self.mmu.wram[0x1FF], 0x2)
+    self.assertEqual(self.mmu.wram[0x100], 0x3)
+
+    # Block writes to a trapped page spring it as well.
+    self.mmu.trap_writes(0xC2, sprung.append)
+    self.mmu.write_block(0xC1F0, bytearray(0x20))
+    self.assertEqual(sprung[-1], 0xC2)
+
+  def test_watch(self):
+    seen = []
+    def callback(addr, value, is_write):
+      seen.append((addr, value, is_write))
+    self.mmu.watch(0xC105, callback, reads=True)
+    self.mmu.wram[0x105] = 0x11
+    self.mmu[0xC104] = 0x1
+    self.mmu[0xC106]
+    self.assertEqual(seen, [])
+
+    # The write lands before the callback sees it. Echo ram is a different address.
+    self.assertEqual(self.mmu[0xC105], 0x11)
+    self.mmu[0xE105] = 0x21
+    self.mmu[0xC105] = 0x22
+    self.assertEqual(seen, [(0xC105, 0x11, False), (0xC105, 0x22, True)])
+    self.assertEqual(self.mmu.wram[0x105], 0x22)
+
+    # Block writes are seen, and watches sit under traps.
+    sprung = []
+    self.mmu.trap_writes(0xC1, sprung.append)
+    self.mmu.write_block(0xC100, bytearray([0x33] * 8))
+    self.assertEqual(sprung, [0xC1])
+    self.assertEqual(seen[-1], (0xC105, 0x33, True))
+    self.mmu[0xC105] = 0x44
+    self.assertEqual(seen[-1], (0xC105, 0x44, True))
+
+    # Unwatching puts the plain page back.
+    del seen[:]
+    self.mmu.unwatch(0xC105, callback)
+    self.mmu[0xC105] = 0x55
+    self.mmu[0xC105]
+    self.assertEqual(seen, [])
+    self.assertIsInstance(self.mmu._read_pages[0xC1], memoryview)
+    self.assertIsInstance(self.mmu._write_pages[0xC1], memoryview)
+
+  def test_lock(self):
+    lock = PageLock()
+    self.mmu.wram[0x100] = 0x11
+    self.mmu.lock(0xC1, 0xC1, lock)
+    self.assertEqual(self.mmu[0xC100], 0x11)
+    lock.locked = True
+    self.mmu[0xC100] = 0x22
+    self.assertEqual(self.mmu[0xC100], 0xFF)
+    self.assertEqual(bytes(self.mmu.read_block(0xC0FF, 2)), b'\x00\xff')
+    lock.locked = False
+    self.assertEqual(self.mmu[0xC100], 0x11)
+
+    # Locks sit under traps and watches, which still see locked accesses.
+    seen = []
+    sprung = []
+    self.mmu.watch(0xC100, lambda addr, value, is_write: seen.append(value), reads=True)
+    self.mmu.trap_writes(0xC1, sprung.append)
+    lock.locked = True
+    self.mmu[0xC100] = 0x33
+    self.mmu[0xC100]
+    self.assertEqual((seen, sprung), ([0x33, 0xFF], [0xC1]))
+    self.assertEqual(self.mmu.wram[0x100], 0x11)
+
+    # Forks don't inherit locks.
+    child = self.mmu.fork()
+    self.assertEqual(child[0xC100], 0x11)
+    self.mmu.unlock(0xC1, 0xC1)
+    self.mmu[0xC100] = 0x44
+    self.assertEqual(self.mmu[0xC100], 0x44)
+    self.assertEqual(seen[-1], 0x44)
+
+  def test_load_cartridge(self):
+    cart = Cartridge(b"\x00" * ROM_TYPE_BYTE + b"\x01" + b"\x00" * 0x10 + b"\x42")
+    self.mmu.load_cartridge(cart)
+    self.assertEqual(self.mmu[ROM_TYPE_BYTE + 0x11], 0x42)
+
+    self.mmu.unload_cartridge(cart)
+    self.assertEqual(self.mmu[ROM_TYPE_BYTE + 0x11], 0x0)
+
+  def test_read_block(self):
+    self.mmu.wram[:] = bytearray(x & 0xFF for x in range(0x2000))
+    block = self.mmu.read_block(0xC010, 0x1000)
+    # A range inside one buffer is handed back without copying.
+    self.assertIsInstance(block, memoryview)
+    self.assertEqual(bytes(block), bytes(self.mmu.wram[0x10:0x1010]))
+
+    # Echo ram is contiguous with the end of wram, but is a separate run.
+    block = self.mmu.read_block(0xDFFE, 4)
+    self.assertEqual(bytes(block), bytes(bytearray([0xFE, 0xFF, 0x00, 0x01])))
+
+    # Ranges crossing into devices fall back to per byte reads for those devices.
+    self.mmu.zram[:] = bytearray([0x77]) * 0x80
+    block = self.mmu.read_block(0xFF7E, 4)
+    self.assertEqual(bytes(block), bytes(bytearray([0, 0, 0x77, 0x77])))
+
+    with self.assertRaises(KeyError):
+      self.mmu.read_block(0xFFFF, 2)
+
+  def test_write_block(self):
+    self.mmu.write_block(0xDFF0, bytearray(range(0x20)))
+    self.assertEqual(self.mmu.wram[0x1FF0:], bytearray(range(0x10)))
+    self.assertEqual(self.mmu.wram[:0x10], bytearray(range(0x10, 0x20)))
+
+    self.mmu.write_block(0xFF7F, b"\x01\x02")
+    self.assertEqual(self.mmu.zram[0], 0x02)
+
+  def test_dma(self):
+    oam = bytearray(0xA0)
+    io = bytearray(0x80)
+    mmu = Mmu(DummyMem(), DummyMem(), oam, io)
+    mmu.write_block(0xC100, bytearray(range(0xA0)))
+    mmu[0xFF46] = 0xC1
+    self.assertEqual(oam, bytearray(range(0xA0)))
+
+  def test_cartridge_bank_switch(self):
+    romstring = bytearray().join(bytearray([i + 5]) * 0x4000 for i in range(8))
+    romstring[ROM_TYPE_BYTE] = 0x1
+    cart = Cartridge(romstring)
+    self.mmu.load_cartridge(cart)
+    self.mmu.in_bios = False
+
+    self.assertEqual(self.mmu[0x4000], 6)
+    self.mmu[0x2000] = 3
+    self.assertEqual(self.mmu[0x4000], 8)
+    self.assertEqual(self.mmu[0x7FFF], 8)
+    # Banked rom is read straight out of the rom image.
+    self.assertIsInstance(self.mmu._read_pages[0x40], memoryview)
+
+    # Ram is disabled until enabled through the cartridge registers.
+    self.mmu[0xA000] = 0x12
+    self.assertEqual(self.mmu[0xA000], 0)
+    self.mmu[0x0000] = 0xA
+    self.mmu[0xA000] = 0x12
+    self.assertEqual(self.mmu[0xA000], 0x12)
+    self.assertEqual(cart.rambanks[0][0], 0x12)
+
+    self.mmu[0x6000] = 1
+    self.mmu[0x4000] = 2
+    self.mmu[0xBFFF] = 0x34
+    self.assertEqual(cart.rambanks[2][0x1FFF], 0x34)
+    self.assertEqual(self.mmu[0xA000], 0)
+
+    # The old cartridge no longer remaps the mmu once it is unloaded.
+    self.mmu.unload_cartridge(cart)
+    cart[0x2000] = 4
+    self.assertEqual(self.mmu[0x4000], 0)
@@ -0,0 +1,196 @@
+import random
+import unittest
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+from gb.io import *
+from gb.machine import Machine
+
+if numpy is not None:
+  from gb.ppu import *
+
+
+def reference_frame(vram, oam, regs):
+  """Render a frame a pixel at a time, the obvious way, to check Renderer against."""
+  lcdc = regs[LCDC_REG]
+  frame = [[0] * 160 for _ in range(144)]
+  if not lcdc & LCDC_ENABLE:
+    return frame
+
+  def tile_pixel(tile, y, x):
+    lo = vram[tile * 16 + y * 2]
+    hi = vram[tile * 16 + y * 2 + 1]
+    return (lo >> (7 - x) & 1) | (hi >> (7 - x) & 1) << 1
+
+  def map_pixel(map_bit, y, x):
+    base = 0x1C00 if lcdc & map_bit else 0x1800
+    number = vram[base + (y >> 3) * 32 + (x >> 3)]
+    if not lcdc & LCDC_TILE_DATA and number < 128:
+      number += 256
+    return tile_pixel(number, y & 7, x & 7)
+
+  def shade(palette, colour):
+    return palette >> (colour * 2) & 3
+
+  height = 16 if lcdc & LCDC_OBJ_SIZE else 8
+  window_line = 0
+  for y in range(144):
+    window_shown = False
+    colours = [0] * 160
+    for x in range(160):
+      if lcdc & LCDC_BG_ENABLE:
+        wx = regs[WX_REG] - 7
+        if lcdc & LCDC_WINDOW_ENABLE and y >= regs[WY_REG] and x >= wx:
+          colours[x] = map_pixel(LCDC_WINDOW_MAP, window_line, x - wx)
+          window_shown = True
+        else:
+          colours[x] = map_pixel(LCDC_BG_MAP, (y + regs[SCY_REG]) & 0xFF,
+                                 (x + regs[SCX_REG]) & 0xFF)
+      frame[y][x] = shade(regs[BGP_REG], colours[x])
+    window_line += window_shown
+
+    if not lcdc & LCDC_OBJ_ENABLE:
+      continue
+    on_line = [i for i in range(40) if oam[i * 4] - 16 <= y < oam[i * 4] - 16 + height][:10]
+    for x in range(160):
+      best = None
+      for i in on_line:
+        sy, sx, tile, flags = oam[i * 4:i * 4 + 4]
+        sx -= 8
+        if not sx <= x < sx + 8:
+          continue
+        row = y - (sy - 16)
+        col = x - sx
+        if flags & 0x40:
+          row = height - 1 - row
+        if flags & 0x20:
+          col = 7 - col
+        if height == 16:
+          tile &= 0xFE
+        colour = tile_pixel(tile + (row >> 3), row & 7, col)
+        if colour and (best is None or sx < best[0]):
+          best = sx, colour, flags
+      if best is not None:
+        _, colour, flags = best
+        if not (flags & 0x80 and colours[x]):
+          frame[y][x] = shade(regs[OBP1_REG if flags & 0x10 else OBP0_REG], colour)
+  return frame
+
+
+@unittest.skipIf(numpy is None, "needs numpy")
+class TestRenderer(unittest.TestCase):
+
+  def setUp(self):
+    self.machine = Machine()
+    self.mmu = self.machine.mmu
+    self.renderer = Renderer(self.mmu)
+
+  def set_regs(self, **regs):
+    for name, value in regs.items():
+      self.mmu[0xFF00 + globals()[name.upper() + '_REG']] = value
+
+  def check(self):
+    frame = self.renderer.render_frame()
+    expected = reference_frame(bytearray(self.mmu.vram), bytearray(self.mmu.oam),
+                               bytearray(self.mmu.io))
+    self.assertEqual(frame.shape, (SCREEN_HEIGHT, SCREEN_WIDTH))
+    self.assertEqual(frame.tolist(), expected)
+    return frame
+
+  def test_decode_tiles(self):
+    tiles = decode_tiles(bytes(bytearray([0x3C, 0x7E] + [0] * 14)))
+    self.assertEqual(tiles.shape, (1, 8, 8))
+    self.assertEqual(tiles[0, 0].tolist(), [0, 2, 3, 3, 3, 3, 2, 0])
+    self.assertEqual(to_rgb(tiles[0])[0, 1].tolist(), [0x55, 0x55, 0x55])
+
+  def test_lcd_off(self):
+    self.renderer.frame[:] = 3
+    self.set_regs(lcdc=0)
+    self.assertEqual(self.renderer.render_frame().max(), 0)
+
+  def test_background(self):
+    # Tile 1 is solid colour 3, and is the only tile in the map, top left.
+    self.mmu.write_block(0x8010, bytearray([0xFF]) * 16)
+    self.mmu[0x8000 + TILE_MAP_0] = 1
+    self.set_regs(lcdc=LCDC_ENABLE | LCDC_BG_ENABLE | LCDC_TILE_DATA, bgp=0xE4, scx=4,
+                  scy=2)
+    frame = self.check()
+    self.assertEqual(frame[:6, :4].tolist(), [[3] * 4] * 6)
+    self.assertEqual(frame[6, 0], 0)
+    self.assertEqual(frame[0, 4], 0)
+
+  def test_random(self):
+    rng = random.Random(1)
+    for lcdc in (0xFF, 0xF3, 0xE3, 0x93, 0xC7, 0x91):
+      self.mmu.write_block(0x8000, bytearray(rng.randrange(256) for _ in range(0x2000)))
+      # Sprites mostly on screen, with some lines crowded past the limit.
+      self.mmu.oam[:0xA0] = bytearray(
+        rng.choice([rng.randrange(256), rng.randrange(16, 40), 60]) if i % 4 == 0 else
+        rng.randrange(176) if i % 4 == 1 else rng.randrange(256) for i in range(0xA0))
+      self.set_regs(lcdc=lcdc, scx=rng.randrange(256), scy=rng.randrange(256),
+                    wy=rng.randrange(100), wx=rng.randrange(170), bgp=rng.randrange(256),
+                    obp0=rng.randrange(256), obp1=rng.randrange(256))
+      self.check()
+
+  def test_tile_cache(self):
+    self.set_regs(lcdc=0x91, bgp=0xE4)
+    rng = random.Random(3)
+    self.mmu.write_block(0x8000, bytearray(rng.randrange(256) for _ in range(0x2000)))
+    self.check()
+    # Tile data, and tile maps in both numbering modes, changed through the mmu.
+    for lcdc in (0x91, 0x81, 0x89):
+      self.set_regs(lcdc=lcdc)
+      for _ in range(20):
+        self.mmu[0x8000 + rng.randrange(0x2000)] = rng.randrange(256)
+      self.mmu[0x8000 + TILE_MAP_0 + 33] ^= 0x80
+      self.check()
+
+    # Writes straight into vram aren't seen until the cache is invalidated.
+    cache = self.renderer.cache
+    self.mmu.vram[0x10:0x20] = bytearray([0xFF]) * 16
+    cache.update()
+    self.assertNotEqual(cache.tiles[1].tolist(), [[3] * 8] * 8)
+    cache.invalidate()
+    cache.update()
+    self.assertEqual(cache.tiles[1].tolist(), [[3] * 8] * 8)
+
+    # Nor are state loads missed.
+    state = self.machine.save_state()
+    self.mmu[0x8010] = 0
+    self.check()
+    self.machine.load_state(state)
+    self.check()
+
+  def test_fork(self):
+    self.set_regs(lcdc=0x91, bgp=0xE4)
+    self.mmu.write_block(0x8000,
+                         bytearray(random.Random(4).randrange(256) for _ in range(0x2000)))
+    fork = self.machine.fork()
+    renderer = Renderer(fork.mmu)
+    # Drawing a fork reads its memory without copying it, and sees its own writes.
+    expected = self.renderer.render_frame().tolist()
+    self.assertEqual(renderer.render_frame().tolist(), expected)
+    self.assertIs(fork.mmu.page_source(0x80)[0], self.mmu.page_source(0x80)[0])
+    fork.mmu.write_block(0x8000, bytearray([0xFF]) * 0x800)
+    self.assertNotEqual(renderer.render_frame().tolist(), expected)
+    self.assertEqual(self.renderer.render_frame().tolist(), expected)
+    self.assertIs(fork.mmu.page_source(0x88)[0], self.mmu.page_source(0x88)[0])
+
+  def test_lines(self):
+    # The window only moves down on the lines it is drawn on.
+    self.mmu.write_block(0x8000,
+                         bytearray(random.Random(2).randrange(256) for _ in range(0x2000)))
+    self.set_regs(lcdc=0xF1, wy=0, wx=7, bgp=0xE4)
+    expected = reference_frame(bytearray(self.mmu.vram), bytearray(self.mmu.oam),
+                               bytearray(self.mmu.io))
+    self.renderer.render_lines(0, 50)
+    self.set_regs(wx=200)
+    self.renderer.render_lines(50, 60)
+    self.set_regs(wx=7)
+    self.renderer.render_lines(60, 144)
+    frame = self.renderer.frame.tolist()
+    self.assertEqual(frame[:50], expected[:50])
+    self.assertEqual(frame[60:], expected[50:134])
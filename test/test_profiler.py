@@ -0,0 +1,82 @@
+import io
+import unittest
+
+from benchmarks.roms import make_rom
+from gb.cartridge import Cartridge
+from gb.cpu import Cpu
+from gb.machine import Machine
+from gb.profiler import *
+
+
+class TestProfiler(unittest.TestCase):
+
+  def setUp(self):
+    rom = bytearray(make_rom([
+      0x31, 0xFE, 0xFF,        # ld sp,0xFFFE
+      0x3E, 0x02,              # ld a,2
+      0xEA, 0x00, 0x20,        # ld (0x2000),a: rom bank 2
+      'loop:',
+      0xCD, ('abs', 'sub'),    # call sub
+      0xCD, 0x00, 0x40,        # call 0x4000
+      0x18, ('rel', 'loop'),
+      'sub:',
+      0xCB, 0x37,              # swap a
+      0xC9,                    # ret
+    ]))
+    rom[0x8000:0x8002] = bytearray([
+      0x3C,                    # inc a
+      0xC9,                    # ret
+    ])
+    self.machine = Machine(Cartridge(bytes(rom)))
+    self.profiler = Profiler(self.machine.cpu)
+
+  def test_start_stop(self):
+    self.profiler.start()
+    self.assertIsInstance(self.machine.cpu, Cpu)
+    self.assertTrue(self.profiler.running)
+    self.machine.run(1000)
+    self.profiler.stop()
+    self.assertIs(type(self.machine.cpu), Cpu)
+    counted = sum(self.profiler.opcode_counts)
+    self.machine.run(1000)
+    self.assertEqual(sum(self.profiler.opcode_counts), counted)
+
+  def test_counts(self):
+    self.profiler.start()
+    self.machine.run(10000)
+    self.profiler.stop()
+    counts = self.profiler.opcode_counts
+    calls = counts[0xCD]
+    self.assertGreater(calls, 100)
+    self.assertEqual(counts[0xC9], calls)
+    self.assertEqual(self.profiler.ext_opcode_counts[0x37], counts[0xCB])
+    self.assertEqual(self.profiler.bank_counts[2][0], calls // 2)
+    self.assertIn(((2, 0x4000), calls // 2), self.profiler.hot_addresses())
+
+    regions = dict(self.profiler.region_cycles())
+    self.assertEqual(sum(regions.values()), self.machine.cpu.cycles)
+    self.assertGreater(regions['romx'], 0)
+    self.assertIn('swap a', self.profiler.report())
+
+  def test_self_modifying_ext_opcode(self):
+    mmu = self.machine.mmu
+    mmu.write_block(0xC000, bytearray([
+      0x21, 0x04, 0xC0,        # ld hl,0xC004
+      0xCB, 0xC6,              # set 0,(hl): turns itself into set 0,a
+      0x18, 0xFE,              # jr $
+    ]))
+    self.machine.cpu.pc = 0xC000
+    self.profiler.start()
+    self.machine.run(100)
+    self.assertEqual(mmu[0xC004], 0xC7)
+    self.assertEqual(self.profiler.ext_opcode_counts[0xC6], 1)
+    self.assertEqual(self.profiler.ext_opcode_counts[0xC7], 0)
+
+  def test_collapsed(self):
+    self.profiler.start()
+    self.machine.run(10000)
+    f = io.StringIO()
+    self.profiler.write_collapsed(f)
+    stacks = dict(line.rsplit(' ', 1) for line in f.getvalue().splitlines())
+    self.assertEqual(sorted(stacks), ['root', 'root;0110', 'root;02:4000'])
+    self.assertEqual(sum(int(cycles) for cycles in stacks.values()), self.machine.cpu.cycles)
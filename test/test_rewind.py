@@ -0,0 +1,104 @@
+import unittest
+
+from gb.cartridge import *
+from gb.machine import *
+from gb.rewind import *
+from gb.rewind import _xor
+
+class TestRewind(unittest.TestCase):
+
+  def setUp(self):
+    rom = bytearray(0x10000)
+    rom[ROM_TYPE_BYTE] = 0x01
+    # 0x100: ld a,0x0A; ld (0x0000),a; ld a,2; ld (0x2000),a; ld hl,0xA000;
+    # loop: inc (hl); ld a,(0x4000); ld (0xC000),a; inc a; ld (0x2000),a; inc l;
+    # ld (hl),a; dec l; jr loop
+    rom[0x100:0x11D] = bytearray([
+      0x3E, 0x0A, 0xEA, 0x00, 0x00, 0x3E, 0x02, 0xEA, 0x00, 0x20, 0x21, 0x00, 0xA0,
+      0x34, 0xFA, 0x00, 0x40, 0xEA, 0x00, 0xC0, 0x3C, 0xEA, 0x00, 0x20, 0x2C, 0x77,
+      0x2D, 0x18, 0xF0])
+    for bank in range(1, 4):
+      rom[bank * 0x4000] = bank
+    self.machine = Machine(Cartridge(bytes(rom)))
+
+  def record(self, rewind, count, cycles=1000):
+    """Take count snapshots, cycles apart, returning the full save state at each."""
+    states = []
+    for _ in range(count):
+      self.machine.run(cycles)
+      rewind.snapshot()
+      states.append(self.machine.save_state())
+    return states
+
+  def test_xor(self):
+    old = bytearray(range(256))
+    new = bytearray(old)
+    new[0] = 0xFF
+    new[255] = 0x00
+    delta = _xor(memoryview(old), new)
+    self.assertEqual(len(delta), 256)
+    self.assertEqual(bytearray(delta), bytearray([0xFF]) + bytearray(254) + bytearray([0xFF]))
+    self.assertEqual(bytearray(_xor(old, delta)), new)
+
+  def test_restore(self):
+    rewind = Rewind(self.machine, keyframe_interval=4)
+    states = self.record(rewind, 10)
+    self.assertEqual(len(rewind), 10)
+
+    rewind.restore(6)
+    self.assertEqual(self.machine.save_state(), states[6])
+    self.assertEqual(len(rewind), 7)
+    # Recording carries on from the restored snapshot.
+    states[7:] = self.record(rewind, 3)
+    for index in (9, 3, 0):
+      rewind.restore(index)
+      self.assertEqual(self.machine.save_state(), states[index])
+
+  def test_dirty_pages(self):
+    rewind = Rewind(self.machine)
+    self.record(rewind, 2)
+    # Only the pages written are saved: the loop writes one page of wram and one of
+    # cartridge ram (in each bank it switches through).
+    pages = rewind._snapshots[-1].pages
+    self.assertIn(('wram', 0), pages)
+    self.assertIn(('cartridge.ram0', 0), pages)
+    self.assertEqual(set(page for _, page in pages), {0})
+
+    rewind.snapshot()
+    self.assertEqual(rewind._snapshots[-1].pages, ())
+    # Writes through echo ram are tracked too.
+    self.machine.mmu[0xE345] = 1
+    rewind.snapshot()
+    self.assertEqual(rewind._snapshots[-1].pages, (('wram', 3),))
+
+  def test_memory_cap(self):
+    rewind = Rewind(self.machine, keyframe_interval=5)
+    self.record(rewind, 5)
+    rewind.max_bytes = rewind.memory_used * 2
+    states = self.record(rewind, 20)
+    self.assertLessEqual(rewind.memory_used, rewind.max_bytes)
+    self.assertLess(len(rewind), 20)
+    self.assertEqual(len(rewind) % 5, 0)
+    # The oldest snapshot left is still complete.
+    oldest = states[-len(rewind)]
+    rewind.restore(0)
+    self.assertEqual(self.machine.save_state(), oldest)
+
+  def test_scheduled(self):
+    rewind = Rewind(self.machine, interval=1000)
+    rewind.start()
+    self.machine.run(10500)
+    # Snapshots are taken at the first instruction boundary after each interval.
+    times = rewind.times
+    self.assertEqual(len(times), 11)
+    for i, time in enumerate(times):
+      self.assertTrue(0 <= time - i * 1000 < 24)
+
+    rewind.restore(5)
+    self.assertEqual(self.machine.cpu.cycles, times[5])
+    self.machine.run(2500)
+    self.assertEqual(len(rewind), 8)
+    self.assertTrue(0 <= rewind.times[-1] - times[5] - 2000 < 24)
+    rewind.stop()
+    self.machine.run(2500)
+    self.assertEqual(len(rewind), 8)
@@ -0,0 +1,127 @@
+import unittest
+
+from gb.cpu import *
+from gb.mem import *
+from gb.mmu import *
+from gb.scheduler import *
+
+class TestScheduler(unittest.TestCase):
+
+  def setUp(self):
+    self.scheduler = Scheduler()
+    self.calls = []
+
+  def callback(self, name):
+    return lambda deadline: self.calls.append((name, deadline))
+
+  def test_order(self):
+    self.scheduler.schedule(30, self.callback('c'))
+    self.scheduler.schedule(10, self.callback('a'))
+    self.scheduler.schedule(20, self.callback('b'))
+    self.assertEqual(self.scheduler.next_deadline, 10)
+
+    self.scheduler.run_due(25)
+    self.assertEqual(self.calls, [('a', 10), ('b', 20)])
+    self.assertEqual(self.scheduler.next_deadline, 30)
+
+    self.scheduler.run_due(30)
+    self.assertEqual(self.calls[-1], ('c', 30))
+    self.assertEqual(self.scheduler.next_deadline, NEVER)
+
+  def test_cancel(self):
+    a = self.scheduler.schedule(10, self.callback('a'))
+    b = self.scheduler.schedule(20, self.callback('b'))
+    self.scheduler.cancel(a)
+    self.assertFalse(a.pending)
+    self.assertEqual(self.scheduler.next_deadline, 20)
+    self.scheduler.cancel(b)
+    self.assertEqual(self.scheduler.next_deadline, NEVER)
+    self.scheduler.run_due(100)
+    self.assertEqual(self.calls, [])
+
+  def test_reschedule(self):
+    a = self.scheduler.schedule(10, self.callback('a'))
+    self.scheduler.schedule(20, self.callback('b'))
+    self.scheduler.reschedule(a, 30)
+    self.assertEqual(self.scheduler.next_deadline, 20)
+    self.scheduler.reschedule(a, 5)
+    self.assertEqual(self.scheduler.next_deadline, 5)
+
+    self.scheduler.run_due(100)
+    self.assertEqual(self.calls, [('a', 5), ('b', 20)])
+
+    # Events that already ran can be put back on the timeline.
+    self.scheduler.reschedule(a, 200)
+    self.scheduler.run_due(200)
+    self.assertEqual(self.calls[-1], ('a', 200))
+
+  def test_periodic(self):
+    def tick(deadline):
+      self.calls.append(deadline)
+      self.scheduler.schedule(deadline + 10, tick)
+    self.scheduler.schedule(10, tick)
+    self.scheduler.run_due(35)
+    self.assertEqual(self.calls, [10, 20, 30])
+    self.assertEqual(self.scheduler.next_deadline, 40)
+
+  def test_earlier_deadline_hook(self):
+    deadlines = []
+    self.scheduler.on_earlier_deadline = deadlines.append
+    self.scheduler.schedule(20, self.callback('a'))
+    self.scheduler.schedule(30, self.callback('b'))
+    self.scheduler.schedule(10, self.callback('c'))
+    self.assertEqual(deadlines, [20, 10])
+
+
+class TestCpuScheduling(unittest.TestCase):
+
+  def setUp(self):
+    self.mmu = Mmu(DummyMem(), DummyMem(), DummyMem(), DummyMem())
+    self.mmu.in_bios = False
+    self.cpu = Cpu(self.mmu)
+    # loop: inc a; jr loop
+    self.mmu.write_block(0xC000, bytearray([0x3C, 0x18, 0xFD]))
+    self.cpu.pc = 0xC000
+
+  def test_clock(self):
+    self.assertIs(self.mmu.scheduler.clock, self.cpu)
+    self.cpu.run(100)
+    self.assertEqual(self.mmu.scheduler.now, self.cpu.cycles)
+
+  def test_events_run_on_time(self):
+    seen = []
+    def event(deadline):
+      seen.append((deadline, self.cpu.cycles, self.cpu.a))
+      if len(seen) < 3:
+        self.mmu.scheduler.schedule(deadline + 160, event)
+    self.mmu.scheduler.schedule(160, event)
+
+    cycles, reason = self.cpu.run(1000)
+    self.assertEqual(reason, REASON_CYCLES)
+    # Each iteration of the loop is 16 cycles, so events land exactly on iterations.
+    self.assertEqual(seen, [(160, 160, 10), (320, 320, 20), (480, 480, 30)])
+
+  def test_event_scheduled_during_run(self):
+    # A device write which schedules an event must cut the current batch short.
+    seen = []
+    class Device(DummyMem):
+      def attach(device, mmu):
+        device.scheduler = mmu.scheduler
+      def __setitem__(device, addr, value):
+        device.scheduler.schedule_in(4, lambda deadline: seen.append((deadline, cpu.cycles)))
+    mmu = Mmu(DummyMem(), Device(), DummyMem(), DummyMem())
+    mmu.in_bios = False
+    cpu = Cpu(mmu)
+    # ld (0x8000),a; loop: jr loop
+    mmu.write_block(0xC000, bytearray([0xEA, 0x00, 0x80, 0x18, 0xFE]))
+    cpu.pc = 0xC000
+    cpu.run(10000)
+    # The write happens during an instruction starting at cycle 0, and events run between
+    # instructions, so it runs at the end of that 16 cycle instruction.
+    self.assertEqual(seen, [(4, 16)])
+
+  def test_execute_instr_runs_events(self):
+    seen = []
+    self.mmu.scheduler.schedule(4, seen.append)
+    self.cpu.execute_instr()
+    self.assertEqual(seen, [4])
@@ -0,0 +1,142 @@
+import io
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+from benchmarks.roms import make_rom
+from gb.cartridge import Cartridge
+from gb.cpu import Cpu
+from gb.machine import Machine
+from gb.profiler import Profiler
+from gb.trace import *
+
+# Counts a up into 0xC000 forever, switching to rom bank 2 and back every 256 counts.
+ROM = bytearray(make_rom([
+  0xAF,                    # xor a
+  'loop:',
+  0x3C,                    # inc a
+  0xEA, 0x00, 0xC0,        # ld (0xC000),a
+  0x20, ('rel', 'loop'),   # jr nz,loop
+  0x3E, 0x02,              # ld a,2
+  0xEA, 0x00, 0x20,        # ld (0x2000),a
+  0xCD, 0x00, 0x40,        # call 0x4000
+  0x3E, 0x01,              # ld a,1
+  0xEA, 0x00, 0x20,        # ld (0x2000),a
+  0xAF,                    # xor a
+  0x18, ('rel', 'loop'),
+]))
+ROM[0x8000] = 0xC9         # ret, in bank 2
+ROM = bytes(ROM)
+
+
+class TestTrace(unittest.TestCase):
+
+  def setUp(self):
+    self.machine = Machine(Cartridge(ROM))
+    self.machine.cpu.sp = 0xFFFE
+
+  def trace(self, cycles, **kwargs):
+    f = io.BytesIO()
+    tracer = Tracer(self.machine.cpu, f, **kwargs)
+    tracer.start()
+    self.machine.run(cycles)
+    tracer.stop()
+    f.seek(0)
+    return tracer, f
+
+  def test_records(self):
+    cpu = self.machine.cpu
+    start = cpu.cycles
+    tracer, f = self.trace(20000, chunk_records=64, chunks=2)
+    self.assertIs(type(cpu), Cpu)
+    records = list(read_trace(f))
+    self.assertEqual(len(records), tracer.records)
+    self.assertGreater(len(records), 1000)
+
+    first = records[0]
+    self.assertEqual((first.cycles, first.pc, first.opcode, first.bank),
+                     (start, 0x100, 0xAF, 1))
+    self.assertEqual((records[1].pc, records[1].af >> 8), (0x101, 0x00))
+    self.assertEqual(records[2].af >> 8, 0x01)
+    # Cycles only go up, and the bank is the one mapped when each instruction ran.
+    self.assertTrue(all(a.cycles < b.cycles for a, b in zip(records, records[1:])))
+    self.assertEqual(set(record.bank for record in records if record.pc == 0x4000), {2})
+    self.assertEqual(set(record.bank for record in records if record.pc == 0x101), {1})
+
+    # Tracing again appends to the same trace.
+    tracer.start()
+    self.machine.run(1000)
+    tracer.stop()
+    f.seek(0)
+    self.assertEqual(len(list(read_trace(f))), tracer.records)
+
+  def test_matches_interpreter(self):
+    _, f = self.trace(5000)
+    machine = Machine(Cartridge(ROM))
+    cpu = machine.cpu
+    cpu.sp = 0xFFFE
+    for record in read_trace(f):
+      self.assertEqual((record.cycles, record.pc, record.af, record.hl, record.sp),
+                       (cpu.cycles, cpu.pc, cpu.af, cpu.hl, cpu.sp))
+      cpu.execute_instr()
+
+  def test_exclusive(self):
+    Profiler(self.machine.cpu).start()
+    with self.assertRaises(ValueError):
+      Tracer(self.machine.cpu, io.BytesIO()).start()
+
+  def test_first_divergence(self):
+    _, f1 = self.trace(5000)
+    data = f1.getvalue()
+    self.assertIsNone(first_divergence(io.BytesIO(data), io.BytesIO(data)))
+
+    # Changing a register in one record.
+    changed = bytearray(data)
+    changed[HEADER.size + 300 * RECORD_SIZE + 14] ^= 0x01
+    index, record1, record2 = first_divergence(io.BytesIO(data), io.BytesIO(bytes(changed)))
+    self.assertEqual(index, 300)
+    self.assertNotEqual(record1, record2)
+    self.assertEqual(record1.pc, record2.pc)
+
+    # One trace stopping early.
+    short = data[:HEADER.size + 400 * RECORD_SIZE]
+    index, record1, record2 = first_divergence(io.BytesIO(short), io.BytesIO(data))
+    self.assertEqual(index, 400)
+    self.assertIsNone(record1)
+    self.assertIsNotNone(record2)
+
+    with self.assertRaises(TraceError):
+      first_divergence(io.BytesIO(b'GBCP' + data[4:]), io.BytesIO(data))
+
+  def test_main(self):
+    _, f = self.trace(5000)
+    data = f.getvalue()
+    changed = bytearray(data)
+    changed[HEADER.size + 30 * RECORD_SIZE + 2] ^= 0x01
+    directory = tempfile.mkdtemp()
+    try:
+      paths = []
+      for name, contents in (('a', data), ('b', changed)):
+        paths.append(os.path.join(directory, name))
+        with open(paths[-1], 'wb') as trace_file:
+          trace_file.write(contents)
+
+      stdout = sys.stdout
+      try:
+        sys.stdout = io.StringIO()
+        self.assertEqual(main(['show', paths[0], '--start', '1', '--count', '2']), 0)
+        self.assertEqual(main(['diff', paths[0], paths[0]]), 0)
+        self.assertEqual(main(['diff', paths[0], paths[1], '--context', '3']), 1)
+        output = sys.stdout.getvalue()
+      finally:
+        sys.stdout = stdout
+    finally:
+      shutil.rmtree(directory)
+    lines = output.splitlines()
+    self.assertIn('01:0101', lines[0])
+    self.assertIn('inc a', lines[0])
+    self.assertEqual(lines[2], "The traces are the same.")
+    self.assertEqual(lines[6], "The traces differ at record 30:")
+    self.assertTrue(lines[7].startswith('-') and lines[8].startswith('+'))